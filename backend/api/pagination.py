@@ -0,0 +1,36 @@
+"""
+游标分页工具
+
+游标是对排序键（如消息序号、(updated_at, id)）和翻页方向的不透明编码，
+客户端只需原样回传 next_cursor / prev_cursor。
+"""
+
+import base64
+import json
+from typing import Any, Dict
+
+from fastapi import HTTPException, status
+
+NEXT = "next"
+PREV = "prev"
+
+def encode_cursor(direction: str, **keys: Any) -> str:
+    """将排序键和翻页方向编码为游标"""
+    payload = json.dumps({"d": direction, **keys}, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, *required_keys: str) -> Dict[str, Any]:
+    """解析游标，格式不正确或缺少 required_keys 中的排序键时返回400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if payload.get("d") not in (NEXT, PREV):
+            raise ValueError("unknown direction")
+        if any(payload.get(key) is None for key in required_keys):
+            raise ValueError("missing sort key")
+        return payload
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="无效的分页游标"
+        )
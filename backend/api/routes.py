@@ -1,24 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from typing import List, Dict, Any, Optional
+from sqlalchemy.orm import Session, contains_eager
+from sqlalchemy import or_, tuple_
+from typing import List, Dict, Any, Optional, Tuple
 import uuid
 import random
 from datetime import datetime
 import json
+import math
 import asyncio
 
 from models.database import (
-    get_db, User, DigitalPersona, Scenario, Conversation, ConversationMessage, 
+    get_db, SessionLocal, User, DigitalPersona, Scenario, Conversation, ConversationMessage, 
     MessageFeedback, PromptOptimization, MarketAgent, MatchRelation, AutoConversation,
-    AutoConversationMessage, RealTimeMessage
+    AutoConversationMessage, RealTimeMessage, ChatSession
 )
 from services.ai_service import ai_service, scenario_service
 from services.match_service import match_service
 from services.chat_service import chat_service
+from services.message_buffer import message_buffer, SEQUENCE_GAP_GRACE
 from services.auth_service import auth_service
 from services.task_service import task_service
+from services.scheduler_service import scheduler_service
+from services.display_name_cache import display_name_cache
+from services.conversation_context import conversation_context_builder
+from api.pagination import encode_cursor, decode_cursor, NEXT, PREV
 from pydantic import BaseModel
 
 # 创建路由
@@ -90,6 +97,8 @@ class PaginatedConversationsResponse(BaseModel):
     page: int
     size: int
     total_pages: int
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
 
 class MessageCreate(BaseModel):
     conversation_id: str
@@ -494,18 +503,24 @@ async def get_conversations(
 
 @router.get("/conversations/paginated", response_model=PaginatedConversationsResponse)
 async def get_conversations_paginated(
-    page: int = 1,
+    page: int = Query(1, deprecated=True, description="页码（已废弃，请使用cursor）"),
     size: int = 10,
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
     category: Optional[str] = None,
     sort_by: str = "date_desc",
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取用户的对话列表（分页）"""
+    """
+    获取用户的对话列表（分页）
+    
+    按时间排序时支持游标分页：键为 (updated_at, id)，响应中的 next_cursor / prev_cursor
+    可直接作为下次请求的 cursor；按标题排序时仍使用页码分页
+    """
     try:
-        # 基础查询
-        query = db.query(Conversation).filter(
+        # 基础查询（场景始终内连接，搜索/分类筛选和结果构建共用同一次连接）
+        query = db.query(Conversation).join(Conversation.scenario).filter(
             Conversation.user_id == current_user.id,
             Conversation.is_active == True
         )
@@ -513,7 +528,7 @@ async def get_conversations_paginated(
         # 搜索筛选
         if search:
             search_term = f"%{search}%"
-            query = query.join(Scenario).filter(
+            query = query.filter(
                 or_(
                     Conversation.title.ilike(search_term),
                     Scenario.name.ilike(search_term),
@@ -523,24 +538,65 @@ async def get_conversations_paginated(
         
         # 分类筛选
         if category and category != "all":
-            query = query.join(Scenario).filter(Scenario.category == category)
-        
-        # 排序
-        if sort_by == "date_desc":
-            query = query.order_by(Conversation.updated_at.desc())
-        elif sort_by == "date_asc":
-            query = query.order_by(Conversation.updated_at.asc())
-        elif sort_by == "title":
-            query = query.order_by(Conversation.title.asc())
-        else:
-            query = query.order_by(Conversation.updated_at.desc())
+            query = query.filter(Scenario.category == category)
         
         # 获取总数
         total = query.count()
         
-        # 分页
-        offset = (page - 1) * size
-        conversations = query.offset(offset).limit(size).all()
+        query = query.options(contains_eager(Conversation.scenario))
+        next_cursor = prev_cursor = None
+        
+        if sort_by == "title":
+            # 按标题排序不支持游标，使用页码分页
+            offset = (page - 1) * size
+            conversations = query.order_by(Conversation.title.asc()).offset(offset).limit(size).all()
+        else:
+            # 按 (updated_at, id) 做键集分页，id 保证排序稳定
+            ascending = sort_by == "date_asc"
+            sort_key = tuple_(Conversation.updated_at, Conversation.id)
+            direction = NEXT
+            
+            if cursor:
+                position = decode_cursor(cursor, "updated_at", "id")
+                direction = position["d"]
+                try:
+                    updated_at = datetime.fromisoformat(position["updated_at"])
+                except (TypeError, ValueError):
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="无效的分页游标"
+                    )
+                key = tuple_(updated_at, position["id"])
+                # 向后翻页沿排序方向取，向前翻页反向取再倒序
+                if (direction == NEXT) == ascending:
+                    query = query.filter(sort_key > key)
+                else:
+                    query = query.filter(sort_key < key)
+            
+            order_ascending = ascending if direction == NEXT else not ascending
+            if order_ascending:
+                query = query.order_by(Conversation.updated_at.asc(), Conversation.id.asc())
+            else:
+                query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+            
+            if cursor:
+                # 多取一条判断是否还有更多
+                conversations = query.limit(size + 1).all()
+            else:
+                offset = (page - 1) * size
+                conversations = query.offset(offset).limit(size + 1).all()
+            
+            has_more = len(conversations) > size
+            conversations = conversations[:size]
+            if direction == PREV:
+                conversations.reverse()
+            
+            if conversations:
+                first, last = conversations[0], conversations[-1]
+                if has_more or direction == PREV:
+                    next_cursor = encode_cursor(NEXT, updated_at=last.updated_at.isoformat(), id=last.id)
+                if (direction == NEXT and (cursor or page > 1)) or (direction == PREV and has_more):
+                    prev_cursor = encode_cursor(PREV, updated_at=first.updated_at.isoformat(), id=first.id)
         
         # 计算总页数
         total_pages = (total + size - 1) // size
@@ -548,24 +604,6 @@ async def get_conversations_paginated(
         # 构建结果
         result_conversations = []
         for conv in conversations:
-            # 获取消息统计
-            message_count = db.query(ConversationMessage).filter(
-                ConversationMessage.conversation_id == conv.id
-            ).count()
-            
-            # 获取最后一条消息
-            last_message_obj = db.query(ConversationMessage).filter(
-                ConversationMessage.conversation_id == conv.id
-            ).order_by(ConversationMessage.created_at.desc()).first()
-            
-            last_message = None
-            if last_message_obj:
-                content = last_message_obj.content
-                if len(content) > 50:
-                    last_message = content[:50] + "..."
-                else:
-                    last_message = content
-            
             # 计算时间差
             duration = calculate_duration(conv.created_at)
             
@@ -583,8 +621,8 @@ async def get_conversations_paginated(
                 },
                 digital_persona_id=str(conv.digital_persona_id),
                 created_at=conv.created_at,
-                message_count=message_count,
-                last_message=last_message or "暂无消息",
+                message_count=conv.message_count or 0,
+                last_message=conv.last_message_preview or "暂无消息",
                 duration=duration
             ))
         
@@ -593,9 +631,13 @@ async def get_conversations_paginated(
             total=total,
             page=page,
             size=size,
-            total_pages=total_pages
+            total_pages=total_pages,
+            next_cursor=next_cursor,
+            prev_cursor=prev_cursor
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -708,6 +750,101 @@ async def create_market_conversation(
             detail=f"创建市场对话失败：{str(e)}"
         )
 
+async def build_persona_turn(
+    message_data: MessageCreate,
+    current_user: User,
+    db: Session
+) -> Tuple[Conversation, Dict[str, Any]]:
+    """
+    验证对话并构建对话上下文，返回 (对话, 生成回复的参数)
+    构建上下文时折叠产生的摘要更新在这里提交，用户消息由调用方保存
+    """
+    # 验证对话是否存在
+    conversation = db.query(Conversation).filter(
+        Conversation.id == message_data.conversation_id,
+        Conversation.user_id == current_user.id
+    ).first()
+    
+    if not conversation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="对话不存在"
+        )
+    
+    # 按token预算构建对话历史（更早的内容折叠进滚动摘要）
+    conversation_history, history_summary = await conversation_context_builder.build(db, conversation)
+    db.commit()
+    
+    persona = conversation.digital_persona
+    scenario = conversation.scenario
+    
+    generation_args = {
+        "system_prompt": persona.system_prompt,
+        "conversation_history": conversation_history,
+        "scenario_context": scenario.context,
+        "user_message": message_data.content,
+        # 检查是否是市场对话（与其他用户的数字人格聊天）
+        "is_market_chat": persona.user_id != current_user.id,
+        "history_summary": history_summary
+    }
+    return conversation, generation_args
+
+def add_user_message(db: Session, conversation: Conversation, content: str) -> ConversationMessage:
+    """添加用户消息（序号接在已有消息之后）并更新对话摘要，由调用方提交"""
+    user_message = ConversationMessage(
+        conversation_id=conversation.id,
+        sender_type="user",
+        content=content,
+        message_index=conversation_context_builder.next_message_index(db, conversation),
+        created_at=datetime.utcnow()
+    )
+    
+    db.add(user_message)
+    conversation.record_message(user_message)
+    return user_message
+
+async def prepare_persona_turn(
+    message_data: MessageCreate,
+    current_user: User,
+    db: Session
+) -> Tuple[Conversation, int, Dict[str, Any]]:
+    """
+    验证对话、构建对话上下文并保存用户消息
+    返回 (对话, 用户消息序号, 生成回复的参数)
+    """
+    conversation, generation_args = await build_persona_turn(message_data, current_user, db)
+    user_message = add_user_message(db, conversation, message_data.content)
+    db.commit()
+    return conversation, user_message.message_index, generation_args
+
+def save_agent_reply(
+    db: Session,
+    conversation: Conversation,
+    message_index: int,
+    content: str,
+    metadata: Dict[str, Any]
+) -> ConversationMessage:
+    """保存AI回复并更新对话摘要"""
+    ai_message = ConversationMessage(
+        conversation_id=conversation.id,
+        sender_type="agent",
+        content=content,
+        message_index=message_index,
+        prompt_used=metadata.get("prompt_used"),
+        model_used=metadata.get("model_used"),
+        tokens_used=metadata.get("tokens_used"),
+        created_at=datetime.utcnow()
+    )
+    
+    db.add(ai_message)
+    
+    # 更新对话摘要和时间
+    conversation.record_message(ai_message)
+    
+    db.commit()
+    db.refresh(ai_message)
+    return ai_message
+
 @router.post("/messages", response_model=MessageResponse)
 async def send_message(
     message_data: MessageCreate,
@@ -716,76 +853,13 @@ async def send_message(
 ):
     """发送消息并获取AI回复"""
     try:
-        # 验证对话是否存在
-        conversation = db.query(Conversation).filter(
-            Conversation.id == message_data.conversation_id,
-            Conversation.user_id == current_user.id
-        ).first()
-        
-        if not conversation:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="对话不存在"
-            )
-        
-        # 获取对话历史
-        existing_messages = db.query(ConversationMessage).filter(
-            ConversationMessage.conversation_id == conversation.id
-        ).order_by(ConversationMessage.message_index).all()
-        
-        # 保存用户消息
-        user_message = ConversationMessage(
-            conversation_id=conversation.id,
-            sender_type="user",
-            content=message_data.content,
-            message_index=len(existing_messages)
-        )
-        
-        db.add(user_message)
-        db.commit()
-        
-        # 准备对话历史
-        conversation_history = [
-            {
-                "sender_type": msg.sender_type,
-                "content": msg.content
-            }
-            for msg in existing_messages
-        ]
+        conversation, message_index, generation_args = await prepare_persona_turn(message_data, current_user, db)
         
         # 生成AI回复
-        persona = conversation.digital_persona
-        scenario = conversation.scenario
-        
-        # 检查是否是市场对话（与其他用户的数字人格聊天）
-        is_market_chat = persona.user_id != current_user.id
-        
-        agent_response, metadata = await ai_service.generate_agent_response(
-            system_prompt=persona.system_prompt,
-            conversation_history=conversation_history,
-            scenario_context=scenario.context,
-            user_message=message_data.content,
-            is_market_chat=is_market_chat
-        )
+        agent_response, metadata = await ai_service.generate_agent_response(**generation_args)
         
         # 保存AI回复
-        ai_message = ConversationMessage(
-            conversation_id=conversation.id,
-            sender_type="agent",
-            content=agent_response,
-            message_index=len(existing_messages) + 1,
-            prompt_used=metadata.get("prompt_used"),
-            model_used=metadata.get("model_used"),
-            tokens_used=metadata.get("tokens_used")
-        )
-        
-        db.add(ai_message)
-        
-        # 更新对话时间
-        conversation.updated_at = datetime.utcnow()
-        
-        db.commit()
-        db.refresh(ai_message)
+        ai_message = save_agent_reply(db, conversation, message_index + 1, agent_response, metadata)
         
         return MessageResponse(
             id=str(ai_message.id),
@@ -803,6 +877,76 @@ async def send_message(
             detail=f"发送消息失败：{str(e)}"
         )
 
+def format_sse_event(event: str, data: Dict[str, Any]) -> str:
+    """格式化一条Server-Sent Events消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/messages/stream")
+async def send_message_stream(
+    message_data: MessageCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    发送消息并以SSE流式返回AI回复
+    
+    事件类型：
+    - delta: {"content": 文本片段}，模型每生成一段即推送
+    - done: 与 POST /messages 相同的 MessageResponse，回复已保存
+    - error: {"detail": 错误信息}，生成失败
+    
+    用户消息与回复在生成完成后一起保存：生成出错或客户端中途断开时两者都不保存，
+    对话中不会留下没有回复的用户消息，客户端可以直接重发
+    """
+    try:
+        conversation, generation_args = await build_persona_turn(message_data, current_user, db)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"发送消息失败：{str(e)}"
+        )
+    
+    conversation_id = conversation.id
+    
+    async def event_stream():
+        async for event in ai_service.stream_agent_response(**generation_args):
+            if event["type"] == "delta":
+                yield format_sse_event("delta", {"content": event["content"]})
+            elif event["type"] == "done":
+                # 流结束后在同一事务中保存用户消息和完整回复（使用独立会话，不依赖请求作用域的数据库会话）
+                stream_db = SessionLocal()
+                try:
+                    conversation = stream_db.query(Conversation).filter(Conversation.id == conversation_id).first()
+                    user_message = add_user_message(stream_db, conversation, message_data.content)
+                    stream_db.flush()
+                    ai_message = save_agent_reply(
+                        stream_db, conversation, user_message.message_index + 1, event["content"], event["metadata"]
+                    )
+                    reply = MessageResponse(
+                        id=str(ai_message.id),
+                        sender_type=ai_message.sender_type,
+                        content=ai_message.content,
+                        created_at=ai_message.created_at,
+                        message_index=ai_message.message_index
+                    )
+                except Exception as e:
+                    stream_db.rollback()
+                    yield format_sse_event("error", {"detail": f"保存回复失败：{str(e)}"})
+                    return
+                finally:
+                    stream_db.close()
+                yield format_sse_event("done", reply.model_dump(mode="json"))
+            else:
+                yield format_sse_event("error", {"detail": event["error"]})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/conversations/{conversation_id}/messages", response_model=List[MessageResponse])
 async def get_conversation_messages(
     conversation_id: str,
@@ -1190,7 +1334,7 @@ async def create_market_agent(
             market_type=market_agent.market_type,
             display_name=market_agent.display_name,
             display_description=market_agent.display_description,
-            tags=json.loads(market_agent.tags or "[]"),
+            tags=market_agent.tag_list,
             last_interaction=market_agent.last_interaction,
             created_at=market_agent.created_at
         )
@@ -1205,17 +1349,59 @@ async def create_market_agent(
 
 @router.get("/market-agents", response_model=List[MarketAgentResponse])
 async def get_market_agents(
+    response: Response,
     market_type: Optional[str] = None,
+    q: Optional[str] = Query(None, max_length=100, description="检索词，匹配显示名称和描述"),
+    tags: Optional[List[str]] = Query(None, description="标签筛选，可传多个，需同时具有"),
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取情感匹配市场中的数字人格列表"""
+    """
+    获取情感匹配市场中的数字人格列表
+    无检索词时按最近活跃排序，有检索词时按相关度排序；下一页游标通过 X-Next-Cursor 响应头返回
+    """
     try:
-        agents = match_service.get_market_agents(
+        after = None
+        if cursor:
+            position = decode_cursor(cursor, "id")
+            try:
+                # 游标键直接进入SQL比较，类型不对时按无效游标处理
+                if position["d"] != NEXT or not isinstance(position["id"], str):
+                    raise ValueError("invalid cursor")
+                if "rank" in position:
+                    rank = position["rank"]
+                    if isinstance(rank, bool) or not isinstance(rank, (int, float)) or not math.isfinite(rank):
+                        raise ValueError("invalid rank")
+                    after = (float(rank), position["id"])
+                else:
+                    after = (datetime.fromisoformat(position["last"]), position["id"])
+            except (KeyError, TypeError, ValueError):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="无效的分页游标"
+                )
+        
+        # 多取一条判断是否还有下一页
+        results = match_service.get_market_agents(
             db=db,
             market_type=market_type,
-            exclude_user_id=current_user.id  # 排除自己的数字人格
-        )
+            exclude_user_id=current_user.id,  # 排除自己的数字人格
+            limit=limit + 1,
+            query=q,
+            tags=tags,
+            after=after
+        )
+        
+        if len(results) > limit:
+            results = results[:limit]
+            last, rank = results[-1]
+            if rank is not None:
+                response.headers["X-Next-Cursor"] = encode_cursor(NEXT, rank=rank, id=last.id)
+            else:
+                response.headers["X-Next-Cursor"] = encode_cursor(NEXT, last=last.last_interaction.isoformat(), id=last.id)
+        agents = [agent for agent, _ in results]
         
         return [
             MarketAgentResponse(
@@ -1225,13 +1411,15 @@ async def get_market_agents(
                 market_type=agent.market_type,
                 display_name=agent.display_name,
                 display_description=agent.display_description,
-                tags=json.loads(agent.tags or "[]"),
+                tags=agent.tag_list,
                 last_interaction=agent.last_interaction,
                 created_at=agent.created_at
             )
             for agent in agents
         ]
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1258,7 +1446,7 @@ async def get_my_market_agents(
                 market_type=agent.market_type,
                 display_name=agent.display_name,
                 display_description=agent.display_description,
-                tags=json.loads(agent.tags or "[]"),
+                tags=agent.tag_list,
                 last_interaction=agent.last_interaction,
                 created_at=agent.created_at
             )
@@ -1285,6 +1473,9 @@ async def create_match_relation(
             target_agent_id=match_data.target_agent_id,
             match_type=match_data.match_type
         )
+        scheduler_service.notify_schedule_changed(
+            match_relation.id, match_relation.next_scheduled_conversation
+        )
         
         # 获取目标agent信息用于响应
         target_agent = db.query(MarketAgent).filter(MarketAgent.id == match_data.target_agent_id).first()
@@ -1296,7 +1487,7 @@ async def create_match_relation(
                 "digital_persona_id": str(target_agent.digital_persona_id),
                 "display_name": target_agent.display_name,
                 "display_description": target_agent.display_description,
-                "tags": json.loads(target_agent.tags or "[]")
+                "tags": target_agent.tag_list
             },
             target_user_id=str(match_relation.target_user_id),
             match_type=match_relation.match_type,
@@ -1320,18 +1511,43 @@ async def create_match_relation(
 
 @router.get("/match-relations", response_model=List[MatchRelationResponse])
 async def get_match_relations(
+    response: Response,
     match_type: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=200, description="每页数量，不传则返回全部"),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取用户的匹配关系列表"""
+    """
+    获取用户的匹配关系列表，按匹配度从高到低排序
+    传入 limit 时分页返回前K条，下一页游标通过 X-Next-Cursor 响应头返回
+    """
     try:
+        after = None
+        if cursor:
+            position = decode_cursor(cursor, "score", "id")
+            if position["d"] != NEXT:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="无效的分页游标"
+                )
+            after = (position["score"], position["id"])
+            limit = limit or 50
+        
+        # 多取一条判断是否还有下一页
         matches = match_service.get_user_matches(
             db=db,
             user_id=current_user.id,
-            match_type=match_type
+            match_type=match_type,
+            limit=limit + 1 if limit else None,
+            after=after
         )
         
+        if limit and len(matches) > limit:
+            matches = matches[:limit]
+            last = matches[-1]
+            response.headers["X-Next-Cursor"] = encode_cursor(NEXT, score=last.max_compatibility_score, id=last.id)
+        
         result = []
         for match in matches:
             # 现在只返回用户作为发起者的匹配，所以target_agent就是目标agent
@@ -1345,7 +1561,7 @@ async def get_match_relations(
                     "digital_persona_id": str(target_agent.digital_persona_id),
                     "display_name": target_agent.display_name,
                     "display_description": target_agent.display_description,
-                    "tags": json.loads(target_agent.tags or "[]")
+                    "tags": target_agent.tag_list
                 },
                 target_user_id=str(target_user_id),
                 match_type=match.match_type,
@@ -1358,6 +1574,8 @@ async def get_match_relations(
         
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1372,8 +1590,7 @@ async def get_followers(
 ):
     """获取关注你的用户列表（别人匹配了你但你没有匹配他们）"""
     try:
-        from models.database import RealTimeMessage
-        
+        # 关注关系、发起者agent与是否已有聊天消息在一次查询中取得
         followers = match_service.get_followers(
             db=db,
             user_id=current_user.id,
@@ -1381,16 +1598,10 @@ async def get_followers(
         )
         
         result = []
-        for relation in followers:
+        for relation, has_realtime_messages in followers:
             # 获取发起者的agent信息
             initiator_agent = relation.initiator_agent
             
-            # 检查是否有实时聊天消息
-            has_realtime_messages = db.query(RealTimeMessage).filter(
-                RealTimeMessage.match_relation_id == relation.id,
-                RealTimeMessage.is_deleted == False
-            ).first() is not None
-            
             # 构建响应，这里target_agent实际是initiator_agent（关注者的agent）
             result.append(MatchRelationResponse(
                 id=str(relation.id),
@@ -1399,7 +1610,7 @@ async def get_followers(
                     "digital_persona_id": str(initiator_agent.digital_persona_id),
                     "display_name": initiator_agent.display_name,
                     "display_description": initiator_agent.display_description,
-                    "tags": json.loads(initiator_agent.tags or "[]")
+                    "tags": initiator_agent.tag_list
                 },
                 target_user_id=str(relation.initiator_user_id),
                 match_type=relation.match_type,
@@ -1434,6 +1645,7 @@ async def cancel_match_relation(
         )
         
         if success:
+            scheduler_service.notify_schedule_changed(match_id, None)
             return {"message": "匹配关系已取消", "match_id": match_id}
         else:
             raise HTTPException(
@@ -1483,21 +1695,12 @@ async def trigger_conversation(
         
         scenario = random.choice(scenarios)
         
-        # 创建后台任务
+        # 创建后台任务（由任务worker异步执行）
         task_id = task_service.create_task(
             task_type="conversation",
             match_relation_id=match_id,
-            scenario_id=str(scenario.id)
-        )
-        
-        # 异步执行对话任务
-        asyncio.create_task(
-            task_service.execute_conversation_task(
-                task_id=task_id,
-                match_relation_id=match_id,
-                scenario_id=str(scenario.id),
-                max_turns=random.randint(6, 12)
-            )
+            scenario_id=str(scenario.id),
+            max_turns=random.randint(6, 12)
         )
         
         return {
@@ -1616,12 +1819,14 @@ async def get_match_conversations(
 @router.get("/match-relations/{match_id}/realtime-messages", response_model=List[RealTimeMessageResponse])
 async def get_realtime_messages(
     match_id: str,
+    response: Response,
     limit: int = 50,
-    offset: int = 0,
+    offset: int = Query(0, deprecated=True, description="偏移量（已废弃，请使用cursor）"),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取实时聊天消息历史"""
+    """获取实时聊天消息历史（游标通过 X-Next-Cursor / X-Prev-Cursor 响应头返回）"""
     try:
         # 验证匹配关系存在且用户有权限
         match_relation = db.query(MatchRelation).filter(
@@ -1636,20 +1841,30 @@ async def get_realtime_messages(
                 detail="匹配关系不存在或无权限"
             )
         
+        # 实时消息属于两个用户之间的聊天会话
+        user1_id, user2_id = ChatSession.get_ordered_user_ids(
+            match_relation.initiator_user_id, match_relation.target_user_id
+        )
+        chat_session = db.query(ChatSession).filter(
+            ChatSession.user1_id == user1_id,
+            ChatSession.user2_id == user2_id
+        ).first()
+        if not chat_session:
+            return []
+        
         # 获取实时聊天消息
-        messages = db.query(RealTimeMessage).filter(
-            RealTimeMessage.match_relation_id == match_id,
-            RealTimeMessage.is_deleted == False
-        ).order_by(RealTimeMessage.sequence_number.desc()).offset(offset).limit(limit).all()
+        messages = paginate_chat_messages(db, chat_session.id, limit, offset, cursor, response)
+        
+        # 一次性解析本页所有发送者的名称
+        sender_names = display_name_cache.get_display_names(db, (msg.sender_user_id for msg in messages))
         
         # 构建响应
         result = []
-        for msg in reversed(messages):  # 反转以获得正确的时间顺序
-            sender_user = db.query(User).filter(User.id == msg.sender_user_id).first()
+        for msg in messages:
             result.append(RealTimeMessageResponse(
                 id=str(msg.id),
                 sender_user_id=str(msg.sender_user_id),
-                sender_name=sender_user.username if sender_user else "未知用户",
+                sender_name=sender_names.get(msg.sender_user_id, "未知用户"),
                 content=msg.content,
                 message_type=msg.message_type,
                 sequence_number=msg.sequence_number,
@@ -1667,6 +1882,66 @@ async def get_realtime_messages(
             detail=f"获取实时聊天消息失败：{str(e)}"
         )
 
+def paginate_chat_messages(
+    db: Session,
+    session_id: str,
+    limit: int,
+    offset: int,
+    cursor: Optional[str],
+    response: Response
+) -> List[RealTimeMessage]:
+    """
+    按消息序号做游标分页，返回按序号正序的消息，并在响应头中写入游标
+    X-Next-Cursor 指向更早的消息，X-Prev-Cursor 指向更新的消息（可用于轮询新消息）
+    """
+    before_sequence = after_sequence = None
+    if cursor:
+        position = decode_cursor(cursor, "seq")
+        if position["d"] == NEXT:
+            before_sequence = position["seq"]
+        else:
+            after_sequence = position["seq"]
+    
+    # 多取一条判断是否还有更多
+    messages = chat_service.get_messages(
+        db=db,
+        session_id=session_id,
+        limit=limit + 1,
+        offset=0 if cursor else offset,
+        before_sequence=before_sequence,
+        after_sequence=after_sequence
+    )
+    
+    has_more = len(messages) > limit
+    if after_sequence is not None:
+        messages = stop_at_pending_gap(messages[:limit], after_sequence)
+    else:
+        messages = messages[-limit:] if limit else []
+    
+    if messages:
+        if has_more or after_sequence is not None:
+            response.headers["X-Next-Cursor"] = encode_cursor(NEXT, seq=messages[0].sequence_number)
+        response.headers["X-Prev-Cursor"] = encode_cursor(PREV, seq=messages[-1].sequence_number)
+    elif cursor and after_sequence is not None:
+        # 暂无新消息，沿用原游标继续轮询
+        response.headers["X-Prev-Cursor"] = cursor
+    
+    return messages
+
+def stop_at_pending_gap(messages: List[RealTimeMessage], after_sequence: int) -> List[RealTimeMessage]:
+    """
+    截断到最近出现的序号空洞之前
+    空洞对应的消息可能已分配序号但还在写缓冲中，越过它推进游标会漏读该消息；
+    空洞之后的消息超过 SEQUENCE_GAP_GRACE 仍未补齐时视为消息已删除或丢失
+    """
+    fresh_after = datetime.utcnow() - SEQUENCE_GAP_GRACE
+    expected = after_sequence + 1
+    for index, message in enumerate(messages):
+        if message.sequence_number != expected and message.created_at > fresh_after:
+            return messages[:index]
+        expected = message.sequence_number + 1
+    return messages
+
 # 新的基于ChatSession的聊天API
 
 class ChatSessionResponse(BaseModel):
@@ -1775,12 +2050,14 @@ async def create_or_get_chat_session(
 @router.get("/chat-sessions/{session_id}/messages", response_model=List[ChatMessageResponse])
 async def get_chat_messages(
     session_id: str,
+    response: Response,
     limit: int = 50,
-    offset: int = 0,
+    offset: int = Query(0, deprecated=True, description="偏移量（已废弃，请使用cursor）"),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取聊天会话的消息列表"""
+    """获取聊天会话的消息列表（游标通过 X-Next-Cursor / X-Prev-Cursor 响应头返回）"""
     try:
         # 验证用户是否有权限访问此会话
         session = chat_service.get_chat_session_by_id(db, session_id)
@@ -1790,20 +2067,17 @@ async def get_chat_messages(
                 detail="无权限访问此聊天会话"
             )
         
-        messages = chat_service.get_messages(
-            db=db,
-            session_id=session_id,
-            limit=limit,
-            offset=offset
-        )
+        messages = paginate_chat_messages(db, session_id, limit, offset, cursor, response)
+        
+        # 一次性解析本页所有发送者的名称
+        sender_names = display_name_cache.get_display_names(db, (msg.sender_user_id for msg in messages))
         
         result = []
         for msg in messages:
-            sender_user = db.query(User).filter(User.id == msg.sender_user_id).first()
             result.append(ChatMessageResponse(
                 id=str(msg.id),
                 sender_user_id=str(msg.sender_user_id),
-                sender_name=sender_user.username if sender_user else "未知用户",
+                sender_name=sender_names.get(msg.sender_user_id, "未知用户"),
                 content=msg.content,
                 message_type=msg.message_type,
                 sequence_number=msg.sequence_number,
@@ -1838,29 +2112,24 @@ async def send_chat_message(
                 detail="无权限访问此聊天会话"
             )
         
-        message = chat_service.send_message(
-            db=db,
+        # 与WebSocket共用消息写缓冲，保证同一会话的序号顺序一致；等待写入后再返回
+        message = await message_buffer.add_message(
             session_id=session_id,
             sender_user_id=current_user.id,
             content=message_data.content,
-            message_type=message_data.message_type
+            message_type=message_data.message_type,
+            wait_for_flush=True
         )
         
-        if not message:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="发送消息失败"
-            )
-        
         return ChatMessageResponse(
-            id=str(message.id),
-            sender_user_id=str(message.sender_user_id),
+            id=message["id"],
+            sender_user_id=str(message["sender_user_id"]),
             sender_name=current_user.username,
-            content=message.content,
-            message_type=message.message_type,
-            sequence_number=message.sequence_number,
-            is_read=message.is_read,
-            created_at=message.created_at
+            content=message["content"],
+            message_type=message["message_type"],
+            sequence_number=message["sequence_number"],
+            is_read=message["is_read"],
+            created_at=message["created_at"]
         )
         
     except HTTPException:
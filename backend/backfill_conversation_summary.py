@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+回填对话摘要字段（message_count / last_message_preview / last_message_at）
+
+对话摘要在发送消息时同步维护，本脚本用于一次性补齐已有对话的数据，可重复执行。
+升级时迁移 0003 会自动执行回填，一般无需手动运行。
+用法: python backfill_conversation_summary.py [--batch-size 500]
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from typing import Optional
+
+from sqlalchemy import func, and_
+from sqlalchemy.orm import Session
+
+from models.database import SessionLocal, Conversation, ConversationMessage
+
+def backfill_conversation_summary(batch_size: int = 500, db: Optional[Session] = None) -> int:
+    """按批回填对话摘要，返回处理的对话数；传入 db 时使用调用方的会话（不关闭）"""
+    owns_session = db is None
+    if owns_session:
+        db = SessionLocal()
+    processed = 0
+    last_id = ""
+    try:
+        while True:
+            conversation_ids = [
+                row.id for row in db.query(Conversation.id).filter(
+                    Conversation.id > last_id
+                ).order_by(Conversation.id).limit(batch_size)
+            ]
+            if not conversation_ids:
+                break
+            last_id = conversation_ids[-1]
+
+            # 本批对话的消息数与最后一条消息的序号
+            stats = db.query(
+                ConversationMessage.conversation_id,
+                func.count(ConversationMessage.id).label("message_count"),
+                func.max(ConversationMessage.message_index).label("last_index")
+            ).filter(
+                ConversationMessage.conversation_id.in_(conversation_ids)
+            ).group_by(ConversationMessage.conversation_id).subquery()
+
+            rows = db.query(
+                stats.c.conversation_id,
+                stats.c.message_count,
+                ConversationMessage.content,
+                ConversationMessage.created_at
+            ).join(
+                ConversationMessage,
+                and_(
+                    ConversationMessage.conversation_id == stats.c.conversation_id,
+                    ConversationMessage.message_index == stats.c.last_index
+                )
+            ).all()
+
+            summaries = {
+                conversation_id: (message_count, content, created_at)
+                for conversation_id, message_count, content, created_at in rows
+            }
+
+            for conversation_id in conversation_ids:
+                message_count, content, created_at = summaries.get(conversation_id, (0, None, None))
+                db.query(Conversation).filter(Conversation.id == conversation_id).update({
+                    "message_count": message_count,
+                    "last_message_preview": Conversation.make_message_preview(content) if content else None,
+                    "last_message_at": created_at
+                }, synchronize_session=False)
+
+            db.commit()
+            processed += len(conversation_ids)
+            print(f"📝 已回填 {processed} 个对话")
+
+        return processed
+
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="回填对话摘要字段")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批处理的对话数")
+    args = parser.parse_args()
+
+    print("🚀 开始回填对话摘要...")
+    try:
+        total = backfill_conversation_summary(args.batch_size)
+        print(f"🎉 回填完成，共处理 {total} 个对话")
+    except Exception as e:
+        print(f"❌ 回填失败: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from models.database import init_database, engine, SessionLocal
+from models.database import engine, SessionLocal
+from migrations import upgrade
 from services.ai_service import scenario_service
 from models.database import Scenario
 
@@ -48,9 +49,9 @@ def main():
     print("=" * 50)
     
     try:
-        # 1. 创建数据库表
-        print("📊 创建数据库表...")
-        init_database()
+        # 1. 创建/升级数据库表（执行未执行的迁移）
+        print("📊 执行数据库迁移...")
+        upgrade()
         
         # 2. 初始化场景数据
         print("📝 初始化场景数据...")
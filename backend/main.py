@@ -1,14 +1,21 @@
 from fastapi import FastAPI, WebSocket, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from api.routes import router
-from models.database import create_tables, get_db
+from models.database import DATABASE_URL, get_db
 from sqlalchemy.orm import Session
 import os
 from dotenv import load_dotenv
 import asyncio
+import logging
 
 load_dotenv()
 
+# 配置日志输出（服务中用 logging 记录的运行信息，如对话结束判断的影子决策，需要根日志器有输出才会被记录）
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+
 # 创建FastAPI应用
 app = FastAPI(
     title="SoulLink API",
@@ -27,6 +34,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Prev-Cursor"],
 )
 
 # 注册路由
@@ -67,35 +75,40 @@ def check_environment():
     print("=" * 50)
 
 def init_database_if_needed():
-    """如果需要则初始化数据库"""
+    """
+    检查数据库结构版本
+    启动时只读取版本号；结构落后时按 DB_AUTO_MIGRATE 自动迁移或提示手动执行 `python migrate.py upgrade`
+    """
     try:
-        # 检查是否是SQLite且文件不存在
-        db_url = os.getenv("DATABASE_URL")
-        if not db_url or db_url.startswith("sqlite"):
-            db_file = "soullink.db"
-            if not os.path.exists(db_file):
-                print("🚀 首次运行，正在初始化数据库...")
-                
-                # 导入初始化模块
-                from init_db import init_default_scenarios
-                
-                # 创建表格
-                create_tables()
-                
-                # 初始化默认数据
-                init_default_scenarios()
-                
-                print("✅ 数据库初始化完成！")
-            else:
-                print("📊 数据库已存在，跳过初始化")
-        else:
-            # PostgreSQL或其他数据库，只创建表格
-            create_tables()
-            print("📊 数据库表检查完成")
+        from migrations import HEAD_VERSION, get_current_version, upgrade
+        
+        current = get_current_version()
+        if current == HEAD_VERSION:
+            print(f"📊 数据库结构已是最新版本 v{current}")
+            return
+        if current is not None and current > HEAD_VERSION:
+            print(f"⚠️ 数据库结构版本 v{current} 高于当前代码支持的 v{HEAD_VERSION}，请确认部署版本")
+            return
+        
+        # SQLite（单机开发）默认自动迁移，其他数据库默认需手动执行
+        default_auto = "true" if DATABASE_URL.startswith("sqlite") else "false"
+        if os.getenv("DB_AUTO_MIGRATE", default_auto).lower() != "true":
+            print(f"⚠️ 数据库结构版本 v{current or 0} 落后于 v{HEAD_VERSION}，请运行: python migrate.py upgrade")
+            return
+        
+        print(f"🚀 数据库结构版本 v{current or 0}，正在迁移到 v{HEAD_VERSION}...")
+        upgrade()
+        
+        if current is None:
+            # 首次运行，初始化默认数据
+            from init_db import init_default_scenarios
+            init_default_scenarios()
+        
+        print("✅ 数据库迁移完成！")
             
     except Exception as e:
         print(f"❌ 数据库初始化失败: {e}")
-        print("💡 请尝试手动运行: python init_db.py")
+        print("💡 请尝试手动运行: python migrate.py upgrade")
 
 @app.on_event("startup")
 async def startup_event():
@@ -118,15 +131,26 @@ async def startup_event():
     
     # 启动定时任务调度服务
     await scheduler_service.start()
+
+    # 启动内嵌的后台任务worker（独立部署worker时可设置 TASK_WORKER_EMBEDDED=false）
+    if os.getenv("TASK_WORKER_EMBEDDED", "true").lower() == "true":
+        from services.task_service import task_service
+        await task_service.start_worker()
     
-    # 启动WebSocket清理任务
-    from services.websocket_service import cleanup_typing_status
+    # 启动聊天消息写缓冲
+    from services.message_buffer import message_buffer
+    await message_buffer.start()
+
+    # 启动WebSocket广播背板和清理任务
+    from services.websocket_service import manager, cleanup_typing_status
+    await manager.start_backplane()
     asyncio.create_task(cleanup_typing_status())
     print("💬 WebSocket服务初始化完成")
 
     print("🚀 SoulLink API 启动完成！")
     print("📚 API文档: http://localhost:8000/docs")
     print("🔧 健康检查: http://localhost:8000/health")
+    print("📈 运行指标: http://localhost:8000/metrics")
     print("💬 WebSocket聊天: ws://localhost:8000/ws/chat/{other_user_id}?userId={user_id}")
 
 @app.on_event("shutdown")
@@ -137,7 +161,23 @@ async def shutdown_event():
     # 停止定时任务调度服务
     from services.scheduler_service import scheduler_service
     await scheduler_service.stop()
-    
+
+    # 停止后台任务worker
+    from services.task_service import task_service
+    await task_service.stop_worker()
+
+    # 停止WebSocket广播背板
+    from services.websocket_service import manager
+    await manager.stop_backplane()
+
+    # 写入缓冲中剩余的聊天消息
+    from services.message_buffer import message_buffer
+    await message_buffer.stop()
+
+    # 关闭AI服务的共享HTTP连接池
+    from services.ai_service import ai_service
+    await ai_service.cleanup()
+
     print("👋 SoulLink API 已安全关闭")
 
 @app.get("/")
@@ -153,12 +193,12 @@ async def root():
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    # 检查数据库连接
+    # 检查数据库连接（从连接池借出一个连接执行探测语句）
     try:
-        from models.database import SessionLocal
-        db = SessionLocal()
-        db.execute("SELECT 1")
-        db.close()
+        from sqlalchemy import text
+        from models.database import engine
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
         db_status = "healthy"
     except Exception as e:
         db_status = f"error: {str(e)}"
@@ -174,6 +214,19 @@ async def health_check():
         "version": "1.0.0"
     }
 
+@app.get("/metrics")
+async def metrics():
+    """运行指标：数据库连接池、LLM网关与响应缓存"""
+    from models.database import get_pool_status
+    from services.ai_service import ai_service
+    from services.llm_gateway import llm_gateway
+    
+    return {
+        "database_pool": get_pool_status(),
+        "llm_gateway": llm_gateway.get_stats(),
+        "llm_cache": ai_service.response_cache.get_stats()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+数据库迁移命令
+
+用法:
+    python migrate.py upgrade [--to 版本号]   执行未执行的迁移（默认到最新版本）
+    python migrate.py current                 查看当前数据库结构版本
+    python migrate.py history                 列出所有迁移及执行状态
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from migrations import HEAD_VERSION, get_current_version, upgrade
+from migrations.versions import MIGRATIONS
+
+def cmd_upgrade(args):
+    current = get_current_version() or 0
+    print(f"🚀 当前版本 v{current}，目标版本 v{args.to or HEAD_VERSION}")
+    count = upgrade(target=args.to)
+    if count:
+        print(f"🎉 已执行 {count} 个迁移，当前版本 v{get_current_version()}")
+    else:
+        print("📊 数据库结构已是最新，无需迁移")
+
+def cmd_current(args):
+    current = get_current_version()
+    if current is None:
+        print(f"📊 数据库尚未执行过迁移（最新版本 v{HEAD_VERSION}）")
+    else:
+        print(f"📊 当前版本 v{current}（最新版本 v{HEAD_VERSION}）")
+
+def cmd_history(args):
+    current = get_current_version() or 0
+    for migration in MIGRATIONS:
+        mark = "✅" if migration.version <= current else "⏳"
+        print(f"{mark} {migration.version:04d}_{migration.name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="SoulLink 数据库迁移")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    upgrade_parser = subparsers.add_parser("upgrade", help="执行未执行的迁移")
+    upgrade_parser.add_argument("--to", type=int, default=None, help="迁移到指定版本")
+    upgrade_parser.set_defaults(func=cmd_upgrade)
+
+    subparsers.add_parser("current", help="查看当前版本").set_defaults(func=cmd_current)
+    subparsers.add_parser("history", help="列出所有迁移").set_defaults(func=cmd_history)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except Exception as e:
+        print(f"❌ 迁移失败: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
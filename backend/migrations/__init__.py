@@ -0,0 +1,22 @@
+"""
+数据库结构的版本化迁移
+
+新增迁移：在 migrations/versions/ 下添加 vNNNN_说明.py（定义 version、name、transactional 和 upgrade(ctx)），
+并追加到 versions/__init__.py 的 MIGRATIONS 列表末尾。
+"""
+
+from migrations.runner import (
+    HEAD_VERSION,
+    MigrationContext,
+    get_current_version,
+    pending_migrations,
+    upgrade,
+)
+
+__all__ = [
+    'HEAD_VERSION',
+    'MigrationContext',
+    'get_current_version',
+    'pending_migrations',
+    'upgrade'
+]
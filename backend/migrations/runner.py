@@ -0,0 +1,125 @@
+"""
+迁移执行器
+
+已执行的迁移记录在 schema_migrations 表中（每个版本一行）。
+启动时只读取当前版本号，不做表结构探测；结构变更统一通过 `python migrate.py upgrade` 执行。
+"""
+
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models.database import engine as default_engine
+from migrations.versions import MIGRATIONS
+
+VERSION_TABLE = "schema_migrations"
+HEAD_VERSION = MIGRATIONS[-1].version
+
+class MigrationContext:
+    """迁移中可用的操作，保证重复执行也不会出错"""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+
+    def execute(self, sql: str, **params):
+        return self.connection.execute(text(sql), params)
+
+    def has_table(self, table: str) -> bool:
+        return self.connection.dialect.has_table(self.connection, table)
+
+    def has_column(self, table: str, column: str) -> bool:
+        columns = self.connection.dialect.get_columns(self.connection, table)
+        return any(c["name"] == column for c in columns)
+
+    def add_column(self, table: str, column: str, ddl_type: str, server_default: Optional[str] = None, nullable: bool = True):
+        """添加列（已存在则跳过）；NOT NULL 列必须提供默认值，已有行会直接取得默认值"""
+        if self.has_column(table, column):
+            return
+        ddl = f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"
+        if server_default is not None:
+            ddl += f" DEFAULT {server_default}"
+        if not nullable:
+            ddl += " NOT NULL"
+        self.execute(ddl)
+        print(f"  ➕ {table}.{column}")
+
+    def create_index(self, name: str, table: str, columns: Sequence[str], using: Optional[str] = None):
+        """
+        创建索引（已存在则跳过），columns 也可以是表达式；using 指定索引类型（如 PostgreSQL 的 gin）
+        PostgreSQL 上使用 CREATE INDEX CONCURRENTLY，建索引期间不阻塞写入，
+        所在迁移需声明 transactional = False。CONCURRENTLY 中途失败会留下 INVALID 的索引，
+        IF NOT EXISTS 会把它当作已存在，因此先检查 pg_index.indisvalid，无效的索引删除后重建
+        """
+        if self.dialect == "postgresql" and self.is_index_valid(name) is False:
+            print(f"  ⚠️ 索引 {name} 无效（上次创建未完成），删除后重建")
+            self.drop_index(name)
+
+        concurrently = " CONCURRENTLY" if self.dialect == "postgresql" else ""
+        method = f" USING {using}" if using else ""
+        self.execute(f"CREATE INDEX{concurrently} IF NOT EXISTS {name} ON {table}{method} ({', '.join(columns)})")
+        print(f"  🗂️ {name}")
+
+    def is_index_valid(self, name: str) -> Optional[bool]:
+        """PostgreSQL 上索引是否可用（pg_index.indisvalid），索引不存在时返回None"""
+        return self.execute(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND pg_table_is_visible(c.oid)",
+            name=name
+        ).scalar()
+
+    def drop_index(self, name: str):
+        """删除索引（不存在则跳过），PostgreSQL 上同样以 CONCURRENTLY 执行"""
+        concurrently = " CONCURRENTLY" if self.dialect == "postgresql" else ""
+        self.execute(f"DROP INDEX{concurrently} IF EXISTS {name}")
+        print(f"  ➖ {name}")
+
+def _ensure_version_table(bind: Engine):
+    with bind.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+            "version INTEGER PRIMARY KEY, "
+            "name VARCHAR(200) NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL)"
+        ))
+
+def get_current_version(bind: Engine = default_engine) -> Optional[int]:
+    """当前数据库结构版本；尚未执行过任何迁移时返回None"""
+    try:
+        with bind.connect() as connection:
+            return connection.execute(text(f"SELECT MAX(version) FROM {VERSION_TABLE}")).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        return None
+
+def pending_migrations(bind: Engine = default_engine, target: Optional[int] = None) -> List:
+    current = get_current_version(bind) or 0
+    target = HEAD_VERSION if target is None else target
+    return [m for m in MIGRATIONS if current < m.version <= target]
+
+def upgrade(bind: Engine = default_engine, target: Optional[int] = None) -> int:
+    """依次执行未执行的迁移，返回执行的迁移数"""
+    _ensure_version_table(bind)
+    migrations = pending_migrations(bind, target)
+
+    for migration in migrations:
+        print(f"🔄 执行迁移 {migration.version:04d}_{migration.name}")
+        if migration.transactional:
+            with bind.begin() as connection:
+                migration.upgrade(MigrationContext(connection))
+                _record(connection, migration)
+        else:
+            # 不能放在事务中的操作（如 CREATE INDEX CONCURRENTLY），每条语句单独提交
+            with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                migration.upgrade(MigrationContext(connection))
+                _record(connection, migration)
+
+    return len(migrations)
+
+def _record(connection: Connection, migration):
+    connection.execute(
+        text(f"INSERT INTO {VERSION_TABLE} (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+        {"version": migration.version, "name": migration.name, "applied_at": datetime.utcnow()}
+    )
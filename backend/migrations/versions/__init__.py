@@ -0,0 +1,27 @@
+"""
+迁移列表，按版本号顺序排列
+"""
+
+from migrations.versions import (
+    v0001_initial_schema,
+    v0002_schedule_lease_and_sequence_counter,
+    v0003_conversation_summary,
+    v0004_query_indexes,
+    v0005_match_compatibility_leaderboard,
+    v0006_market_search,
+    v0007_task_jobs,
+    v0008_market_search_coalesce,
+    v0009_market_search_fts_keys,
+)
+
+MIGRATIONS = [
+    v0001_initial_schema,
+    v0002_schedule_lease_and_sequence_counter,
+    v0003_conversation_summary,
+    v0004_query_indexes,
+    v0005_match_compatibility_leaderboard,
+    v0006_market_search,
+    v0007_task_jobs,
+    v0008_market_search_coalesce,
+    v0009_market_search_fts_keys,
+]
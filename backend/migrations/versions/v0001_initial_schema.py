@@ -0,0 +1,223 @@
+"""
+初始结构：创建尚不存在的表
+
+表结构固定为引入迁移之前的版本，不引用 models.database 中的模型：模型之后新增的列、索引和表
+由后续迁移添加，新数据库与已有数据库经过同样的迁移步骤得到同样的结构。
+已有数据库（引入迁移之前用 create_all 创建的）只补建缺失的表。
+修改模型时不要改动这里，请新增迁移。
+"""
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String, Table, Text, UniqueConstraint
+)
+
+version = 1
+name = "initial_schema"
+transactional = True
+
+metadata = MetaData()
+
+Table(
+    "users", metadata,
+    Column("id", String, primary_key=True),
+    Column("username", String(50), unique=True, index=True, nullable=False),
+    Column("email", String(100), unique=True, index=True, nullable=False),
+    Column("hashed_password", String(100), nullable=False),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("is_active", Boolean),
+)
+
+Table(
+    "digital_personas", metadata,
+    Column("id", String, primary_key=True),
+    Column("user_id", String, ForeignKey("users.id"), nullable=False),
+    Column("name", String(100), nullable=False),
+    Column("description", Text),
+    Column("system_prompt", Text, nullable=False),
+    Column("initial_prompt", Text, nullable=False),
+    Column("optimization_count", Integer),
+    Column("personality_score", Float),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("is_active", Boolean),
+)
+
+Table(
+    "scenarios", metadata,
+    Column("id", String, primary_key=True),
+    Column("name", String(100), nullable=False),
+    Column("description", Text, nullable=False),
+    Column("context", Text, nullable=False),
+    Column("category", String(50), nullable=False),
+    Column("difficulty_level", String(20)),
+    Column("created_at", DateTime),
+    Column("is_active", Boolean),
+)
+
+Table(
+    "conversations", metadata,
+    Column("id", String, primary_key=True),
+    Column("user_id", String, ForeignKey("users.id"), nullable=False),
+    Column("digital_persona_id", String, ForeignKey("digital_personas.id"), nullable=False),
+    Column("scenario_id", String, ForeignKey("scenarios.id"), nullable=False),
+    Column("title", String(200)),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("is_active", Boolean),
+)
+
+Table(
+    "conversation_messages", metadata,
+    Column("id", String, primary_key=True),
+    Column("conversation_id", String, ForeignKey("conversations.id"), nullable=False),
+    Column("sender_type", String(20), nullable=False),
+    Column("content", Text, nullable=False),
+    Column("message_index", Integer, nullable=False),
+    Column("created_at", DateTime),
+    Column("prompt_used", Text),
+    Column("model_used", String(50)),
+    Column("tokens_used", Integer),
+)
+
+Table(
+    "message_feedbacks", metadata,
+    Column("id", String, primary_key=True),
+    Column("conversation_id", String, ForeignKey("conversations.id"), nullable=False),
+    Column("message_id", String, ForeignKey("conversation_messages.id"), nullable=False),
+    Column("feedback_type", String(20), nullable=False),
+    Column("feedback_content", Text),
+    Column("created_at", DateTime),
+)
+
+Table(
+    "prompt_optimizations", metadata,
+    Column("id", String, primary_key=True),
+    Column("digital_persona_id", String, ForeignKey("digital_personas.id"), nullable=False),
+    Column("old_prompt", Text, nullable=False),
+    Column("new_prompt", Text, nullable=False),
+    Column("optimization_reason", Text, nullable=False),
+    Column("feedback_data", Text),
+    Column("improvement_score", Float),
+    Column("created_at", DateTime),
+)
+
+Table(
+    "market_agents", metadata,
+    Column("id", String, primary_key=True),
+    Column("user_id", String, ForeignKey("users.id"), nullable=False),
+    Column("digital_persona_id", String, ForeignKey("digital_personas.id"), nullable=False),
+    Column("market_type", String(20), nullable=False),
+    Column("display_name", String(100), nullable=False),
+    Column("display_description", Text, nullable=False),
+    Column("tags", Text),
+    Column("is_active", Boolean),
+    Column("last_interaction", DateTime),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+)
+
+Table(
+    "match_relations", metadata,
+    Column("id", String, primary_key=True),
+    Column("initiator_user_id", String, ForeignKey("users.id"), nullable=False),
+    Column("target_user_id", String, ForeignKey("users.id"), nullable=False),
+    Column("initiator_agent_id", String, ForeignKey("market_agents.id"), nullable=False),
+    Column("target_agent_id", String, ForeignKey("market_agents.id"), nullable=False),
+    Column("match_type", String(20), nullable=False),
+    Column("love_compatibility_score", Float),
+    Column("friendship_compatibility_score", Float),
+    Column("total_interactions", Integer),
+    Column("status", String(20)),
+    Column("last_conversation_at", DateTime),
+    Column("next_scheduled_conversation", DateTime),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+)
+
+Table(
+    "chat_sessions", metadata,
+    Column("id", String, primary_key=True),
+    Column("user1_id", String, ForeignKey("users.id"), nullable=False),
+    Column("user2_id", String, ForeignKey("users.id"), nullable=False),
+    Column("status", String(20)),
+    Column("last_message_at", DateTime),
+    Column("message_count", Integer),
+    Column("user1_online", Boolean),
+    Column("user2_online", Boolean),
+    Column("user1_last_seen", DateTime),
+    Column("user2_last_seen", DateTime),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("related_match_relation_id", String, ForeignKey("match_relations.id"), nullable=True),
+    UniqueConstraint("user1_id", "user2_id", name="unique_user_pair"),
+    Index("idx_chat_session_users", "user1_id", "user2_id"),
+    Index("idx_chat_session_status", "status"),
+    Index("idx_chat_session_last_message", "last_message_at"),
+)
+
+Table(
+    "realtime_messages", metadata,
+    Column("id", String, primary_key=True),
+    Column("chat_session_id", String, ForeignKey("chat_sessions.id"), nullable=False),
+    Column("sender_user_id", String, ForeignKey("users.id"), nullable=False),
+    Column("content", Text, nullable=False),
+    Column("message_type", String(20)),
+    Column("is_deleted", Boolean),
+    Column("edited_at", DateTime),
+    Column("created_at", DateTime),
+    Column("sequence_number", Integer, nullable=False),
+    Column("is_read", Boolean),
+    Column("read_at", DateTime),
+    Index("idx_realtime_message_session_seq", "chat_session_id", "sequence_number"),
+    Index("idx_realtime_message_session_time", "chat_session_id", "created_at"),
+    Index("idx_realtime_message_sender", "sender_user_id"),
+    Index("idx_realtime_message_read_status", "is_read"),
+    UniqueConstraint("chat_session_id", "sequence_number", name="unique_message_sequence"),
+)
+
+Table(
+    "auto_conversations", metadata,
+    Column("id", String, primary_key=True),
+    Column("match_relation_id", String, ForeignKey("match_relations.id"), nullable=False),
+    Column("scenario_id", String, ForeignKey("scenarios.id"), nullable=False),
+    Column("max_turns", Integer),
+    Column("actual_turns", Integer),
+    Column("termination_reason", String(50)),
+    Column("status", String(20)),
+    Column("started_at", DateTime),
+    Column("ended_at", DateTime),
+    Column("created_at", DateTime),
+    Column("round_love_score", Float),
+    Column("round_friendship_score", Float),
+)
+
+Table(
+    "auto_conversation_messages", metadata,
+    Column("id", String, primary_key=True),
+    Column("auto_conversation_id", String, ForeignKey("auto_conversations.id"), nullable=False),
+    Column("sender_agent_id", String, ForeignKey("market_agents.id"), nullable=False),
+    Column("content", Text, nullable=False),
+    Column("message_index", Integer, nullable=False),
+    Column("created_at", DateTime),
+    Column("prompt_used", Text),
+    Column("model_used", String(50)),
+    Column("tokens_used", Integer),
+)
+
+Table(
+    "match_evaluations", metadata,
+    Column("id", String, primary_key=True),
+    Column("auto_conversation_id", String, ForeignKey("auto_conversations.id"), nullable=False),
+    Column("message_id", String, ForeignKey("auto_conversation_messages.id"), nullable=False),
+    Column("love_score_delta", Float),
+    Column("friendship_score_delta", Float),
+    Column("evaluation_reason", Text),
+    Column("evaluator_model", String(50)),
+    Column("evaluation_prompt", Text),
+    Column("tokens_used", Integer),
+    Column("created_at", DateTime),
+)
+
+def upgrade(ctx):
+    metadata.create_all(bind=ctx.connection, checkfirst=True)
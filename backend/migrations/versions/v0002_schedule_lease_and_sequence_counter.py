@@ -0,0 +1,20 @@
+"""
+调度租约持有者与聊天会话序号计数器
+
+- match_relations.schedule_owner
+- chat_sessions.last_sequence_number，按已有消息的最大序号回填，避免新消息与历史消息序号冲突
+"""
+
+version = 2
+name = "schedule_lease_and_sequence_counter"
+transactional = True
+
+def upgrade(ctx):
+    ctx.add_column("match_relations", "schedule_owner", "VARCHAR(100)")
+    ctx.add_column("chat_sessions", "last_sequence_number", "INTEGER", server_default="0", nullable=False)
+
+    ctx.execute(
+        "UPDATE chat_sessions SET last_sequence_number = COALESCE("
+        "(SELECT MAX(sequence_number) FROM realtime_messages "
+        "WHERE realtime_messages.chat_session_id = chat_sessions.id), 0)"
+    )
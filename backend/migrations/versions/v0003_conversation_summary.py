@@ -0,0 +1,37 @@
+"""
+对话列表摘要与人格聊天的滚动摘要
+
+- conversations.message_count / last_message_preview / last_message_at，并按已有消息回填
+- conversations.history_summary / summary_until_index
+
+回填使用SQL完成，不引用模型；预览规则固定为本迁移时 Conversation.make_message_preview 的规则（前50个字符，超出加"..."）
+"""
+
+version = 3
+name = "conversation_summary"
+transactional = True
+
+PREVIEW_LENGTH = 50
+
+# 每个对话最后一条消息（message_index 最大）
+LAST_MESSAGE = (
+    "FROM conversation_messages m WHERE m.conversation_id = conversations.id "
+    "ORDER BY m.message_index DESC LIMIT 1"
+)
+
+def upgrade(ctx):
+    ctx.add_column("conversations", "message_count", "INTEGER", server_default="0", nullable=False)
+    ctx.add_column("conversations", "last_message_preview", "VARCHAR(60)")
+    ctx.add_column("conversations", "last_message_at", "TIMESTAMP")
+    ctx.add_column("conversations", "history_summary", "TEXT")
+    ctx.add_column("conversations", "summary_until_index", "INTEGER")
+
+    # 在迁移所在的事务中回填，失败时与加列一起回滚
+    ctx.execute(
+        "UPDATE conversations SET "
+        "message_count = (SELECT count(*) FROM conversation_messages m WHERE m.conversation_id = conversations.id), "
+        "last_message_preview = (SELECT CASE WHEN length(m.content) > :limit "
+        f"THEN substr(m.content, 1, :limit) || '...' ELSE m.content END {LAST_MESSAGE}), "
+        f"last_message_at = (SELECT m.created_at {LAST_MESSAGE})",
+        limit=PREVIEW_LENGTH
+    )
@@ -0,0 +1,28 @@
+"""
+高频查询的索引
+
+PostgreSQL 上以 CREATE INDEX CONCURRENTLY 在线创建，不锁表
+"""
+
+version = 4
+name = "query_indexes"
+transactional = False
+
+INDEXES = [
+    ("idx_conversation_user_active_updated", "conversations", ["user_id", "is_active", "updated_at"]),
+    ("idx_conversation_persona", "conversations", ["digital_persona_id"]),
+    ("idx_conversation_message_conv_index", "conversation_messages", ["conversation_id", "message_index"]),
+    ("idx_message_feedback_conv_created", "message_feedbacks", ["conversation_id", "created_at"]),
+    ("idx_market_agent_active_type_last", "market_agents", ["is_active", "market_type", "last_interaction"]),
+    ("idx_market_agent_user_type_active", "market_agents", ["user_id", "market_type", "is_active"]),
+    ("idx_match_relation_status_next_conv", "match_relations", ["status", "next_scheduled_conversation"]),
+    ("idx_match_relation_initiator", "match_relations", ["initiator_user_id", "status", "match_type"]),
+    ("idx_match_relation_target", "match_relations", ["target_user_id", "status", "match_type"]),
+    ("idx_auto_conversation_match_status_created", "auto_conversations", ["match_relation_id", "status", "created_at"]),
+    ("idx_auto_conversation_message_conv_index", "auto_conversation_messages", ["auto_conversation_id", "message_index"]),
+    ("idx_match_evaluation_auto_conv", "match_evaluations", ["auto_conversation_id"]),
+]
+
+def upgrade(ctx):
+    for index_name, table, columns in INDEXES:
+        ctx.create_index(index_name, table, columns)
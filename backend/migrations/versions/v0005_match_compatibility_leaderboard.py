@@ -0,0 +1,31 @@
+"""
+匹配列表按匹配度排序
+
+- match_relations.max_compatibility_score（恋爱/友谊匹配度中的较高者），按已有分数回填
+- 以 (initiator_user_id, status[, match_type], max_compatibility_score, id) 索引替换原来的发起者索引，
+  匹配列表可按索引顺序读取前K条而无需排序
+"""
+
+version = 5
+name = "match_compatibility_leaderboard"
+transactional = False
+
+def upgrade(ctx):
+    ctx.add_column("match_relations", "max_compatibility_score", "FLOAT", server_default="0", nullable=False)
+    ctx.execute(
+        "UPDATE match_relations SET max_compatibility_score = CASE "
+        "WHEN COALESCE(love_compatibility_score, 0) >= COALESCE(friendship_compatibility_score, 0) "
+        "THEN COALESCE(love_compatibility_score, 0) "
+        "ELSE COALESCE(friendship_compatibility_score, 0) END"
+    )
+
+    ctx.create_index(
+        "idx_match_relation_initiator_score", "match_relations",
+        ["initiator_user_id", "status", "max_compatibility_score", "id"]
+    )
+    ctx.create_index(
+        "idx_match_relation_initiator_type_score", "match_relations",
+        ["initiator_user_id", "status", "match_type", "max_compatibility_score", "id"]
+    )
+    # 新索引的前缀已覆盖原发起者索引
+    ctx.drop_index("idx_match_relation_initiator")
@@ -0,0 +1,150 @@
+"""
+情感匹配市场检索
+
+- market_agent_tags 标签倒排表，按已有数字人格的 tags（JSON）回填
+- market_agents 列表索引补上 id，按 (last_interaction, id) 游标分页无需排序；另加不限市场类型的列表索引
+- 名称/描述的三字（trigram）全文索引：
+  SQLite 为 FTS5 外部内容表 market_agents_fts，由触发器与 market_agents 同步（0009 改为以整数主键关联）；
+  PostgreSQL 为 pg_trgm 扩展加 GIN 表达式索引。
+  数据库不支持时跳过，检索退化为 LIKE 匹配
+
+不引用应用代码，标签规范化规则与回填SQL固定在本迁移中
+"""
+
+import json
+import re
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, ForeignKey, Index, MetaData, String, Table, Text, bindparam, select, text
+)
+from sqlalchemy.exc import DBAPIError
+
+version = 6
+name = "market_search"
+transactional = False
+
+BATCH_SIZE = 1000
+MAX_TAG_LENGTH = 50
+
+metadata = MetaData()
+
+# 固定为本迁移时的表结构，之后的改动由新的迁移完成；market_agents 只列出回填用到的列
+market_agents = Table(
+    "market_agents", metadata,
+    Column("id", String, primary_key=True),
+    Column("market_type", String(20)),
+    Column("tags", Text),
+    Column("is_active", Boolean),
+    Column("last_interaction", DateTime),
+    Column("created_at", DateTime),
+)
+
+market_agent_tags = Table(
+    "market_agent_tags", metadata,
+    Column("market_agent_id", String, ForeignKey("market_agents.id"), primary_key=True),
+    Column("tag", String(50), primary_key=True),
+    Column("market_type", String(20), nullable=False),
+    Column("last_interaction", DateTime, nullable=False),
+    Index("idx_market_agent_tag_type_last", "tag", "market_type", "last_interaction", "market_agent_id"),
+    Index("idx_market_agent_tag_last", "tag", "last_interaction", "market_agent_id"),
+)
+
+def _normalize_tag(tag) -> str:
+    """标签的检索键，固定为本迁移时 market_search_service.normalize_tag 的规则"""
+    return re.sub(r"\s+", " ", str(tag)).strip().lower()[:MAX_TAG_LENGTH]
+
+def upgrade(ctx):
+    if not ctx.has_table("market_agent_tags"):
+        market_agent_tags.create(bind=ctx.connection)
+        print("  ➕ market_agent_tags")
+    _backfill_tags(ctx)
+
+    ctx.create_index(
+        "idx_market_agent_active_type_last_id", "market_agents",
+        ["is_active", "market_type", "last_interaction", "id"]
+    )
+    ctx.create_index(
+        "idx_market_agent_active_last_id", "market_agents",
+        ["is_active", "last_interaction", "id"]
+    )
+    ctx.drop_index("idx_market_agent_active_type_last")
+
+    try:
+        if ctx.dialect == "sqlite":
+            _create_sqlite_fts(ctx)
+        elif ctx.dialect == "postgresql":
+            ctx.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            ctx.create_index(
+                "idx_market_agent_search_trgm", "market_agents",
+                ["(display_name || ' ' || coalesce(display_description, '')) gin_trgm_ops"],
+                using="gin"
+            )
+    except DBAPIError as e:
+        print(f"  ⚠️ 未能创建全文索引，市场检索将使用 LIKE 匹配: {e}")
+
+def _backfill_tags(ctx):
+    """按 id 分批回填在架数字人格的标签，重复执行时跳过已存在的行"""
+    table = market_agents
+    last_id = ""
+    while True:
+        # 通过表对象查询，时间列按 DateTime 类型读写
+        agents = ctx.connection.execute(
+            select(table.c.id, table.c.tags, table.c.market_type, table.c.last_interaction, table.c.created_at)
+            .where(table.c.is_active == True, table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not agents:
+            break
+
+        rows = []
+        for agent_id, tags, market_type, last_interaction, created_at in agents:
+            try:
+                tag_list = json.loads(tags or "[]")
+            except ValueError:
+                tag_list = []
+            keys = dict.fromkeys(_normalize_tag(t) for t in tag_list if isinstance(t, str))
+            rows.extend(
+                {"agent_id": agent_id, "tag": key, "market_type": market_type,
+                 "last_interaction": last_interaction or created_at}
+                for key in keys if key
+            )
+
+        if rows:
+            ctx.connection.execute(text(
+                "INSERT INTO market_agent_tags (market_agent_id, tag, market_type, last_interaction) "
+                "VALUES (:agent_id, :tag, :market_type, :last_interaction) ON CONFLICT DO NOTHING"
+            ).bindparams(bindparam("last_interaction", type_=DateTime)), rows)
+        last_id = agents[-1][0]
+
+def _create_sqlite_fts(ctx):
+    ctx.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS market_agents_fts USING fts5("
+        "display_name, display_description, "
+        "content='market_agents', content_rowid='rowid', tokenize='trigram')"
+    )
+    ctx.execute(
+        "CREATE TRIGGER IF NOT EXISTS market_agents_fts_insert AFTER INSERT ON market_agents BEGIN "
+        "INSERT INTO market_agents_fts(rowid, display_name, display_description) "
+        "VALUES (new.rowid, new.display_name, new.display_description); "
+        "END"
+    )
+    ctx.execute(
+        "CREATE TRIGGER IF NOT EXISTS market_agents_fts_delete AFTER DELETE ON market_agents BEGIN "
+        "INSERT INTO market_agents_fts(market_agents_fts, rowid, display_name, display_description) "
+        "VALUES ('delete', old.rowid, old.display_name, old.display_description); "
+        "END"
+    )
+    ctx.execute(
+        "CREATE TRIGGER IF NOT EXISTS market_agents_fts_update "
+        "AFTER UPDATE OF display_name, display_description ON market_agents BEGIN "
+        "INSERT INTO market_agents_fts(market_agents_fts, rowid, display_name, display_description) "
+        "VALUES ('delete', old.rowid, old.display_name, old.display_description); "
+        "INSERT INTO market_agents_fts(rowid, display_name, display_description) "
+        "VALUES (new.rowid, new.display_name, new.display_description); "
+        "END"
+    )
+    # 按已有数据建索引；名称命中的权重高于描述
+    ctx.execute("INSERT INTO market_agents_fts(market_agents_fts) VALUES ('rebuild')")
+    ctx.execute("INSERT INTO market_agents_fts(market_agents_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    print("  🗂️ market_agents_fts")
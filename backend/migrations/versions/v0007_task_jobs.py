@@ -0,0 +1,42 @@
+"""
+后台任务队列表 task_jobs
+
+引入迁移之前由 create_all 建表的数据库已有该表，这里只补建缺失的表和索引
+"""
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text
+
+version = 7
+name = "task_jobs"
+transactional = False
+
+metadata = MetaData()
+
+task_jobs = Table(
+    "task_jobs", metadata,
+    Column("id", String, primary_key=True),
+    Column("task_type", String(50), nullable=False),
+    Column("payload", Text),
+    Column("status", String(20)),
+    Column("progress", Integer),
+    Column("result", Text),
+    Column("error", Text),
+    Column("attempts", Integer),
+    Column("max_attempts", Integer),
+    Column("available_at", DateTime),
+    Column("locked_by", String(100)),
+    Column("locked_until", DateTime),
+    Column("created_at", DateTime),
+    Column("started_at", DateTime),
+    Column("completed_at", DateTime),
+    Column("updated_at", DateTime),
+)
+
+def upgrade(ctx):
+    if not ctx.has_table("task_jobs"):
+        task_jobs.create(bind=ctx.connection)
+        print("  ➕ task_jobs")
+
+    ctx.create_index("idx_task_job_status_available", "task_jobs", ["status", "available_at"])
+    ctx.create_index("idx_task_job_status_locked", "task_jobs", ["status", "locked_until"])
+    ctx.create_index("idx_task_job_created", "task_jobs", ["created_at"])
@@ -0,0 +1,33 @@
+"""
+市场全文索引的表达式改为 display_name || ' ' || coalesce(display_description, '')
+
+描述为 NULL 时原表达式的结果为 NULL，名称也无法被检索到。0006 已按新表达式建索引，
+这里只重建按旧表达式建立的 PostgreSQL 索引，否则检索使用的表达式与索引不一致、无法走索引。
+重建失败时迁移不会被记录，再次执行会继续重建
+"""
+
+version = 8
+name = "market_search_coalesce"
+transactional = False
+
+INDEX_NAME = "idx_market_agent_search_trgm"
+
+def upgrade(ctx):
+    if ctx.dialect != "postgresql":
+        return
+    if not ctx.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar():
+        return  # 0006 未能启用 pg_trgm，检索使用 LIKE 匹配
+
+    definition = ctx.execute(
+        "SELECT pg_get_indexdef(c.oid) FROM pg_class c "
+        "WHERE c.relname = :name AND c.relkind = 'i' AND pg_table_is_visible(c.oid)",
+        name=INDEX_NAME
+    ).scalar()
+    if definition is not None and "coalesce" not in definition.lower():
+        ctx.drop_index(INDEX_NAME)
+
+    ctx.create_index(
+        INDEX_NAME, "market_agents",
+        ["(display_name || ' ' || coalesce(display_description, '')) gin_trgm_ops"],
+        using="gin"
+    )
@@ -0,0 +1,71 @@
+"""
+SQLite 市场全文索引改为以整数主键关联
+
+0006 的 FTS5 外部内容表以 market_agents 的隐式 rowid 关联，而 market_agents 的主键是字符串 id，
+VACUUM 可能重新编号隐式 rowid，之后检索会命中错误的数字人格。
+这里新增 market_agent_search_keys(id INTEGER PRIMARY KEY, market_agent_id)：INTEGER PRIMARY KEY 即 rowid，
+VACUUM 不会改变；market_agents_fts 改为普通 FTS5 表，rowid 取该表的 id，由触发器维护。
+0006 未能创建全文索引（不支持 FTS5）时跳过，检索仍使用 LIKE 匹配
+"""
+
+version = 9
+name = "market_search_fts_keys"
+transactional = True
+
+def upgrade(ctx):
+    if ctx.dialect != "sqlite":
+        return
+    if not ctx.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'market_agents_fts'"
+    ).scalar():
+        return
+
+    ctx.execute(
+        "CREATE TABLE IF NOT EXISTS market_agent_search_keys ("
+        "id INTEGER PRIMARY KEY, "
+        "market_agent_id VARCHAR NOT NULL UNIQUE REFERENCES market_agents (id))"
+    )
+    ctx.execute(
+        "INSERT INTO market_agent_search_keys (market_agent_id) "
+        "SELECT id FROM market_agents ORDER BY rowid ON CONFLICT DO NOTHING"
+    )
+    print("  ➕ market_agent_search_keys")
+
+    for trigger in ("market_agents_fts_insert", "market_agents_fts_delete", "market_agents_fts_update"):
+        ctx.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    ctx.execute("DROP TABLE market_agents_fts")
+    ctx.execute(
+        "CREATE VIRTUAL TABLE market_agents_fts USING fts5("
+        "display_name, display_description, tokenize='trigram')"
+    )
+
+    key = "(SELECT id FROM market_agent_search_keys WHERE market_agent_id = {}.id)"
+    ctx.execute(
+        "CREATE TRIGGER market_agents_fts_insert AFTER INSERT ON market_agents BEGIN "
+        "INSERT INTO market_agent_search_keys (market_agent_id) VALUES (new.id); "
+        "INSERT INTO market_agents_fts (rowid, display_name, display_description) "
+        f"VALUES ({key.format('new')}, new.display_name, new.display_description); "
+        "END"
+    )
+    ctx.execute(
+        "CREATE TRIGGER market_agents_fts_delete AFTER DELETE ON market_agents BEGIN "
+        f"DELETE FROM market_agents_fts WHERE rowid = {key.format('old')}; "
+        "DELETE FROM market_agent_search_keys WHERE market_agent_id = old.id; "
+        "END"
+    )
+    ctx.execute(
+        "CREATE TRIGGER market_agents_fts_update "
+        "AFTER UPDATE OF display_name, display_description ON market_agents BEGIN "
+        "UPDATE market_agents_fts SET display_name = new.display_name, display_description = new.display_description "
+        f"WHERE rowid = {key.format('new')}; "
+        "END"
+    )
+
+    ctx.execute(
+        "INSERT INTO market_agents_fts (rowid, display_name, display_description) "
+        "SELECT k.id, a.display_name, a.display_description "
+        "FROM market_agent_search_keys k JOIN market_agents a ON a.id = k.market_agent_id"
+    )
+    # 名称命中的权重高于描述
+    ctx.execute("INSERT INTO market_agents_fts(market_agents_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    print("  🗂️ market_agents_fts")
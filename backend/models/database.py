@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float, ForeignKey, Index, UniqueConstraint
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Text, Boolean, Float, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
+import json
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -20,11 +21,43 @@ if not DATABASE_URL:
 else:
     print("📊 使用PostgreSQL数据库")
 
+# 连接池配置
+POOL_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),  # 常驻连接数
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),  # 高峰时允许额外创建的连接数
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),  # 等待空闲连接的超时（秒）
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),  # 连接最长复用时间（秒），避免被服务端断开
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",  # 取出连接前检测是否可用
+}
+
+# SQLite连接参数：WAL模式允许读写并发，busy_timeout让并发写入等待而不是直接报 database is locked
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 268435456)),
+}
+
 # 根据数据库类型选择引擎参数
 if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    if ":memory:" in DATABASE_URL or DATABASE_URL.rstrip("/") == "sqlite:":
+        # 内存数据库只能使用单连接池
+        engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(
+            DATABASE_URL,
+            connect_args={"check_same_thread": False, "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000},
+            **POOL_OPTIONS
+        )
+
+    @event.listens_for(engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
 else:
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(DATABASE_URL, **POOL_OPTIONS)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -96,12 +129,42 @@ class Conversation(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     
+    # 对话摘要（写消息时同步维护，列表页无需再查询消息表）
+    message_count = Column(Integer, default=0, nullable=False)
+    last_message_preview = Column(String(60))
+    last_message_at = Column(DateTime)
+    
+    # 滚动摘要：message_index <= summary_until_index 的消息已折叠进 history_summary
+    history_summary = Column(Text)
+    summary_until_index = Column(Integer)
+    
+    __table_args__ = (
+        Index('idx_conversation_user_active_updated', 'user_id', 'is_active', 'updated_at'),
+        Index('idx_conversation_persona', 'digital_persona_id'),
+    )
+    
     # Relationships
     user = relationship("User", back_populates="conversations")
     digital_persona = relationship("DigitalPersona", back_populates="conversations")
     scenario = relationship("Scenario", back_populates="conversations")
     messages = relationship("ConversationMessage", back_populates="conversation")
     feedbacks = relationship("MessageFeedback", back_populates="conversation")
+    
+    @staticmethod
+    def make_message_preview(content: str, limit: int = 50) -> str:
+        """生成最后一条消息的预览文本"""
+        return content[:limit] + "..." if len(content) > limit else content
+    
+    def record_message(self, message: "ConversationMessage"):
+        """
+        新消息写入后更新对话摘要，需与消息在同一事务中提交
+        消息数在数据库中累加，避免并发发送时互相覆盖；每次提交前只能调用一次
+        """
+        now = message.created_at or datetime.utcnow()
+        self.message_count = Conversation.message_count + 1
+        self.last_message_preview = self.make_message_preview(message.content)
+        self.last_message_at = now
+        self.updated_at = now
 
 class ConversationMessage(Base):
     __tablename__ = "conversation_messages"
@@ -118,6 +181,10 @@ class ConversationMessage(Base):
     model_used = Column(String(50))  # 使用的模型
     tokens_used = Column(Integer)  # 使用的token数
     
+    __table_args__ = (
+        Index('idx_conversation_message_conv_index', 'conversation_id', 'message_index'),
+    )
+    
     # Relationships
     conversation = relationship("Conversation", back_populates="messages")
     feedbacks = relationship("MessageFeedback", back_populates="message")
@@ -132,6 +199,10 @@ class MessageFeedback(Base):
     feedback_content = Column(Text)  # 文字反馈内容
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        Index('idx_message_feedback_conv_created', 'conversation_id', 'created_at'),
+    )
+    
     # Relationships
     conversation = relationship("Conversation", back_populates="feedbacks")
     message = relationship("ConversationMessage", back_populates="feedbacks")
@@ -168,11 +239,50 @@ class MarketAgent(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        # 市场列表（market_search_service.search），按 (last_interaction, id) 游标分页
+        Index('idx_market_agent_active_type_last_id', 'is_active', 'market_type', 'last_interaction', 'id'),
+        Index('idx_market_agent_active_last_id', 'is_active', 'last_interaction', 'id'),
+        # 用户在某个市场的投放（create_market_agent、create_match_relation）
+        Index('idx_market_agent_user_type_active', 'user_id', 'market_type', 'is_active'),
+    )
+    
     # Relationships
     user = relationship("User")
     digital_persona = relationship("DigitalPersona")
     initiated_matches = relationship("MatchRelation", foreign_keys="MatchRelation.initiator_agent_id", back_populates="initiator_agent")
     received_matches = relationship("MatchRelation", foreign_keys="MatchRelation.target_agent_id", back_populates="target_agent")
+    tag_entries = relationship("MarketAgentTag", back_populates="market_agent", cascade="all, delete-orphan")
+
+    @property
+    def tag_list(self):
+        """展示用的标签列表；解析结果按 tags 的原始JSON缓存，tags 修改后重新解析"""
+        cached = self.__dict__.get("_tag_list_cache")
+        if cached is None or cached[0] != self.tags:
+            cached = (self.tags, json.loads(self.tags or "[]"))
+            self._tag_list_cache = cached
+        return list(cached[1])
+
+class MarketAgentTag(Base):
+    """
+    市场标签倒排索引：每个在架数字人格的每个标签一行
+    冗余 market_type 和 last_interaction，按标签筛选时可直接按索引顺序分页，不必回表排序；
+    由 market_search_service.sync_tags 维护，数字人格下架后对应行被删除
+    """
+    __tablename__ = "market_agent_tags"
+    
+    market_agent_id = Column(String, ForeignKey("market_agents.id"), primary_key=True)
+    tag = Column(String(50), primary_key=True)  # 规范化后的标签（去空白、小写）
+    market_type = Column(String(20), nullable=False)
+    last_interaction = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index('idx_market_agent_tag_type_last', 'tag', 'market_type', 'last_interaction', 'market_agent_id'),
+        Index('idx_market_agent_tag_last', 'tag', 'last_interaction', 'market_agent_id'),
+    )
+    
+    # Relationships
+    market_agent = relationship("MarketAgent", back_populates="tag_entries")
 
 class MatchRelation(Base):
     """用户之间的匹配关系"""
@@ -188,15 +298,26 @@ class MatchRelation(Base):
     # 匹配度分数
     love_compatibility_score = Column(Float, default=0.0)  # 恋爱匹配度
     friendship_compatibility_score = Column(Float, default=0.0)  # 友谊匹配度
+    max_compatibility_score = Column(Float, default=0.0, nullable=False)  # 两项匹配度中的较高者，用于匹配列表排序，随分数一起更新
     total_interactions = Column(Integer, default=0)  # 总交互次数
     
     # 状态和时间
     status = Column(String(20), default="active")  # active, paused, ended
     last_conversation_at = Column(DateTime)
     next_scheduled_conversation = Column(DateTime)
+    schedule_owner = Column(String(100))  # 领取当前对话计划的任务ID（task_jobs.id），对话完成后清空
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        Index('idx_match_relation_status_next_conv', 'status', 'next_scheduled_conversation'),
+        # 我发起的匹配按匹配度排序（get_user_matches），带 match_type 的索引同时用于 create_match_relation 去重
+        Index('idx_match_relation_initiator_score', 'initiator_user_id', 'status', 'max_compatibility_score', 'id'),
+        Index('idx_match_relation_initiator_type_score', 'initiator_user_id', 'status', 'match_type', 'max_compatibility_score', 'id'),
+        # 匹配了我的关系（get_user_agent_matches、get_followers）
+        Index('idx_match_relation_target', 'target_user_id', 'status', 'match_type'),
+    )
+    
     # Relationships
     initiator_user = relationship("User", foreign_keys=[initiator_user_id])
     target_user = relationship("User", foreign_keys=[target_user_id])
@@ -216,6 +337,7 @@ class ChatSession(Base):
     status = Column(String(20), default="active")  # active, archived, blocked
     last_message_at = Column(DateTime)  # 最后消息时间
     message_count = Column(Integer, default=0)  # 消息总数
+    last_sequence_number = Column(Integer, default=0, nullable=False)  # 已分配的最大消息序号
     
     # 用户在线状态（用于WebSocket连接管理）
     user1_online = Column(Boolean, default=False)
@@ -355,6 +477,10 @@ class AutoConversation(Base):
     round_love_score = Column(Float, default=0.0)  # 本轮恋爱匹配度变化
     round_friendship_score = Column(Float, default=0.0)  # 本轮友谊匹配度变化
     
+    __table_args__ = (
+        Index('idx_auto_conversation_match_status_created', 'match_relation_id', 'status', 'created_at'),
+    )
+    
     # Relationships
     match_relation = relationship("MatchRelation", back_populates="auto_conversations")
     scenario = relationship("Scenario")
@@ -377,6 +503,10 @@ class AutoConversationMessage(Base):
     model_used = Column(String(50))
     tokens_used = Column(Integer)
     
+    __table_args__ = (
+        Index('idx_auto_conversation_message_conv_index', 'auto_conversation_id', 'message_index'),
+    )
+    
     # Relationships
     auto_conversation = relationship("AutoConversation", back_populates="messages")
     sender_agent = relationship("MarketAgent")
@@ -400,15 +530,61 @@ class MatchEvaluation(Base):
     tokens_used = Column(Integer)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        Index('idx_match_evaluation_auto_conv', 'auto_conversation_id'),
+    )
+    
     # Relationships
     auto_conversation = relationship("AutoConversation", back_populates="evaluations")
     message = relationship("AutoConversationMessage")
 
+class TaskJob(Base):
+    """后台任务队列（持久化，支持多进程/多节点的worker通过租约领取）"""
+    __tablename__ = "task_jobs"
+
+    id = Column(String, primary_key=True, default=generate_uuid)
+    task_type = Column(String(50), nullable=False)
+    payload = Column(Text)  # 任务参数，JSON格式存储
+
+    # 任务状态
+    status = Column(String(20), default="pending")  # pending, running, completed, failed
+    progress = Column(Integer, default=0)
+    result = Column(Text)  # 任务结果，JSON格式存储
+    error = Column(Text)
+
+    # 重试与租约
+    attempts = Column(Integer, default=0)  # 已领取次数
+    max_attempts = Column(Integer, default=3)
+    available_at = Column(DateTime, default=datetime.utcnow)  # 可被领取的最早时间（用于重试退避）
+    locked_by = Column(String(100))  # 持有租约的worker
+    locked_until = Column(DateTime)  # 租约到期时间，到期未续约则可被其他worker重新领取
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    completed_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index('idx_task_job_status_available', 'status', 'available_at'),
+        Index('idx_task_job_status_locked', 'status', 'locked_until'),
+        Index('idx_task_job_created', 'created_at'),
+    )
+
 # 创建所有表
 def create_tables():
     Base.metadata.create_all(bind=engine)
     print("✅ 数据库表创建完成")
 
+def get_pool_status() -> dict:
+    """连接池状态：常驻大小、已借出、溢出与空闲连接数"""
+    pool = engine.pool
+    status = {"pool_class": type(pool).__name__}
+    for name in ("size", "checkedout", "overflow", "checkedin"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            status[name] = method()
+    return status
+
 # 获取数据库会话
 def get_db():
     db = SessionLocal()
@@ -435,15 +611,18 @@ __all__ = [
     'MessageFeedback',
     'PromptOptimization',
     'MarketAgent',
+    'MarketAgentTag',
     'MatchRelation',
     'ChatSession',  # 新增的聊天会话模型
     'RealTimeMessage',
     'AutoConversation',
     'AutoConversationMessage',
     'MatchEvaluation',
+    'TaskJob',
     'Base',
     'engine',
     'SessionLocal',
+    'get_pool_status',
     'get_db',
     'create_tables',
     'init_database'
@@ -2,11 +2,14 @@ import openai
 import os
 import json
 import httpx
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 from datetime import datetime
 import re
 from dotenv import load_dotenv
 
+from services.llm_cache import LLMResponseCache
+from services.llm_gateway import llm_gateway, ProviderHTTPError
+
 load_dotenv()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -17,17 +20,43 @@ class AIService:
         # AI服务提供商选择 (openai 或 dify)
         self.ai_provider = os.getenv("AI_PROVIDER", "openai").lower()
         
-        # OpenAI配置
+        # 共享的连接池HTTP客户端（OpenAI与Dify共用，避免每次请求重新建连）
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("AI_HTTP_MAX_CONNECTIONS", 100)),
+                max_keepalive_connections=int(os.getenv("AI_HTTP_MAX_KEEPALIVE", 20))
+            ),
+            timeout=httpx.Timeout(float(os.getenv("AI_HTTP_TIMEOUT", 60.0)), connect=10.0)
+        )
+        
+        # OpenAI配置（使用异步客户端，LLM调用不会阻塞事件循环；重试由LLM网关统一处理）
         self.model = os.getenv("OPENAI_MODEL", "gpt-4-turbo-preview")
-        self.client = openai.OpenAI()
+        self.client = openai.AsyncOpenAI(http_client=self.http_client, max_retries=0)
         
         # Dify配置
         self.dify_api_key = os.getenv("DIFY_API_KEY")
         self.dify_base_url = os.getenv("DIFY_BASE_URL", "https://api.dify.ai/v1")
         self.dify_app_id = os.getenv("DIFY_APP_ID")
         
-        # HTTP客户端用于Dify API调用
-        self.http_client = httpx.AsyncClient()
+        # 确定性调用（评估、判断等）的响应缓存
+        self.response_cache = LLMResponseCache()
+    
+    def count_tokens(self, text: str) -> int:
+        """
+        估算文本的token数（用于上下文预算和TPM限流，不需要精确值）
+        按字符估算，不依赖分词器：精确计数需要额外安装tiktoken，且首次使用时会联网下载编码文件
+        """
+        # 中日韩字符约1个token，其余约4个字符1个token
+        cjk = len(re.findall(r'[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+        return cjk + (len(text) - cjk + 3) // 4
+    
+    def _estimate_request_tokens(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> int:
+        """估算一次请求消耗的token数（输入 + 输出上限），用于TPM限流"""
+        return sum(self.count_tokens(msg["content"]) for msg in messages) + (max_tokens or 512)
+    
+    @property
+    def _dify_model(self) -> str:
+        return self.dify_app_id or "default"
     
     async def _call_dify_api(
         self,
@@ -66,17 +95,27 @@ class AIService:
             if conversation_id:
                 data["conversation_id"] = conversation_id
             
-            response = await self.http_client.post(
-                f"{self.dify_base_url}/chat-messages",
-                headers=headers,
-                json=data,
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Dify API error: {response.status_code} - {response.text}")
+            async def request():
+                response = await self.http_client.post(
+                    f"{self.dify_base_url}/chat-messages",
+                    headers=headers,
+                    json=data,
+                    timeout=30.0
+                )
+                if response.status_code != 200:
+                    raise ProviderHTTPError(
+                        response.status_code,
+                        f"Dify API error: {response.status_code} - {response.text}",
+                        response.headers.get("retry-after")
+                    )
+                return response.json()
             
-            result = response.json()
+            result = await llm_gateway.call(
+                "dify",
+                self._dify_model,
+                request,
+                estimated_tokens=self.count_tokens(self_awareness + prompt) + 512
+            )
             
             metadata = {
                 "provider": "dify",
@@ -110,11 +149,16 @@ class AIService:
             Tuple[response_content, metadata]
         """
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
+            response = await llm_gateway.call(
+                "openai",
+                self.model,
+                lambda: self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                ),
+                estimated_tokens=self._estimate_request_tokens(messages, max_tokens)
             )
             
             agent_response = response.choices[0].message.content
@@ -131,14 +175,124 @@ class AIService:
         except Exception as e:
             print(f"Error calling OpenAI API: {e}")
             return "抱歉，我现在无法回复。", {"error": str(e), "provider": "openai"}
+    
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        use_cache: Optional[bool] = None
+    ) -> str:
+        """
+        单次补全调用（评估、判断、生成提示等非对话场景），返回模型输出文本
+        
+        Args:
+            use_cache: None 时按温度决定是否缓存；True 强制使用缓存；False 不使用缓存
+        """
+        model = model or self.model
+        if use_cache is None:
+            use_cache = self.response_cache.should_cache(temperature)
+        use_cache = use_cache and self.response_cache.enabled
+        
+        cache_key = None
+        if use_cache:
+            cache_key = self.response_cache.make_key(
+                f"openai:{self.client.base_url}", model, messages, temperature, max_tokens
+            )
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        params = {"model": model, "messages": messages, "temperature": temperature}
+        if max_tokens is not None:
+            params["max_tokens"] = max_tokens
+        response = await llm_gateway.call(
+            "openai",
+            model,
+            lambda: self.client.chat.completions.create(**params),
+            estimated_tokens=self._estimate_request_tokens(messages, max_tokens)
+        )
+        content = response.choices[0].message.content or ""
+        
+        if cache_key is not None and content:
+            self.response_cache.set(cache_key, content)
+        return content
+        
+    def _build_agent_system_prompt(
+        self,
+        system_prompt: str,
+        scenario_context: str,
+        is_market_chat: bool = False,
+        history_summary: Optional[str] = None
+    ) -> str:
+        """构建agent回复使用的完整系统提示"""
+        market_chat_instruction = ""
+        if is_market_chat:
+            market_chat_instruction = """
+
+重要提示：你现在正在与一个用户进行聊天，对方通过情感匹配市场发现了你。
+- 这不是和你的创造者的对话，而是和一个想要了解你的用户进行对话
+- 可以适当展示你的个性特点，但不要过于亲密或透露过多私人信息
+- 保持自然的交流节奏，不要显得过于主动或被动
+"""
+        
+        summary_section = ""
+        if history_summary:
+            summary_section = f"""
+之前的对话摘要：
+{history_summary}
+"""
+        
+        return f"""
+{system_prompt}
+
+场景背景：
+{scenario_context}
+{market_chat_instruction}{summary_section}
+请根据你的人格特征，在当前场景下自然地回应用户。保持角色一致性，回复应该符合你的性格特点。
+**必须遵守**：除非必要或用户明确要求，保持回复长度在10个字左右，保持口语表达，就像真人在敲键盘打字。
+"""
+    
+    def _build_dify_prompt(self, conversation_history: List[Dict[str, str]], user_message: str) -> str:
+        """Dify需要将对话历史和用户消息组合成一个完整的prompt"""
+        conversation_text = ""
+        for msg in conversation_history:
+            sender = "用户" if msg["sender_type"] == "user" else "助手"
+            conversation_text += f"{sender}：{msg['content']}\n"
         
+        return f"""
+对话历史：
+{conversation_text}
+
+用户：{user_message}
+
+请以数字人格身份回复："""
+    
+    def _build_openai_messages(
+        self,
+        full_system_prompt: str,
+        conversation_history: List[Dict[str, str]],
+        user_message: str
+    ) -> List[Dict[str, str]]:
+        """构建OpenAI消息列表：系统提示 + 对话历史 + 当前用户消息"""
+        messages = [{"role": "system", "content": full_system_prompt}]
+        
+        for msg in conversation_history:
+            role = "user" if msg["sender_type"] == "user" else "assistant"
+            messages.append({"role": role, "content": msg["content"]})
+        
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
     async def generate_agent_response(
         self, 
         system_prompt: str, 
         conversation_history: List[Dict[str, str]], 
         scenario_context: str,
         user_message: str,
-        is_market_chat: bool = False
+        is_market_chat: bool = False,
+        history_summary: Optional[str] = None
     ) -> Tuple[str, Dict[str, Any]]:
         """
         生成agent回复
@@ -149,87 +303,36 @@ class AIService:
             scenario_context: 场景上下文
             user_message: 用户消息
             is_market_chat: 是否是市场聊天（与其他用户对话）
+            history_summary: 更早对话的摘要（对话历史之前的内容）
             
         Returns:
             Tuple[agent_response, metadata]
         """
         try:
             # 构建完整的系统提示
-            market_chat_instruction = ""
-            if is_market_chat:
-                market_chat_instruction = """
-
-重要提示：你现在正在与一个用户进行聊天，对方通过情感匹配市场发现了你。
-- 这不是和你的创造者的对话，而是和一个想要了解你的用户进行对话
-- 可以适当展示你的个性特点，但不要过于亲密或透露过多私人信息
-- 保持自然的交流节奏，不要显得过于主动或被动
-"""
-            
-            full_system_prompt = f"""
-{system_prompt}
-
-场景背景：
-{scenario_context}
-{market_chat_instruction}
-
-请根据你的人格特征，在当前场景下自然地回应用户。保持角色一致性，回复应该符合你的性格特点。
-**必须遵守**：除非必要或用户明确要求，保持回复长度在10个字左右，保持口语表达，就像真人在敲键盘打字。
-"""
+            full_system_prompt = self._build_agent_system_prompt(
+                system_prompt, scenario_context, is_market_chat, history_summary
+            )
             
             # 根据AI服务提供商选择调用方式
             if self.ai_provider == "dify":
-                # 使用Dify API
-                # 对于Dify，我们需要将对话历史和用户消息组合成一个完整的prompt
-                conversation_text = ""
-                for msg in conversation_history:
-                    sender = "用户" if msg["sender_type"] == "user" else "助手"
-                    conversation_text += f"{sender}：{msg['content']}\n"
-                
-                # 构建完整的prompt
-                complete_prompt = f"""
-对话历史：
-{conversation_text}
-
-用户：{user_message}
-
-请以数字人格身份回复："""
-                
                 agent_response, metadata = await self._call_dify_api(
                     self_awareness=full_system_prompt,
-                    prompt=complete_prompt,
+                    prompt=self._build_dify_prompt(conversation_history, user_message),
                     user_id="soullink_user"
                 )
-                
-                # 添加额外的元数据
-                metadata.update({
-                    "prompt_used": full_system_prompt,
-                    "conversation_length": len(conversation_history)
-                })
-                
             else:
-                # 使用OpenAI API
-                # 构建消息历史
-                messages = [{"role": "system", "content": full_system_prompt}]
-                
-                # 添加对话历史
-                for msg in conversation_history:
-                    role = "user" if msg["sender_type"] == "user" else "assistant"
-                    messages.append({"role": role, "content": msg["content"]})
-                
-                # 添加当前用户消息
-                messages.append({"role": "user", "content": user_message})
-                
                 agent_response, metadata = await self._call_openai_api(
-                    messages=messages,
+                    messages=self._build_openai_messages(full_system_prompt, conversation_history, user_message),
                     temperature=0.8,
                     max_tokens=512
                 )
-                
-                # 添加额外的元数据
-                metadata.update({
-                    "prompt_used": full_system_prompt,
-                    "conversation_length": len(conversation_history)
-                })
+            
+            # 添加额外的元数据
+            metadata.update({
+                "prompt_used": full_system_prompt,
+                "conversation_length": len(conversation_history)
+            })
             
             return agent_response, metadata
             
@@ -237,6 +340,187 @@ class AIService:
             print(f"Error generating agent response: {e}")
             return "抱歉，我现在无法回复。", {"error": str(e)}
     
+    async def stream_agent_response(
+        self, 
+        system_prompt: str, 
+        conversation_history: List[Dict[str, str]], 
+        scenario_context: str,
+        user_message: str,
+        is_market_chat: bool = False,
+        history_summary: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        流式生成agent回复，参数与 generate_agent_response 相同
+        
+        依次产出 {"type": "delta", "content": 文本片段}，
+        结束时产出 {"type": "done", "content": 完整回复, "metadata": {...}}；
+        出错时产出 {"type": "error", "error": 错误信息} 并结束
+        """
+        full_system_prompt = self._build_agent_system_prompt(
+            system_prompt, scenario_context, is_market_chat, history_summary
+        )
+        
+        if self.ai_provider == "dify":
+            events = self._stream_dify_api(
+                self_awareness=full_system_prompt,
+                prompt=self._build_dify_prompt(conversation_history, user_message),
+                user_id="soullink_user"
+            )
+        else:
+            events = self._stream_openai_api(
+                messages=self._build_openai_messages(full_system_prompt, conversation_history, user_message),
+                temperature=0.8,
+                max_tokens=512
+            )
+        
+        chunks = []
+        try:
+            async for event in events:
+                if event["type"] == "delta":
+                    chunks.append(event["content"])
+                    yield event
+                elif event["type"] == "done":
+                    event["metadata"].update({
+                        "prompt_used": full_system_prompt,
+                        "conversation_length": len(conversation_history)
+                    })
+                    yield {"type": "done", "content": "".join(chunks), "metadata": event["metadata"]}
+        except Exception as e:
+            print(f"Error streaming agent response: {e}")
+            yield {"type": "error", "error": str(e)}
+    
+    async def _stream_openai_api(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.8,
+        max_tokens: int = 512
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """以 stream=True 调用OpenAI API，逐个产出文本片段"""
+        async with llm_gateway.slot("openai", self.model, self._estimate_request_tokens(messages, max_tokens)):
+            # 只重试建立流之前的错误，已开始输出后不再重试
+            stream = await llm_gateway.with_retry(lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            ))
+            
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"type": "delta", "content": chunk.choices[0].delta.content}
+        
+        yield {
+            "type": "done",
+            "metadata": {
+                "provider": "openai",
+                "model_used": self.model,
+                "tokens_used": None,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+        }
+    
+    async def _stream_dify_api(
+        self,
+        prompt: str,
+        self_awareness: str = "",
+        conversation_id: Optional[str] = None,
+        user_id: str = "default_user"
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """以 response_mode=streaming 调用Dify API，解析SSE事件逐个产出文本片段"""
+        headers = {
+            "Authorization": f"Bearer {self.dify_api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        data = {
+            "inputs": {
+                "self_awareness": self_awareness
+            },
+            "query": prompt,
+            "user": user_id,
+            "response_mode": "streaming"
+        }
+        
+        if conversation_id:
+            data["conversation_id"] = conversation_id
+        
+        metadata = {"provider": "dify"}
+        async with llm_gateway.slot("dify", self._dify_model, self.count_tokens(self_awareness + prompt) + 512):
+            async with self.http_client.stream(
+                "POST",
+                f"{self.dify_base_url}/chat-messages",
+                headers=headers,
+                json=data
+            ) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    raise Exception(f"Dify API error: {response.status_code} - {body.decode(errors='replace')}")
+                
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[5:].strip())
+                    event_type = event.get("event")
+                
+                    if event_type in ("message", "agent_message") and event.get("answer"):
+                        yield {"type": "delta", "content": event["answer"]}
+                    elif event_type == "message_end":
+                        metadata.update({
+                            "conversation_id": event.get("conversation_id"),
+                            "message_id": event.get("message_id") or event.get("id"),
+                            "dify_metadata": event.get("metadata", {})
+                        })
+                    elif event_type == "error":
+                        raise Exception(f"Dify API error: {event.get('message')}")
+        
+        metadata["timestamp"] = datetime.utcnow().isoformat()
+        yield {"type": "done", "metadata": metadata}
+    
+    async def summarize_conversation(
+        self,
+        previous_summary: Optional[str],
+        messages: List[Dict[str, str]]
+    ) -> Optional[str]:
+        """
+        将新的对话内容合并进已有摘要，返回更新后的摘要，失败时返回None
+        
+        Args:
+            previous_summary: 已有的对话摘要（可为空）
+            messages: 需要折叠进摘要的消息，按时间正序
+        """
+        conversation_text = ""
+        for msg in messages:
+            sender = "用户" if msg["sender_type"] == "user" else "AI助手"
+            conversation_text += f"{sender}：{msg['content']}\n"
+        
+        prompt = f"""
+请更新一段对话的摘要。
+
+已有摘要：
+{previous_summary or "（无）"}
+
+新的对话内容：
+{conversation_text}
+
+要求：
+1. 合并已有摘要与新的对话内容，保留关键事实、用户透露的个人信息与偏好、双方关系和情绪的变化
+2. 使用第三人称，按时间顺序简要叙述
+3. 不超过300字，直接输出摘要内容
+"""
+        
+        try:
+            content = await self.complete(
+                [{"role": "user", "content": prompt}],
+                temperature=0.3,
+                max_tokens=600
+            )
+            return content.strip() or None
+            
+        except Exception as e:
+            print(f"Error summarizing conversation: {e}")
+            return None
+    
     async def optimize_system_prompt(
         self, 
         current_prompt: str, 
@@ -298,12 +582,11 @@ class AIService:
                 result = json.loads(agent_response)
             else:
                 # 使用OpenAI API
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": optimization_prompt}],
+                content = await self.complete(
+                    [{"role": "user", "content": optimization_prompt}],
                     temperature=0.3
                 )
-                result = json.loads(response.choices[0].message.content)
+                result = json.loads(content)
             
             return (
                 result["new_prompt"],
@@ -398,13 +681,12 @@ class AIService:
                 )
                 return agent_response.strip()
             else:
-                # 使用OpenAI API
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": prompt_generation_request}],
+                # 使用OpenAI API（较高温度，每次生成的人格各不相同，不缓存）
+                content = await self.complete(
+                    [{"role": "user", "content": prompt_generation_request}],
                     temperature=0.7
                 )
-                return response.choices[0].message.content.strip()
+                return content.strip()
             
         except Exception as e:
             print(f"Error generating initial prompt: {e}")
@@ -517,12 +799,11 @@ class AIService:
                 result = json.loads(agent_response)
             else:
                 # 使用OpenAI API
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": question_prompt}],
+                content = await self.complete(
+                    [{"role": "user", "content": question_prompt}],
                     temperature=0.8
                 )
-                result = json.loads(response.choices[0].message.content)
+                result = json.loads(content)
             return result
             
         except Exception as e:
@@ -576,12 +857,11 @@ class AIService:
                 result = json.loads(agent_response)
             else:
                 # 使用OpenAI API
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": judgment_prompt}],
+                content = await self.complete(
+                    [{"role": "user", "content": judgment_prompt}],
                     temperature=0.3
                 )
-                result = json.loads(response.choices[0].message.content)
+                result = json.loads(content)
             return result.get("continue", True)
             
         except Exception as e:
@@ -642,12 +922,11 @@ class AIService:
                 new_prompt = agent_response.strip()
             else:
                 # 使用OpenAI API
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": optimization_prompt}],
+                content = await self.complete(
+                    [{"role": "user", "content": optimization_prompt}],
                     temperature=0.6
                 )
-                new_prompt = response.choices[0].message.content.strip()
+                new_prompt = content.strip()
             
             # 更新数据库中的system prompt
             persona.system_prompt = new_prompt
@@ -670,8 +949,12 @@ class AIService:
     
     async def cleanup(self):
         """清理资源"""
+        if hasattr(self, 'client'):
+            await self.client.close()
         if hasattr(self, 'http_client'):
             await self.http_client.aclose()
+        if hasattr(self, 'response_cache'):
+            self.response_cache.close()
 
 class ScenarioService:
     """场景服务"""
@@ -740,6 +1023,32 @@ OPENAI_API_KEY=your_openai_api_key
 OPENAI_BASE_URL=https://api.openai.com/v1  # 可选，默认官方API
 OPENAI_MODEL=gpt-4-turbo-preview  # 可选，默认模型
 
+HTTP连接池配置（OpenAI与Dify共用）：
+AI_HTTP_MAX_CONNECTIONS=100  # 可选，最大连接数
+AI_HTTP_MAX_KEEPALIVE=20  # 可选，最大保持连接数
+AI_HTTP_TIMEOUT=60  # 可选，请求超时（秒）
+
+对话历史窗口（人格聊天，超出部分折叠进滚动摘要）：
+CHAT_HISTORY_TOKEN_BUDGET=2000  # 可选，原文历史的token上限
+CHAT_HISTORY_MAX_MESSAGES=40  # 可选，原文历史的条数上限
+
+LLM调用网关（所有服务共享的并发、速率限制与重试）：
+LLM_PROVIDER_CONCURRENCY=16  # 可选，每个服务商的最大并发
+LLM_MODEL_CONCURRENCY=8  # 可选，每个模型的最大并发
+LLM_INTERACTIVE_RESERVED=2  # 可选，为交互请求预留的并发名额，后台任务不可占用
+LLM_RPM=0  # 可选，每个模型每分钟请求数，0表示不限制
+LLM_TPM=0  # 可选，每个模型每分钟token数，0表示不限制
+LLM_MAX_RETRIES=3  # 可选，429/5xx/连接错误的最大重试次数
+LLM_RETRY_BASE_DELAY=0.5  # 可选，退避基数（秒），带随机抖动按指数增长
+LLM_RETRY_MAX_DELAY=20  # 可选，单次退避上限（秒）
+
+LLM响应缓存（温度不高于阈值的评估、判断类调用）：
+LLM_CACHE_ENABLED=true  # 可选，是否启用缓存
+LLM_CACHE_SIZE=1000  # 可选，内存缓存条数上限（LRU淘汰）
+LLM_CACHE_TTL=3600  # 可选，缓存有效期（秒）
+LLM_CACHE_MAX_TEMPERATURE=0.3  # 可选，温度高于该值的调用不缓存
+LLM_CACHE_PATH=./llm_cache.db  # 可选，设置后启用SQLite磁盘缓存
+
 Dify配置：
 DIFY_API_KEY=your_dify_api_key
 DIFY_BASE_URL=https://api.dify.ai/v1  # 可选，默认官方API
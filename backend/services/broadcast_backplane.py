@@ -0,0 +1,202 @@
+"""
+WebSocket 广播背板
+在多个进程/节点之间转发会话广播（聊天消息、正在输入、上下线状态），并共享会话的在线状态
+
+每个节点只持有本地的WebSocket连接。ConnectionManager 广播时先投递给本地连接，
+再通过背板发布；其他节点收到后投递给各自的本地连接。
+连接加入/离开会话时通知背板（join / leave），背板据此订阅会话的频道并登记在线状态。
+
+通过 CHAT_BACKPLANE 选择实现：
+- memory（默认）: 单进程部署，不做跨进程转发，在线状态即本地连接
+- redis: 通过 Redis Pub/Sub 转发，连接地址取自 REDIS_URL
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# 收到其他节点的广播后的本地投递函数: (session_id, message, exclude_user)
+DeliverHandler = Callable[[str, Dict[str, Any], Optional[str]], Awaitable[None]]
+
+class InProcessBackplane:
+    """单进程背板：所有连接都在本进程内，无需转发"""
+
+    async def start(self, deliver: DeliverHandler):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def join(self, session_id: str, user_id: str):
+        pass
+
+    async def leave(self, session_id: str, user_id: str):
+        pass
+
+    async def publish(self, session_id: str, message: Dict[str, Any], exclude_user: Optional[str] = None):
+        pass
+
+    async def online_users(self, session_id: str) -> Set[str]:
+        """其他节点上在线的用户（单进程部署没有其他节点）"""
+        return set()
+
+class RedisBackplane:
+    """
+    基于 Redis Pub/Sub 的背板
+
+    - 每个会话一个频道（{prefix}:session:{session_id}），节点只订阅本地有连接的会话，
+      广播量不随集群中的会话总数增长
+    - 在线状态登记在每个会话的有序集合（{prefix}:presence:{session_id}）中，成员为 "用户ID|节点ID"，
+      分数为过期时间；节点定期续期本地连接，节点崩溃后其登记在 presence_ttl 内过期
+    """
+
+    def __init__(self, url: str, prefix: str = "soullink:chat", presence_ttl: Optional[float] = None):
+        self.url = url
+        self.prefix = prefix
+        self.presence_ttl = presence_ttl or float(os.getenv("CHAT_PRESENCE_TTL", 60))  # 秒
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.redis = None
+        self.pubsub = None
+        self.listener_task: Optional[asyncio.Task] = None
+        self.refresh_task: Optional[asyncio.Task] = None
+        # 本节点上有连接的会话: {session_id: {user_id}}
+        self._local: Dict[str, Set[str]] = {}
+
+    def _channel(self, session_id: str) -> str:
+        return f"{self.prefix}:session:{session_id}"
+
+    def _presence_key(self, session_id: str) -> str:
+        return f"{self.prefix}:presence:{session_id}"
+
+    async def start(self, deliver: DeliverHandler):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(self.url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # 节点自己的频道保证始终有订阅（没有会话连接时 listen 也不会退出），不会有其他节点发布到这里
+        await self.pubsub.subscribe(f"{self.prefix}:node:{self.node_id}")
+        self.listener_task = asyncio.create_task(self._listen(deliver))
+        self.refresh_task = asyncio.create_task(self._refresh_presence())
+        logger.info(f"广播背板已连接 Redis: 节点 {self.node_id}")
+
+    async def stop(self):
+        for task in (self.listener_task, self.refresh_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if self.redis:
+            # 正常退出时立即撤销本节点的在线登记，不等过期
+            try:
+                for session_id, users in self._local.items():
+                    if users:
+                        await self.redis.zrem(self._presence_key(session_id), *self._members(users))
+            except Exception as e:
+                logger.error(f"撤销在线状态失败: {e}")
+            await self.redis.aclose()
+
+    def _members(self, users: Set[str]):
+        return [f"{user_id}|{self.node_id}" for user_id in users]
+
+    async def join(self, session_id: str, user_id: str):
+        """本节点上的用户加入会话：首次有连接时订阅会话频道，并登记在线状态"""
+        users = self._local.setdefault(session_id, set())
+        first = not users
+        users.add(user_id)
+        try:
+            if first:
+                await self.pubsub.subscribe(self._channel(session_id))
+            await self._register(session_id, [user_id])
+        except Exception as e:
+            logger.error(f"加入会话频道失败 (会话 {session_id}): {e}")
+
+    async def leave(self, session_id: str, user_id: str):
+        """本节点上的用户离开会话：撤销在线登记，会话在本节点上没有连接时取消订阅"""
+        users = self._local.get(session_id)
+        if users is None or user_id not in users:
+            return
+        users.discard(user_id)
+        if not users:
+            del self._local[session_id]
+        try:
+            await self.redis.zrem(self._presence_key(session_id), f"{user_id}|{self.node_id}")
+            if not users:
+                await self.pubsub.unsubscribe(self._channel(session_id))
+        except Exception as e:
+            logger.error(f"离开会话频道失败 (会话 {session_id}): {e}")
+
+    async def online_users(self, session_id: str) -> Set[str]:
+        """所有节点上在该会话中在线的用户（登记未过期）"""
+        try:
+            members = await self.redis.zrangebyscore(self._presence_key(session_id), time.time(), "+inf")
+        except Exception as e:
+            logger.error(f"读取在线状态失败 (会话 {session_id}): {e}")
+            return set()
+        return {member.decode().rsplit("|", 1)[0] for member in members}
+
+    async def _register(self, session_id: str, users):
+        key = self._presence_key(session_id)
+        expires_at = time.time() + self.presence_ttl
+        await self.redis.zadd(key, {member: expires_at for member in self._members(set(users))})
+        # 清理已过期的登记（崩溃节点留下的），整个会话无人在线时键自动过期
+        await self.redis.zremrangebyscore(key, "-inf", time.time())
+        await self.redis.pexpire(key, int(self.presence_ttl * 2000))
+
+    async def _refresh_presence(self):
+        """定期续期本节点的在线登记"""
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            for session_id, users in list(self._local.items()):
+                try:
+                    await self._register(session_id, list(users))
+                except Exception as e:
+                    logger.error(f"续期在线状态失败 (会话 {session_id}): {e}")
+
+    async def publish(self, session_id: str, message: Dict[str, Any], exclude_user: Optional[str] = None):
+        envelope = {
+            "node": self.node_id,
+            "sessionId": session_id,
+            "excludeUser": exclude_user,
+            "message": message
+        }
+        try:
+            await self.redis.publish(self._channel(session_id), json.dumps(envelope))
+        except Exception as e:
+            logger.error(f"发布广播到背板失败 (会话 {session_id}): {e}")
+
+    async def _listen(self, deliver: DeliverHandler):
+        """接收其他节点的广播并投递给本地连接，断线后自动重新订阅"""
+        while True:
+            try:
+                async for item in self.pubsub.listen():
+                    envelope = json.loads(item["data"])
+                    if envelope["node"] == self.node_id:
+                        continue  # 本节点发布的广播已在本地投递过
+                    await deliver(envelope["sessionId"], envelope["message"], envelope.get("excludeUser"))
+            except asyncio.CancelledError:
+                await self.pubsub.aclose()
+                raise
+            except Exception as e:
+                logger.error(f"广播背板接收出错，1秒后重新订阅: {e}")
+                await asyncio.sleep(1)
+                try:
+                    channels = [f"{self.prefix}:node:{self.node_id}"] + [self._channel(s) for s in self._local]
+                    await self.pubsub.subscribe(*channels)
+                except Exception as e:
+                    logger.error(f"重新订阅广播频道失败: {e}")
+
+def create_backplane():
+    """根据 CHAT_BACKPLANE 创建背板实例"""
+    kind = os.getenv("CHAT_BACKPLANE", "memory").lower()
+    if kind == "redis":
+        return RedisBackplane(os.getenv("REDIS_URL", "redis://localhost:6379"))
+    return InProcessBackplane()
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, update, select
 from datetime import datetime
 from typing import Optional, List
 from models.database import ChatSession, RealTimeMessage, User, MatchRelation
@@ -178,12 +178,15 @@ class ChatService:
                 print(f"❌ 用户 {sender_user_id} 不是会话 {session_id} 的参与者")
                 return None
             
-            # 计算消息序号
-            last_message = db.query(RealTimeMessage).filter(
-                RealTimeMessage.chat_session_id == session_id
-            ).order_by(RealTimeMessage.sequence_number.desc()).first()
-            
-            sequence_number = (last_message.sequence_number + 1) if last_message else 1
+            # 原子分配消息序号，同时更新会话信息
+            now = datetime.utcnow()
+            sequence_number = self.reserve_sequence_numbers(
+                db,
+                session_id,
+                message_count=ChatSession.message_count + 1,
+                last_message_at=now,
+                updated_at=now
+            )
             
             # 创建消息
             message = RealTimeMessage(
@@ -195,12 +198,6 @@ class ChatService:
             )
             
             db.add(message)
-            
-            # 更新会话信息
-            chat_session.message_count += 1
-            chat_session.last_message_at = datetime.utcnow()
-            chat_session.updated_at = datetime.utcnow()
-            
             db.commit()
             db.refresh(message)
             
@@ -212,32 +209,71 @@ class ChatService:
             db.rollback()
             return None
     
+    def reserve_sequence_numbers(self, db: Session, session_id: str, count: int = 1, **values) -> int:
+        """
+        在会话计数器上原子预留count个连续的消息序号，返回其中最后一个
+        
+        递增在数据库中完成，UPDATE 持有的行锁保证并发写入者拿到不重叠的序号，
+        无需再查询会话中最大的序号。values 为同一条 UPDATE 中需要顺带更新的会话字段。
+        调用方负责提交事务。
+        """
+        stmt = update(ChatSession).where(ChatSession.id == session_id).values(
+            last_sequence_number=ChatSession.last_sequence_number + count,
+            **values
+        ).execution_options(synchronize_session=False)
+        
+        if db.get_bind().dialect.update_returning:
+            return db.execute(stmt.returning(ChatSession.last_sequence_number)).scalar_one()
+        
+        # 不支持 UPDATE ... RETURNING 的数据库：在同一事务中读回（行已被本事务锁定）
+        db.execute(stmt)
+        return db.execute(
+            select(ChatSession.last_sequence_number).where(ChatSession.id == session_id)
+        ).scalar_one()
+    
     def get_messages(
         self, 
         db: Session, 
         session_id: str, 
         limit: int = 50, 
-        offset: int = 0
+        offset: int = 0,
+        before_sequence: Optional[int] = None,
+        after_sequence: Optional[int] = None
     ) -> List[RealTimeMessage]:
         """
         获取聊天会话的消息列表
         
+        按 (chat_session_id, sequence_number) 索引做键集分页：before_sequence 取更早的消息，
+        after_sequence 取更新的消息，都不传时取最新的消息。
+        
         Args:
             db: 数据库会话
             session_id: 聊天会话ID
             limit: 消息数量限制
-            offset: 偏移量
+            offset: 偏移量（已废弃，仅为兼容旧客户端保留）
+            before_sequence: 只返回序号小于该值的消息
+            after_sequence: 只返回序号大于该值的消息
             
         Returns:
-            List[RealTimeMessage]: 消息列表
+            List[RealTimeMessage]: 消息列表（按序号正序）
         """
         try:
-            messages = db.query(RealTimeMessage).filter(
+            query = db.query(RealTimeMessage).filter(
                 and_(
                     RealTimeMessage.chat_session_id == session_id,
                     RealTimeMessage.is_deleted == False
                 )
-            ).order_by(
+            )
+            
+            if after_sequence is not None:
+                return query.filter(
+                    RealTimeMessage.sequence_number > after_sequence
+                ).order_by(RealTimeMessage.sequence_number.asc()).limit(limit).all()
+            
+            if before_sequence is not None:
+                query = query.filter(RealTimeMessage.sequence_number < before_sequence)
+            
+            messages = query.order_by(
                 RealTimeMessage.sequence_number.desc()
             ).offset(offset).limit(limit).all()
             
@@ -0,0 +1,139 @@
+"""
+人格对话上下文构建
+按token预算截取最近的对话，更早的内容折叠进对话上的滚动摘要
+
+- 只读取尚未折叠的最近消息（ORDER BY message_index DESC LIMIT k），不再加载全部历史
+- 未折叠的消息超出预算（或条数上限）时，把较早的部分合并进摘要，只保留约一半预算的最新消息，
+  因此摘要只需偶尔增量更新，发给模型的上下文大小保持稳定
+- 每次请求最多调用一次摘要（一块），长期未摘要的旧对话在之后的请求中逐块折叠，不拖慢单次回复；
+  摘要失败或积压未折叠完时，使用预算内尽可能多的未折叠原文，而不是丢弃未能摘要的消息
+"""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models.database import Conversation, ConversationMessage
+from services.ai_service import ai_service
+
+class ConversationContextBuilder:
+    def __init__(self):
+        self.token_budget = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", 2000))  # 原文历史的token上限
+        self.max_messages = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", 40))  # 原文历史的条数上限
+
+    def next_message_index(self, db: Session, conversation: Conversation) -> int:
+        """下一条消息的序号（利用 (conversation_id, message_index) 索引）"""
+        last_index = db.query(func.max(ConversationMessage.message_index)).filter(
+            ConversationMessage.conversation_id == conversation.id
+        ).scalar()
+        return 0 if last_index is None else last_index + 1
+
+    async def build(self, db: Session, conversation: Conversation) -> Tuple[List[Dict[str, str]], Optional[str]]:
+        """
+        返回 (最近的对话历史, 更早对话的摘要)
+        需要折叠时会更新对话上的摘要字段，由调用方提交
+        """
+        summary_until = conversation.summary_until_index
+        if summary_until is None:
+            summary_until = -1
+
+        # 最新的未折叠消息，按时间倒序
+        recent = db.query(ConversationMessage).filter(
+            ConversationMessage.conversation_id == conversation.id,
+            ConversationMessage.message_index > summary_until
+        ).order_by(ConversationMessage.message_index.desc()).limit(self.max_messages).all()
+
+        token_counts = [ai_service.count_tokens(msg.content) for msg in recent]
+        if sum(token_counts) > self.token_budget or len(recent) >= self.max_messages:
+            fold_until = self._fold_boundary(recent, token_counts)
+            if fold_until is not None:
+                await self._fold_next_chunk(db, conversation, fold_until)
+            recent = self._unsummarized_within_budget(conversation, recent, token_counts)
+
+        history = [
+            {"sender_type": msg.sender_type, "content": msg.content}
+            for msg in reversed(recent)
+        ]
+        return history, conversation.history_summary
+
+    def _fold_boundary(self, recent: List[ConversationMessage], token_counts: List[int]) -> Optional[int]:
+        """保留约一半预算（且不超过一半条数上限）的最新消息，返回需要折叠到的消息序号；无需折叠时返回None"""
+        keep_budget = self.token_budget // 2
+        keep_count = min(len(recent), self.max_messages // 2)
+        used = 0
+        for i, tokens in enumerate(token_counts[:keep_count]):
+            if i > 0 and used + tokens > keep_budget:
+                keep_count = i
+                break
+            used += tokens
+
+        if keep_count == len(recent):
+            return None
+        return recent[keep_count].message_index
+
+    async def _fold_next_chunk(self, db: Session, conversation: Conversation, fold_until: int):
+        """
+        把 (summary_until, fold_until] 区间内最早的一块消息合并进摘要
+
+        recent 受条数上限截断，更早的未折叠消息（如长期未摘要的旧对话）不在其中，
+        因此从上次折叠位置起按时间顺序读取，不跳过任何消息；一次只合并一块，剩余的由之后的请求继续
+        """
+        summary_until = conversation.summary_until_index
+        if summary_until is None:
+            summary_until = -1
+
+        chunk = db.query(ConversationMessage).filter(
+            ConversationMessage.conversation_id == conversation.id,
+            ConversationMessage.message_index > summary_until,
+            ConversationMessage.message_index <= fold_until
+        ).order_by(ConversationMessage.message_index.asc()).limit(self.max_messages).all()
+        if not chunk:
+            return
+        chunk = self._within_budget(chunk)
+
+        summary = await ai_service.summarize_conversation(
+            conversation.history_summary,
+            [{"sender_type": msg.sender_type, "content": msg.content} for msg in chunk]
+        )
+        if summary is None:
+            # 摘要失败时折叠位置不变，下一轮从这里重试
+            return
+
+        conversation.history_summary = summary
+        conversation.summary_until_index = chunk[-1].message_index
+
+    def _unsummarized_within_budget(
+        self,
+        conversation: Conversation,
+        recent: List[ConversationMessage],
+        token_counts: List[int]
+    ) -> List[ConversationMessage]:
+        """
+        摘要之后的最新消息（倒序），不超过token预算（至少一条）
+        折叠成功时即为保留的消息；摘要失败或积压未折叠完时，摘要与这些消息之间更早的原文暂不放入上下文
+        """
+        summary_until = conversation.summary_until_index
+        if summary_until is None:
+            summary_until = -1
+
+        kept, used = [], 0
+        for msg, tokens in zip(recent, token_counts):
+            if msg.message_index <= summary_until or (kept and used + tokens > self.token_budget):
+                break
+            kept.append(msg)
+            used += tokens
+        return kept
+
+    def _within_budget(self, chunk: List[ConversationMessage]) -> List[ConversationMessage]:
+        """单次摘要的输入不超过token预算（至少一条）"""
+        used = 0
+        for i, msg in enumerate(chunk):
+            used += ai_service.count_tokens(msg.content)
+            if i > 0 and used > self.token_budget:
+                return chunk[:i]
+        return chunk
+
+# 全局上下文构建器实例
+conversation_context_builder = ConversationContextBuilder()
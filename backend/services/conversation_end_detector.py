@@ -0,0 +1,110 @@
+"""
+自动对话结束判断的本地预筛
+明显的情况（互相道别、重复绕圈、连续敷衍短回复、正在提问）直接给出结论，
+只有拿不准时才交给LLM判断
+
+每次判断都会记录一条日志（conversation_end_decision），包含判断来源与原因，
+开启 CONVERSATION_END_SHADOW_LLM 后预筛命中时也会调用LLM，记录两者是否一致，用于衡量预筛的准确率
+
+尚未校准的规则列在 CONVERSATION_END_SHADOW_RULES 中（默认 short_reply_streak）：命中时只记录
+（source=shadow），结论仍由LLM给出。数字人格的回复本身就很短（提示词要求10字左右），
+短回复规则还要求回复是纯语气词/附和或带有道别，正常的简短交流不会被判定为敷衍
+"""
+
+import logging
+import os
+import re
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 中英文告别用语
+FAREWELL_PATTERN = re.compile(
+    r"(再见|拜拜|回头聊|下次聊|改天聊|下次再聊|先聊到这|就聊到这|晚安|告辞|先走了|先下了|保重|"
+    r"\bbye\b|\bgoodbye\b|see you|talk (to you )?(later|soon)|good ?night|take care|catch you later|\bttyl\b)",
+    re.IGNORECASE
+)
+QUESTION_PATTERN = re.compile(r"[?？]\s*$")
+# 没有实际内容的语气词、附和
+LOW_CONTENT_PATTERN = re.compile(
+    r"^(嗯+|哦+|噢+|喔+|啊+|哈+|呵+|嘿+|额+|呃+|好+的?|好吧|行吧?|可以|是的?|对+|没错|"
+    r"ok|okay|k+|yes|yeah|yep|sure|lol|ha(ha)+|hmm+|emm+)[\s。.!！~～…,，]*$",
+    re.IGNORECASE
+)
+
+class ConversationEndHeuristic:
+    def __init__(self):
+        self.short_reply_chars = int(os.getenv("CONVERSATION_END_SHORT_REPLY_CHARS", 6))  # 视为敷衍回复的最大长度
+        self.short_reply_streak = int(os.getenv("CONVERSATION_END_SHORT_REPLY_STREAK", 3))  # 连续短回复条数
+        self.repeat_similarity = float(os.getenv("CONVERSATION_END_REPEAT_SIMILARITY", 0.85))  # 判定为重复的相似度
+        self.shadow_llm = os.getenv("CONVERSATION_END_SHADOW_LLM", "false").lower() == "true"
+        # 只记录、不生效的规则
+        self.shadow_rules = {
+            rule.strip() for rule in os.getenv("CONVERSATION_END_SHADOW_RULES", "short_reply_streak").split(",")
+            if rule.strip()
+        }
+
+    def classify(self, conversation_context: List[Dict[str, str]]) -> Tuple[Optional[bool], str]:
+        """
+        返回 (结论, 原因)
+        结论为 True/False 表示可以直接判定，None 表示需要LLM判断
+        """
+        contents = [msg["content"].strip() for msg in conversation_context]
+        last = contents[-1]
+
+        # 双方都已道别
+        if FAREWELL_PATTERN.search(last) and FAREWELL_PATTERN.search(contents[-2]):
+            return True, "mutual_farewell"
+
+        # 双方在重复之前说过的话
+        if len(contents) >= 4 and all(
+            self._similar(contents[-i], contents[-i - 2]) for i in (1, 2)
+        ):
+            return True, "repetition_loop"
+
+        # 连续的敷衍短回复：都很短，且都是语气词/附和或其中有人道别
+        streak = contents[-self.short_reply_streak:]
+        if (
+            len(streak) == self.short_reply_streak
+            and all(len(c) <= self.short_reply_chars for c in streak)
+            and (all(LOW_CONTENT_PATTERN.match(c) for c in streak) or any(FAREWELL_PATTERN.search(c) for c in streak))
+        ):
+            return True, "short_reply_streak"
+
+        # 对方刚提出问题且没有道别，对话显然还会继续
+        if QUESTION_PATTERN.search(last) and not FAREWELL_PATTERN.search(last):
+            return False, "open_question"
+
+        return None, "uncertain"
+
+    def is_shadow(self, reason: str) -> bool:
+        """该规则是否只记录、不生效"""
+        return reason in self.shadow_rules
+
+    def _similar(self, a: str, b: str) -> bool:
+        return a == b or SequenceMatcher(None, a, b).ratio() >= self.repeat_similarity
+
+    def log_decision(
+        self,
+        conversation_id: Optional[str],
+        turn: int,
+        source: str,
+        reason: str,
+        decision: bool,
+        llm_decision: Optional[bool] = None
+    ):
+        """记录一次结束判断，source 为 heuristic、shadow（规则命中但以LLM结论为准）或 llm"""
+        logger.info(
+            "conversation_end_decision conversation=%s turn=%d source=%s reason=%s decision=%s llm_decision=%s agree=%s",
+            conversation_id,
+            turn,
+            source,
+            reason,
+            decision,
+            llm_decision,
+            None if llm_decision is None else llm_decision == decision
+        )
+
+# 全局结束判断预筛实例
+conversation_end_heuristic = ConversationEndHeuristic()
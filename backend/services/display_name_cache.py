@@ -0,0 +1,64 @@
+"""
+用户显示名称缓存
+聊天记录、实时消息等需要批量展示发送者名称的地方共用，避免逐条查询用户表
+
+- 未命中的用户通过一次 IN 查询批量加载
+- 条目按 USER_NAME_CACHE_TTL（秒）过期
+- 用户名被修改时（User.username 赋值）自动失效
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.database import User
+
+class DisplayNameCache:
+    def __init__(self):
+        self.ttl = float(os.getenv("USER_NAME_CACHE_TTL", 300))
+        self.max_entries = int(os.getenv("USER_NAME_CACHE_SIZE", 10000))
+        # {user_id: (显示名称, 过期时间)}，按写入顺序淘汰
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def get_display_names(self, db: Session, user_ids: Iterable[str]) -> Dict[str, str]:
+        """返回 {user_id: 显示名称}，不存在的用户不包含在结果中"""
+        now = time.monotonic()
+        names: Dict[str, str] = {}
+        missing = set()
+
+        for user_id in set(user_ids):
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > now:
+                names[user_id] = entry[0]
+            else:
+                missing.add(user_id)
+
+        if missing:
+            rows = db.query(User.id, User.username).filter(User.id.in_(missing)).all()
+            for user_id, username in rows:
+                names[user_id] = username
+                self._set(user_id, username, now)
+
+        return names
+
+    def invalidate(self, user_id: str):
+        """使指定用户的缓存失效"""
+        self._entries.pop(user_id, None)
+
+    def _set(self, user_id: str, name: str, now: float):
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (name, now + self.ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+# 全局显示名称缓存实例
+display_name_cache = DisplayNameCache()
+
+@event.listens_for(User.username, "set")
+def _invalidate_on_username_change(target, value, oldvalue, initiator):
+    if target.id:
+        display_name_cache.invalidate(target.id)
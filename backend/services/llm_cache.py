@@ -0,0 +1,146 @@
+"""
+LLM响应缓存
+对确定性（低温度）的模型调用按内容寻址缓存，任务重试或重复评估时不再重复付费
+
+- 键为 (provider, model, messages, temperature, max_tokens) 的SHA-256
+- 内存层：LRU淘汰 + TTL过期
+- 可选的磁盘层：设置 LLM_CACHE_PATH 后写入本地SQLite文件，进程重启后仍可命中
+- 默认只缓存温度不高于 LLM_CACHE_MAX_TEMPERATURE 的调用
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+class LLMResponseCache:
+    def __init__(self):
+        self.enabled = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+        self.max_entries = int(os.getenv("LLM_CACHE_SIZE", 1000))
+        self.ttl = float(os.getenv("LLM_CACHE_TTL", 3600))  # 秒
+        self.max_temperature = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", 0.3))
+        self.disk_path = os.getenv("LLM_CACHE_PATH")
+
+        # {key: (响应内容, 过期时间)}
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        if self.enabled and self.disk_path:
+            self._open_disk()
+
+    def _open_disk(self):
+        try:
+            self._disk = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._disk.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+            self._disk.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ LLM磁盘缓存不可用，仅使用内存缓存: {e}")
+            self._disk = None
+
+    def should_cache(self, temperature: float) -> bool:
+        """温度足够低的调用结果才视为可复用"""
+        return self.enabled and temperature <= self.max_temperature
+
+    @staticmethod
+    def make_key(
+        provider: str,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: Optional[int] = None
+    ) -> str:
+        payload = json.dumps(
+            {
+                "provider": provider,
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens
+            },
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+
+        entry = self._memory.get(key)
+        if entry:
+            if entry[1] > now:
+                self._memory.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[0]
+            del self._memory[key]
+
+        if self._disk is not None:
+            try:
+                with self._disk_lock:
+                    row = self._disk.execute(
+                        "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                print(f"⚠️ 读取LLM磁盘缓存失败: {e}")
+                row = None
+            if row and row[1] > now:
+                self._set_memory(key, row[0], row[1])
+                self._stats["disk_hits"] += 1
+                return row[0]
+
+        self._stats["misses"] += 1
+        return None
+
+    def set(self, key: str, value: str):
+        expires_at = time.time() + self.ttl
+        self._set_memory(key, value, expires_at)
+        self._stats["stores"] += 1
+
+        if self._disk is not None:
+            try:
+                with self._disk_lock:
+                    self._disk.execute(
+                        "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, value, expires_at)
+                    )
+                    self._disk.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ 写入LLM磁盘缓存失败: {e}")
+
+    def _set_memory(self, key: str, value: str, expires_at: float):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        """清空所有缓存"""
+        self._memory.clear()
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.execute("DELETE FROM llm_cache")
+                self._disk.commit()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """命中/未命中计数"""
+        lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round((self._stats["hits"] + self._stats["disk_hits"]) / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_enabled": self._disk is not None
+        }
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
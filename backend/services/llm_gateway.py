@@ -0,0 +1,182 @@
+"""
+LLM调用网关
+所有模型调用（OpenAI与Dify）统一经过这里，进程内共享限流状态
+
+- 按服务商、按模型分别限制并发
+- 按模型的每分钟请求数（RPM）与每分钟token数（TPM）令牌桶
+- 429 / 5xx / 连接错误按带抖动的指数退避重试，优先遵循服务端的 Retry-After
+- 优先级通道：交互请求（默认）优先于后台请求（自动对话等），
+  并为交互请求预留部分并发名额，后台负载再高也不会拖慢聊天
+"""
+
+import asyncio
+import contextlib
+import os
+import random
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+import openai
+
+from services.rate_limit import PrioritySemaphore, TokenBucket
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# 当前调用链所属的优先级通道，后台任务入口处切换为 BACKGROUND
+_current_lane: ContextVar[int] = ContextVar("llm_lane", default=INTERACTIVE)
+
+class ProviderHTTPError(Exception):
+    """服务商返回的HTTP错误（用于非OpenAI SDK的调用，如Dify）"""
+
+    def __init__(self, status_code: int, message: str, retry_after: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class LLMGateway:
+    def __init__(self):
+        self.provider_concurrency = int(os.getenv("LLM_PROVIDER_CONCURRENCY", 16))  # 每个服务商的最大并发
+        self.model_concurrency = int(os.getenv("LLM_MODEL_CONCURRENCY", 8))  # 每个模型的最大并发
+        self.interactive_reserved = int(os.getenv("LLM_INTERACTIVE_RESERVED", 2))  # 为交互请求预留的并发名额
+        self.rpm = int(os.getenv("LLM_RPM", 0))  # 每个模型每分钟请求数，0表示不限制
+        self.tpm = int(os.getenv("LLM_TPM", 0))  # 每个模型每分钟token数，0表示不限制
+        self.max_retries = int(os.getenv("LLM_MAX_RETRIES", 3))
+        self.retry_base_delay = float(os.getenv("LLM_RETRY_BASE_DELAY", 0.5))  # 退避基数（秒）
+        self.retry_max_delay = float(os.getenv("LLM_RETRY_MAX_DELAY", 20))  # 单次退避上限（秒）
+
+        self._provider_limits: Dict[str, PrioritySemaphore] = {}
+        self._model_limits: Dict[Tuple[str, str], PrioritySemaphore] = {}
+        self._request_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._token_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0}
+
+    @contextlib.contextmanager
+    def lane(self, priority: int):
+        """在该上下文内发起的模型调用使用指定优先级通道"""
+        token = _current_lane.set(priority)
+        try:
+            yield
+        finally:
+            _current_lane.reset(token)
+
+    def _limits_for(self, provider: str, model: str):
+        key = (provider, model)
+        if provider not in self._provider_limits:
+            self._provider_limits[provider] = PrioritySemaphore(self.provider_concurrency, self.interactive_reserved)
+        if key not in self._model_limits:
+            self._model_limits[key] = PrioritySemaphore(self.model_concurrency, self.interactive_reserved)
+            if self.rpm > 0:
+                self._request_buckets[key] = TokenBucket(rate=self.rpm / 60, capacity=self.rpm)
+            if self.tpm > 0:
+                self._token_buckets[key] = TokenBucket(rate=self.tpm / 60, capacity=self.tpm)
+        return (
+            self._provider_limits[provider],
+            self._model_limits[key],
+            self._request_buckets.get(key),
+            self._token_buckets.get(key)
+        )
+
+    @contextlib.asynccontextmanager
+    async def slot(self, provider: str, model: str, estimated_tokens: int = 0):
+        """
+        占用一次调用名额（并发 + RPM/TPM），流式调用在整个流期间持有
+        """
+        priority = _current_lane.get()
+        provider_limit, model_limit, request_bucket, token_bucket = self._limits_for(provider, model)
+
+        await model_limit.acquire(priority)
+        try:
+            await provider_limit.acquire(priority)
+            try:
+                if request_bucket is not None:
+                    await request_bucket.acquire()
+                if token_bucket is not None and estimated_tokens > 0:
+                    await token_bucket.acquire(estimated_tokens)
+                self._stats["requests"] += 1
+                yield
+            finally:
+                provider_limit.release()
+        finally:
+            model_limit.release()
+
+    async def with_retry(self, request_fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行请求，可重试的错误按带抖动的指数退避重试"""
+        attempt = 0
+        while True:
+            try:
+                return await request_fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self._stats["failures"] += 1
+                    raise
+                attempt += 1
+                self._stats["retries"] += 1
+                print(f"⚠️ LLM调用失败，{delay:.1f}秒后第{attempt}次重试: {e}")
+                await asyncio.sleep(delay)
+
+    async def call(
+        self,
+        provider: str,
+        model: str,
+        request_fn: Callable[[], Awaitable[Any]],
+        estimated_tokens: int = 0
+    ) -> Any:
+        """在限流名额内执行一次请求，失败重试时先释放名额再退避"""
+        async def attempt():
+            async with self.slot(provider, model, estimated_tokens):
+                return await request_fn()
+
+        return await self.with_retry(attempt)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """返回重试前的等待秒数，不应重试时返回None"""
+        if attempt >= self.max_retries:
+            return None
+
+        status_code = getattr(error, "status_code", None)
+        if status_code is not None:
+            if status_code != 429 and status_code < 500:
+                return None
+            if status_code == 429:
+                self._stats["rate_limited"] += 1
+        elif not isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+            return None
+
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.retry_max_delay)
+
+        # 全抖动：在 [0, base * 2^attempt] 内随机，避免多个请求同时重试
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        value = getattr(error, "retry_after", None)
+        if value is None:
+            response = getattr(error, "response", None)
+            headers = getattr(response, "headers", None)
+            value = headers.get("retry-after") if headers is not None else None
+        try:
+            return float(value) if value is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """网关状态：各服务商/模型的并发占用与排队数"""
+        return {
+            **self._stats,
+            "providers": {
+                provider: {"in_flight": limit.in_use, "waiting": limit.waiting}
+                for provider, limit in self._provider_limits.items()
+            },
+            "models": {
+                f"{provider}:{model}": {"in_flight": limit.in_use, "waiting": limit.waiting}
+                for (provider, model), limit in self._model_limits.items()
+            }
+        }
+
+# 全局LLM网关实例
+llm_gateway = LLMGateway()
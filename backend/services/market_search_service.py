@@ -0,0 +1,214 @@
+"""
+情感匹配市场的检索
+按市场类型、标签筛选，按显示名称/描述全文检索，结果使用游标分页
+
+- 标签：market_agent_tags 倒排表，(tag, market_type, last_interaction) 索引可直接按时间顺序读取前K条
+- 全文检索：按三字切分（trigram）建索引，中文无需分词也能做子串匹配；
+  SQLite 使用 FTS5（market_agents_fts，bm25 排序，名称权重更高），PostgreSQL 使用 pg_trgm（GIN 索引，word_similarity 排序）。
+  短于3个字符的检索词无法走三字索引，作为附加的 LIKE 条件；数据库不支持时整体退化为 LIKE
+- 无检索词时按最近活跃时间排序，游标键为 (last_interaction, id)；有检索词时按相关度排序，游标键为 (rank, id)。
+  相关度需逐条计算，命中过多时只对最近投放的 MARKET_SEARCH_MAX_CANDIDATES 条排序
+
+索引均由迁移 0006_market_search 创建（PostgreSQL 全文索引的表达式由 0008 更新）。SQLite 的 FTS5 表经
+market_agent_search_keys 的整数主键关联到 market_agents（0009），VACUUM 不影响关联。
+"""
+
+import os
+import re
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import Float, Integer, and_, column, exists, func, literal, literal_column, or_, select, table, text
+from sqlalchemy.orm import Session, aliased
+
+from models.database import MarketAgent, MarketAgentTag
+
+# FTS5 trigram 分词器的最小可检索长度
+TRIGRAM_MIN_LENGTH = 3
+
+def _contains_pattern(term: str) -> str:
+    """子串匹配的 LIKE 模式，转义通配符"""
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+class MarketSearchService:
+    def __init__(self):
+        self.max_tags = int(os.getenv("MARKET_MAX_TAGS", 10))  # 每个数字人格最多索引的标签数
+        self.max_candidates = int(os.getenv("MARKET_SEARCH_MAX_CANDIDATES", 2000))  # 按相关度排序的最大命中数
+        self.max_tag_length = 50  # 与 market_agent_tags.tag 列长度一致
+        self._text_index_available: Optional[bool] = None  # 首次检索时探测
+
+    # ---------- 标签 ----------
+
+    def normalize_tag(self, tag: str) -> str:
+        """标签的检索键：去除首尾空白、合并连续空白、转小写"""
+        return re.sub(r"\s+", " ", str(tag)).strip().lower()[:self.max_tag_length]
+
+    def clean_tags(self, tags: Optional[Iterable[str]]) -> List[str]:
+        """展示用的标签：去除空标签和（规范化后）重复的标签，最多保留 max_tags 个"""
+        result, seen = [], set()
+        for tag in tags or []:
+            display = re.sub(r"\s+", " ", str(tag)).strip()[:self.max_tag_length]
+            key = self.normalize_tag(display)
+            if key and key not in seen:
+                seen.add(key)
+                result.append(display)
+            if len(result) >= self.max_tags:
+                break
+        return result
+
+    def sync_tags(self, db: Session, agent: MarketAgent):
+        """
+        按 agent.tags 重建该数字人格的标签索引行（不提交）
+        修改 tags、is_active、market_type 或 last_interaction 后都需要调用
+        """
+        if agent.id is None:
+            db.flush()
+
+        db.query(MarketAgentTag).filter(
+            MarketAgentTag.market_agent_id == agent.id
+        ).delete(synchronize_session=False)
+
+        if not agent.is_active:
+            return
+
+        last_interaction = agent.last_interaction or datetime.utcnow()
+        keys = dict.fromkeys(self.normalize_tag(tag) for tag in agent.tag_list)
+        db.add_all([
+            MarketAgentTag(
+                market_agent_id=agent.id,
+                tag=key,
+                market_type=agent.market_type,
+                last_interaction=last_interaction
+            )
+            for key in keys if key
+        ])
+
+    # ---------- 检索 ----------
+
+    def search(
+        self,
+        db: Session,
+        market_type: Optional[str] = None,
+        exclude_user_id: Optional[str] = None,
+        query: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        limit: int = 50,
+        after: Optional[Tuple] = None
+    ) -> List[Tuple[MarketAgent, Optional[float]]]:
+        """
+        检索市场中的数字人格，返回 [(agent, rank)]
+
+        Args:
+            query: 检索词，按空白拆分，所有词都需出现在名称或描述中
+            tags: 标签筛选，需同时具有全部标签
+            after: 上一页最后一条的游标键；有检索词时为 (rank, id)，否则为 (last_interaction, id)
+        Returns:
+            rank 为相关度（越小越相关），没有使用全文索引排序时为 None
+        """
+        terms = (query or "").split()
+        tag_keys = list(dict.fromkeys(k for k in (self.normalize_tag(t) for t in tags or []) if k))
+
+        ranked_terms = []
+        if terms and self._has_text_index(db):
+            ranked_terms = [t for t in terms if len(t) >= TRIGRAM_MIN_LENGTH]
+        like_terms = [t for t in terms if t not in ranked_terms]
+
+        filters = [MarketAgent.is_active == True]
+        if market_type:
+            filters.append(MarketAgent.market_type == market_type)
+        if exclude_user_id:
+            filters.append(MarketAgent.user_id != exclude_user_id)
+        for term in like_terms:
+            pattern = _contains_pattern(term)
+            filters.append(or_(
+                MarketAgent.display_name.ilike(pattern, escape="\\"),
+                MarketAgent.display_description.ilike(pattern, escape="\\")
+            ))
+
+        if ranked_terms:
+            candidates = self._ranked_candidates(db, ranked_terms, filters + self._tag_filters(tag_keys))
+            rank = candidates.c.search_rank
+            q = db.query(MarketAgent, rank).join(candidates, candidates.c.id == MarketAgent.id)
+            if after is not None:
+                last_rank, last_id = after
+                q = q.filter(or_(rank > last_rank, and_(rank == last_rank, MarketAgent.id > last_id)))
+            q = q.order_by(rank, MarketAgent.id)
+        elif tag_keys:
+            # 从第一个标签的倒排行出发，按冗余的 last_interaction 顺序读取
+            entry = aliased(MarketAgentTag)
+            q = db.query(MarketAgent, literal(None, Float)).join(
+                entry, entry.market_agent_id == MarketAgent.id
+            ).filter(entry.tag == tag_keys[0], *filters, *self._tag_filters(tag_keys[1:]))
+            if market_type:
+                q = q.filter(entry.market_type == market_type)
+            if after is not None:
+                last_interaction, last_id = after
+                q = q.filter(or_(
+                    entry.last_interaction < last_interaction,
+                    and_(entry.last_interaction == last_interaction, entry.market_agent_id < last_id)
+                ))
+            q = q.order_by(entry.last_interaction.desc(), entry.market_agent_id.desc())
+        else:
+            q = db.query(MarketAgent, literal(None, Float)).filter(*filters)
+            if after is not None:
+                last_interaction, last_id = after
+                q = q.filter(or_(
+                    MarketAgent.last_interaction < last_interaction,
+                    and_(MarketAgent.last_interaction == last_interaction, MarketAgent.id < last_id)
+                ))
+            q = q.order_by(MarketAgent.last_interaction.desc(), MarketAgent.id.desc())
+
+        return [(agent, rank) for agent, rank in q.limit(limit).all()]
+
+    def _ranked_candidates(self, db: Session, terms: List[str], filters: list):
+        """
+        全文索引命中且满足筛选条件的候选集 (id, search_rank)
+        相关度需要逐条计算，宽泛的检索词可能命中大量数字人格，只对最近投放的 max_candidates 条排序
+        """
+        if db.bind.dialect.name == "sqlite":
+            # 每个词作为短语检索，多个词之间为 AND；rank 为 bm25（越小越相关）
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            fts = table("market_agents_fts", column("rowid", Integer), column("rank", Float))
+            keys = table("market_agent_search_keys", column("id", Integer), column("market_agent_id"))
+            return select(MarketAgent.id, fts.c.rank.label("search_rank")).select_from(
+                fts.join(keys, keys.c.id == fts.c.rowid)
+                .join(MarketAgent.__table__, MarketAgent.id == keys.c.market_agent_id)
+            ).where(
+                literal_column("market_agents_fts").op("MATCH")(match), *filters
+            ).order_by(fts.c.rowid.desc()).limit(self.max_candidates).subquery("candidates")
+
+        # 与迁移中 GIN 索引的表达式保持一致，否则 ILIKE 无法使用索引；描述为 NULL 时整个拼接结果也会是 NULL
+        document = literal_column(
+            "(market_agents.display_name || ' ' || coalesce(market_agents.display_description, ''))"
+        )
+        return select(
+            MarketAgent.id, (-func.word_similarity(" ".join(terms), document)).label("search_rank")
+        ).where(
+            *[document.ilike(_contains_pattern(term), escape="\\") for term in terms], *filters
+        ).order_by(
+            MarketAgent.last_interaction.desc(), MarketAgent.id.desc()
+        ).limit(self.max_candidates).subquery("candidates")
+
+    def _tag_filters(self, tag_keys: List[str]) -> list:
+        filters = []
+        for key in tag_keys:
+            entry = aliased(MarketAgentTag)
+            filters.append(exists().where(and_(entry.market_agent_id == MarketAgent.id, entry.tag == key)))
+        return filters
+
+    def _has_text_index(self, db: Session) -> bool:
+        """数据库是否已建全文索引（SQLite 需支持 FTS5，PostgreSQL 需安装 pg_trgm）"""
+        if self._text_index_available is None:
+            if db.bind.dialect.name == "sqlite":
+                sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'market_agents_fts'"
+            elif db.bind.dialect.name == "postgresql":
+                sql = "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+            else:
+                sql = None
+            self._text_index_available = bool(sql and db.execute(text(sql)).first())
+            if not self._text_index_available:
+                print("⚠️ 市场全文索引不可用，检索将退化为 LIKE 匹配（请运行 python migrate.py upgrade）")
+        return self._text_index_available
+
+# 全局市场检索实例
+market_search_service = MarketSearchService()
@@ -3,23 +3,43 @@
 处理数字人格匹配、自动对话、匹配度评估等功能
 """
 
+import asyncio
 import json
+import math
+import os
 import random
 from datetime import datetime, timedelta
 from shutil import ExecError
 from typing import List, Dict, Any, Tuple, Optional
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_, case
+from sqlalchemy.orm import Session, aliased, joinedload
+from sqlalchemy import func, and_, or_, case, exists
 
 from models.database import (
     MarketAgent, MatchRelation, AutoConversation, AutoConversationMessage,
-    MatchEvaluation, DigitalPersona, Scenario, User
+    MatchEvaluation, DigitalPersona, Scenario, User, ChatSession, RealTimeMessage, TaskJob
 )
 from services.ai_service import AIService
+from services.conversation_end_detector import conversation_end_heuristic
+from services.market_search_service import market_search_service
+from services.task_service import TaskStatus
+
+# claim_scheduled_conversation 的结果
+CLAIM_CLAIMED = "claimed"
+CLAIM_EXTENDED = "extended"
+CLAIM_SKIPPED = "skipped"
+
+# 匹配度评估模式：batch（整段对话一次评估）或 per_message（逐条评估）
+EVALUATION_MODES = ("batch", "per_message")
+DEFAULT_EVALUATION_MODE = "batch"
 
 class MatchService:
     def __init__(self, ai_service: AIService):
         self.ai_service = ai_service
+        self.evaluation_mode = os.getenv("MATCH_EVALUATION_MODE", DEFAULT_EVALUATION_MODE).strip().lower()
+        if self.evaluation_mode not in EVALUATION_MODES:
+            print(f"⚠️ 未知的 MATCH_EVALUATION_MODE={self.evaluation_mode!r}（可选 {'/'.join(EVALUATION_MODES)}），"
+                  f"使用默认的 {DEFAULT_EVALUATION_MODE}")
+            self.evaluation_mode = DEFAULT_EVALUATION_MODE
 
     async def evaluate_message_compatibility(
         self,
@@ -73,17 +93,14 @@ class MatchService:
 
         try:
             # 调用AI进行评估
-            response = self.ai_service.client.chat.completions.create(
-                model=self.ai_service.model,
-                messages=[
+            result_text = await self.ai_service.complete(
+                [
                     {"role": "system", "content": "你是专业的情感关系分析师，专门评估数字人格之间的匹配度。"},
                     {"role": "user", "content": evaluation_prompt}
                 ],
                 temperature=0.3
             )
             
-            result_text = response.choices[0].message.content
-            
             # 解析JSON结果
             try:
                 result = json.loads(result_text)
@@ -105,16 +122,175 @@ class MatchService:
             print(f"匹配度评估失败: {e}")
             return 0.0, 0.0, f"评估失败: {str(e)}"
 
+    async def evaluate_conversation_compatibility(
+        self,
+        conversation_context: List[Dict[str, str]],
+        agent1: MarketAgent,
+        agent2: MarketAgent,
+        match_type: str = "love"
+    ) -> List[Tuple[float, float, str]]:
+        """
+        一次性评估整段对话中每条消息的匹配度影响
+        返回: 与conversation_context一一对应的 (恋爱匹配度变化, 友谊匹配度变化, 评估原因) 列表
+        """
+        if not conversation_context:
+            return []
+
+        messages_text = "\n".join(
+            f"[{index}] {msg['sender']}: {msg['content']}"
+            for index, msg in enumerate(conversation_context)
+        )
+
+        evaluation_prompt = f"""
+你是一个专业的情感关系分析师。请逐条分析以下完整对话中每条消息对两个数字人格之间匹配度的影响。
+
+人格A信息:
+名称: {agent1.display_name}
+描述: {agent1.display_description}
+
+人格B信息:
+名称: {agent2.display_name}
+描述: {agent2.display_description}
+
+完整对话（方括号内为消息序号）:
+{messages_text}
+
+请从以下维度分析每条消息的影响:
+1. 情感共鸣程度
+2. 价值观契合度
+3. 交流舒适度
+4. 话题兴趣匹配
+5. 人格互补性
+
+基于分析，为每条消息给出匹配度分数变化:
+- 恋爱匹配度变化: -1到+1的浮点数 (负数表示降低，正数表示提高)
+- 友谊匹配度变化: -1到+1的浮点数
+
+请用以下JSON格式回复，evaluations中必须包含全部{len(conversation_context)}条消息:
+{{
+    "evaluations": [
+        {{
+            "index": 消息序号,
+            "love_score_delta": 浮点数,
+            "friendship_score_delta": 浮点数,
+            "analysis": "该条消息的分析原因"
+        }}
+    ]
+}}
+"""
+
+        results = [(0.0, 0.0, "评估解析失败")] * len(conversation_context)
+
+        try:
+            # 调用AI进行评估
+            result_text = await self.ai_service.complete(
+                [
+                    {"role": "system", "content": "你是专业的情感关系分析师，专门评估数字人格之间的匹配度。"},
+                    {"role": "user", "content": evaluation_prompt}
+                ],
+                temperature=0.3
+            )
+
+            # 解析JSON结果；缺失或无效的条目保留默认值，不影响其他条目
+            try:
+                evaluations = json.loads(result_text).get("evaluations", [])
+            except (json.JSONDecodeError, AttributeError):
+                # 如果JSON解析失败，返回默认值
+                return results
+
+            if not isinstance(evaluations, list):
+                return results
+
+            for item in evaluations:
+                try:
+                    index = int(item.get("index", -1))
+                    love_delta = float(item.get("love_score_delta", 0))
+                    friendship_delta = float(item.get("friendship_score_delta", 0))
+                except (ValueError, TypeError, AttributeError):
+                    continue
+                if not 0 <= index < len(results):
+                    continue
+                if not (math.isfinite(love_delta) and math.isfinite(friendship_delta)):
+                    continue
+
+                analysis = item.get("analysis", "无分析说明")
+
+                # 限制分数变化范围
+                love_delta = max(-10, min(10, love_delta))
+                friendship_delta = max(-10, min(10, friendship_delta))
+
+                results[index] = (love_delta, friendship_delta, analysis)
+
+            return results
+
+        except Exception as e:
+            print(f"批量匹配度评估失败: {e}")
+            return [(0.0, 0.0, f"评估失败: {str(e)}")] * len(conversation_context)
+
+    async def _generate_turn_reply(
+        self,
+        scenario: Scenario,
+        sender: MarketAgent,
+        receiver: MarketAgent,
+        sender_persona: DigitalPersona,
+        conversation_context: List[Dict[str, str]]
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        生成自动对话中某一轮发言者的回复
+        """
+        # 构建对话上下文
+        context_messages = [
+            {"sender_type": "system", "content": f"场景: {scenario.name}\n{scenario.context}"},
+            {"sender_type": "system", "content": f"对话对象: {receiver.display_name}"}
+        ]
+        
+        # 添加历史对话（仅当有历史记录时）
+        if conversation_context:
+            # 只保留最近6条消息，但不包括最后一条（避免重复）
+            for msg in conversation_context[-6:]:
+                context_messages.append({
+                    "sender_type": "user" if msg["sender"] == sender.display_name else "assistant",
+                    "content": msg["content"]
+                })
+        
+        # 准备用户消息（第一轮对话时使用场景描述作为开场）
+        if conversation_context:
+            user_message = conversation_context[-1]["content"]
+        else:
+            # 第一轮对话时，使用场景描述作为开场提示
+            user_message = f"请根据场景'{scenario.name}'开始一段自然的对话。"
+        
+        return await self.ai_service.generate_agent_response(
+            system_prompt=sender_persona.system_prompt,
+            conversation_history=context_messages,
+            scenario_context=scenario.context,
+            user_message=user_message,
+            # user_id=sender.user_id
+        )
+
     async def conduct_auto_conversation(
         self,
         match_relation: MatchRelation,
         scenario: Scenario,
         max_turns: int = 10,
-        db: Session = None
+        db: Session = None,
+        pipelined: bool = True,
+        evaluation_mode: Optional[str] = None
     ) -> AutoConversation:
         """
         执行一轮自动对话
+        
+        pipelined为True时，第N轮的匹配度评估和结束判断与第N+1轮的回复生成并发执行，
+        评估结果在对话结束后统一汇总写入；为False时逐步串行执行。两种模式保存的消息、结束轮次和评估结果相同。
+        流水线模式下对话自然结束时，预先生成的下一轮回复被取消并丢弃：不保存、不计入 actual_turns、不参与评估；
+        若请求已发给模型，这次调用的token消耗仍会产生（每轮自动对话最多一条回复），并计入网关的请求数。
+        evaluation_mode为"batch"时在对话结束后一次性评估全部消息，
+        为"per_message"时逐条评估；默认取MATCH_EVALUATION_MODE环境变量。
         """
+        evaluation_mode = evaluation_mode or self.evaluation_mode
+        if evaluation_mode not in EVALUATION_MODES:
+            # 未知模式会导致不产生任何评估结果，直接报错而不是静默记为0分
+            raise ValueError(f"未知的匹配度评估模式: {evaluation_mode}")
         
         # 创建自动对话记录
         auto_conv = AutoConversation(
@@ -128,12 +304,17 @@ class MatchService:
         db.commit()
         db.refresh(auto_conv)
         
+        # 流水线模式下尚未完成的后台任务，出错时需要取消
+        pending_tasks: List[asyncio.Task] = []
+        
         try:
             # 获取两个agent的数字人格
             agent1 = match_relation.initiator_agent
             agent2 = match_relation.target_agent
-            persona1 = agent1.digital_persona
-            persona2 = agent2.digital_persona
+            personas = {
+                agent1.id: agent1.digital_persona,
+                agent2.id: agent2.digital_persona
+            }
             
             conversation_context = []
             total_love_score = 0.0
@@ -143,42 +324,38 @@ class MatchService:
             current_sender = agent1 if random.choice([True, False]) else agent2
             current_receiver = agent2 if current_sender == agent1 else agent1
             
+            # 已保存的消息及其对应的评估结果（按顺序一一对应）
+            saved_messages: List[AutoConversationMessage] = []
+            evaluation_results: List[Tuple[float, float, str]] = []
+            
+            # 流水线模式：各轮的评估任务，以及上一轮的结束判断任务
+            evaluation_tasks: List[asyncio.Task] = []
+            end_check_task: Optional[asyncio.Task] = None
+            
             for turn in range(max_turns):
-                # 构建对话上下文
-                context_messages = [
-                    {"sender_type": "system", "content": f"场景: {scenario.name}\n{scenario.context}"},
-                    {"sender_type": "system", "content": f"对话对象: {current_receiver.display_name}"}
-                ]
+                sender_persona = personas[current_sender.id]
                 
-                # 生成AI回复
-                if current_sender == agent1:
-                    sender_persona = persona1
+                if pipelined:
+                    # 生成本轮回复的同时等待上一轮的结束判断
+                    reply_task = asyncio.create_task(self._generate_turn_reply(
+                        scenario, current_sender, current_receiver, sender_persona, conversation_context
+                    ))
+                    pending_tasks.append(reply_task)
+                    
+                    if end_check_task is not None:
+                        should_end = await end_check_task
+                        end_check_task = None
+                        if should_end:
+                            # 对话已自然结束，丢弃预先生成的回复（已发出的请求仍会计费，见文档说明）
+                            reply_task.cancel()
+                            auto_conv.termination_reason = "natural_end"
+                            break
+                    
+                    response, metadata = await reply_task
                 else:
-                    sender_persona = persona2
-                
-                # 添加历史对话（仅当有历史记录时）
-                if conversation_context:
-                    # 只保留最近6条消息，但不包括最后一条（避免重复）
-                    for msg in conversation_context[-6:]:
-                        context_messages.append({
-                            "sender_type": "user" if msg["sender"] == current_sender.display_name else "assistant",
-                            "content": msg["content"]
-                        })
-                
-                # 准备用户消息（第一轮对话时使用场景描述作为开场）
-                if conversation_context:
-                    user_message = conversation_context[-1]["content"]
-                else:
-                    # 第一轮对话时，使用场景描述作为开场提示
-                    user_message = f"请根据场景'{scenario.name}'开始一段自然的对话。"
-                
-                response, metadata = await self.ai_service.generate_agent_response(
-                    system_prompt=sender_persona.system_prompt,
-                    conversation_history=context_messages,
-                    scenario_context=scenario.context,
-                    user_message=user_message,
-                    # user_id=current_sender.user_id
-                )
+                    response, metadata = await self._generate_turn_reply(
+                        scenario, current_sender, current_receiver, sender_persona, conversation_context
+                    )
                 
                 # 保存消息
                 message = AutoConversationMessage(
@@ -198,16 +375,58 @@ class MatchService:
                     "sender": current_sender.display_name,
                     "content": response
                 })
+                saved_messages.append(message)
                 
-                # 评估匹配度
-                love_delta, friendship_delta, analysis = await self.evaluate_message_compatibility(
-                    message=response,
-                    sender_agent=current_sender,
-                    receiver_agent=current_receiver,
+                if pipelined:
+                    # 评估和结束判断放到后台，不阻塞下一轮回复生成
+                    if evaluation_mode == "per_message":
+                        evaluation_task = asyncio.create_task(self.evaluate_message_compatibility(
+                            message=response,
+                            sender_agent=current_sender,
+                            receiver_agent=current_receiver,
+                            conversation_context=list(conversation_context),
+                            match_type=match_relation.match_type
+                        ))
+                        pending_tasks.append(evaluation_task)
+                        evaluation_tasks.append(evaluation_task)
+                    end_check_task = asyncio.create_task(
+                        self._should_end_conversation(list(conversation_context), scenario, auto_conv.id)
+                    )
+                    pending_tasks.append(end_check_task)
+                elif evaluation_mode == "per_message":
+                    # 评估匹配度
+                    evaluation_results.append(await self.evaluate_message_compatibility(
+                        message=response,
+                        sender_agent=current_sender,
+                        receiver_agent=current_receiver,
+                        conversation_context=conversation_context,
+                        match_type=match_relation.match_type
+                    ))
+                
+                # 交换发言者
+                current_sender, current_receiver = current_receiver, current_sender
+                
+                # 检查对话是否应该自然结束
+                if not pipelined and await self._should_end_conversation(conversation_context, scenario, auto_conv.id):
+                    auto_conv.termination_reason = "natural_end"
+                    break
+            
+            # 最后一轮的结束判断仍需等待，以保持与串行模式一致的终止原因
+            if end_check_task is not None and await end_check_task:
+                auto_conv.termination_reason = "natural_end"
+            
+            # 汇总各轮评估结果
+            if evaluation_mode == "batch":
+                evaluation_results = await self.evaluate_conversation_compatibility(
                     conversation_context=conversation_context,
+                    agent1=agent1,
+                    agent2=agent2,
                     match_type=match_relation.match_type
                 )
-                
+            elif pipelined:
+                evaluation_results = [await task for task in evaluation_tasks]
+            
+            for message, (love_delta, friendship_delta, analysis) in zip(saved_messages, evaluation_results):
                 # 保存评估结果
                 evaluation = MatchEvaluation(
                     auto_conversation_id=auto_conv.id,
@@ -221,14 +440,6 @@ class MatchService:
                 
                 total_love_score += love_delta
                 total_friendship_score += friendship_delta
-                
-                # 交换发言者
-                current_sender, current_receiver = current_receiver, current_sender
-                
-                # 检查对话是否应该自然结束
-                if await self._should_end_conversation(conversation_context, scenario):
-                    auto_conv.termination_reason = "natural_end"
-                    break
             
             # 完成对话
             auto_conv.status = "completed"
@@ -240,21 +451,30 @@ class MatchService:
             if auto_conv.termination_reason is None:
                 auto_conv.termination_reason = "max_turns"
             
-            # 更新匹配关系的总分
-            match_relation.love_compatibility_score += total_love_score
-            match_relation.friendship_compatibility_score += total_friendship_score
-            match_relation.total_interactions += 1
+            # 更新匹配关系的总分（在数据库中原子累加，避免并发对话互相覆盖）
+            new_love_score = MatchRelation.love_compatibility_score + total_love_score
+            new_friendship_score = MatchRelation.friendship_compatibility_score + total_friendship_score
+            match_relation.love_compatibility_score = new_love_score
+            match_relation.friendship_compatibility_score = new_friendship_score
+            match_relation.max_compatibility_score = case(
+                (new_love_score >= new_friendship_score, new_love_score),
+                else_=new_friendship_score
+            )
+            match_relation.total_interactions = MatchRelation.total_interactions + 1
             match_relation.last_conversation_at = datetime.utcnow()
             
-            # 安排下次对话（24-72小时后）
+            # 安排下次对话（24-72小时后），释放调度租约
             next_hours = random.randint(24, 72)
             match_relation.next_scheduled_conversation = datetime.utcnow() + timedelta(hours=next_hours)
+            match_relation.schedule_owner = None
             
             db.commit()
             
             return auto_conv
             
         except Exception as e:
+            for task in pending_tasks:
+                task.cancel()
             auto_conv.status = "failed"
             auto_conv.ended_at = datetime.utcnow()
             auto_conv.termination_reason = f"error: {str(e)}"
@@ -264,14 +484,41 @@ class MatchService:
     async def _should_end_conversation(
         self,
         conversation_context: List[Dict[str, str]],
-        scenario: Scenario
+        scenario: Scenario,
+        conversation_id: Optional[str] = None
     ) -> bool:
         """
         判断对话是否应该自然结束
+        先用本地规则预筛，拿不准时再调用LLM
         """
         if len(conversation_context) < 4:
             return False
         
+        turn = len(conversation_context)
+        decision, reason = conversation_end_heuristic.classify(conversation_context)
+        if decision is not None and conversation_end_heuristic.is_shadow(reason):
+            # 未校准的规则只记录，以LLM的结论为准
+            llm_decision = await self._llm_should_end_conversation(conversation_context, scenario)
+            conversation_end_heuristic.log_decision(conversation_id, turn, "shadow", reason, decision, llm_decision)
+            return llm_decision
+        
+        if decision is None:
+            decision = await self._llm_should_end_conversation(conversation_context, scenario)
+            conversation_end_heuristic.log_decision(conversation_id, turn, "llm", reason, decision)
+            return decision
+        
+        llm_decision = None
+        if conversation_end_heuristic.shadow_llm:
+            llm_decision = await self._llm_should_end_conversation(conversation_context, scenario)
+        conversation_end_heuristic.log_decision(conversation_id, turn, "heuristic", reason, decision, llm_decision)
+        return decision
+
+    async def _llm_should_end_conversation(
+        self,
+        conversation_context: List[Dict[str, str]],
+        scenario: Scenario
+    ) -> bool:
+        """由LLM判断对话是否已经自然结束"""
         # 获取最后几条消息
         recent_messages = conversation_context[-3:]
         messages_text = "\n".join([f"{msg['sender']}: {msg['content']}" for msg in recent_messages])
@@ -289,13 +536,13 @@ class MatchService:
 """
         
         try:
-            response = await self.ai_service.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1
+            content = await self.ai_service.complete(
+                [{"role": "user", "content": prompt}],
+                temperature=0.1,
+                model="gpt-3.5-turbo"
             )
             
-            result = response.choices[0].message.content.strip().upper()
+            result = content.strip().upper()
             return result == "YES"
             
         except Exception:
@@ -317,20 +564,24 @@ class MatchService:
         db: Session,
         market_type: str = None,
         exclude_user_id: str = None,
-        limit: int = 50
-    ) -> List[MarketAgent]:
+        limit: int = 50,
+        query: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        after: Optional[Tuple] = None
+    ) -> List[Tuple[MarketAgent, Optional[float]]]:
         """
-        获取市场中的数字人格列表
+        获取市场中的数字人格列表，返回 [(agent, rank)]
+        无检索词时按最近活跃排序，有检索词时按相关度排序，详见 market_search_service.search
         """
-        query = db.query(MarketAgent).filter(MarketAgent.is_active == True)
-        
-        if market_type:
-            query = query.filter(MarketAgent.market_type == market_type)
-        
-        if exclude_user_id:
-            query = query.filter(MarketAgent.user_id != exclude_user_id)
-        
-        return query.order_by(MarketAgent.last_interaction.desc()).limit(limit).all()
+        return market_search_service.search(
+            db=db,
+            market_type=market_type,
+            exclude_user_id=exclude_user_id,
+            query=query,
+            tags=tags,
+            limit=limit,
+            after=after
+        )
 
     def create_market_agent(
         self,
@@ -359,8 +610,9 @@ class MatchService:
             existing.digital_persona_id = digital_persona_id
             existing.display_name = display_name
             existing.display_description = display_description
-            existing.tags = json.dumps(tags or [], ensure_ascii=False)
+            existing.tags = json.dumps(market_search_service.clean_tags(tags), ensure_ascii=False)
             existing.updated_at = datetime.utcnow()
+            market_search_service.sync_tags(db, existing)
             db.commit()
             return existing
         else:
@@ -371,9 +623,10 @@ class MatchService:
                 market_type=market_type,
                 display_name=display_name,
                 display_description=display_description,
-                tags=json.dumps(tags or [], ensure_ascii=False)
+                tags=json.dumps(market_search_service.clean_tags(tags), ensure_ascii=False)
             )
             db.add(agent)
+            market_search_service.sync_tags(db, agent)
             db.commit()
             db.refresh(agent)
             return agent
@@ -438,15 +691,23 @@ class MatchService:
         self,
         db: Session,
         user_id: str,
-        match_type: str = None
+        match_type: str = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[float, str]] = None
     ) -> List[MatchRelation]:
         """
-        获取用户的匹配关系列表
+        获取用户的匹配关系列表，按匹配度（两项中的较高者）从高到低排序
         只显示用户主动发起的匹配，不包括别人添加该用户agent的匹配
+
+        Args:
+            limit: 只返回前 limit 条（不传则返回全部）
+            after: 上一页最后一条的 (max_compatibility_score, id)，返回排在其后的匹配
         """
         try:
-            # 只查询用户作为发起者的匹配关系
-            query = db.query(MatchRelation).filter(
+            # 只查询用户作为发起者的匹配关系，目标agent一并加载
+            query = db.query(MatchRelation).options(
+                joinedload(MatchRelation.target_agent)
+            ).filter(
                 MatchRelation.initiator_user_id == user_id,
                 MatchRelation.status == "active"
             )
@@ -454,13 +715,19 @@ class MatchService:
             if match_type:
                 query = query.filter(MatchRelation.match_type == match_type)
 
-            # 由于sqlite不支持greatest函数，这里用case表达式实现
-            order_expr = case(
-                (MatchRelation.love_compatibility_score >= MatchRelation.friendship_compatibility_score, MatchRelation.love_compatibility_score),
-                else_=MatchRelation.friendship_compatibility_score
-            ).desc()
+            if after is not None:
+                score, last_id = after
+                query = query.filter(or_(
+                    MatchRelation.max_compatibility_score < score,
+                    and_(MatchRelation.max_compatibility_score == score, MatchRelation.id < last_id)
+                ))
+
+            # max_compatibility_score 随分数一起维护，可直接利用索引按序读取前K条
+            query = query.order_by(MatchRelation.max_compatibility_score.desc(), MatchRelation.id.desc())
+            if limit is not None:
+                query = query.limit(limit)
 
-            return query.order_by(order_expr).all()
+            return query.all()
         except Exception as e:
             print(f"获取匹配关系失败: {e}")
             return []
@@ -495,43 +762,45 @@ class MatchService:
         db: Session,
         user_id: str,
         match_type: str = None
-    ) -> List[MatchRelation]:
+    ) -> List[Tuple[MatchRelation, bool]]:
         """
         获取"关注你的"关系列表
-        返回别人匹配了该用户的agent，但该用户没有反向匹配对方的关系
+        返回别人匹配了该用户的agent，但该用户没有反向匹配对方的关系，
+        以及双方之间是否已有实时聊天消息，即 [(匹配关系, has_realtime_messages)]
+
+        反向匹配的过滤（NOT EXISTS）与聊天消息的检查（EXISTS，经由双方的 ChatSession）
+        都在同一条查询中完成，发起者的agent一并加载，查询次数与关注者数量无关
         """
         try:
-            from sqlalchemy import and_, not_, exists
-            
-            # 查询别人匹配了该用户的agent的关系
-            follower_query = db.query(MatchRelation).filter(
+            reverse = aliased(MatchRelation)
+            reverse_match_exists = exists().where(
+                reverse.initiator_user_id == user_id,
+                reverse.target_user_id == MatchRelation.initiator_user_id,
+                reverse.match_type == MatchRelation.match_type,
+                reverse.status == "active"
+            )
+
+            has_realtime_messages = exists().where(
+                ChatSession.id == RealTimeMessage.chat_session_id,
+                or_(
+                    and_(ChatSession.user1_id == user_id, ChatSession.user2_id == MatchRelation.initiator_user_id),
+                    and_(ChatSession.user1_id == MatchRelation.initiator_user_id, ChatSession.user2_id == user_id)
+                ),
+                RealTimeMessage.is_deleted == False
+            ).label("has_realtime_messages")
+
+            query = db.query(MatchRelation, has_realtime_messages).options(
+                joinedload(MatchRelation.initiator_agent)
+            ).filter(
                 MatchRelation.target_user_id == user_id,
-                MatchRelation.status == "active"
+                MatchRelation.status == "active",
+                ~reverse_match_exists
             )
 
             if match_type:
-                follower_query = follower_query.filter(MatchRelation.match_type == match_type)
+                query = query.filter(MatchRelation.match_type == match_type)
 
-            # 获取所有关注者关系
-            follower_relations = follower_query.all()
-            
-            # 过滤掉用户已经反向匹配的关系
-            filtered_relations = []
-            for relation in follower_relations:
-                # 检查当前用户是否已经匹配了对方
-                reverse_match_exists = db.query(MatchRelation).filter(
-                    and_(
-                        MatchRelation.initiator_user_id == user_id,
-                        MatchRelation.target_user_id == relation.initiator_user_id,
-                        MatchRelation.match_type == relation.match_type,
-                        MatchRelation.status == "active"
-                    )
-                ).first()
-                
-                if not reverse_match_exists:
-                    filtered_relations.append(relation)
-            
-            return filtered_relations
+            return [(relation, bool(has_messages)) for relation, has_messages in query.all()]
             
         except Exception as e:
             print(f"获取关注者关系失败: {e}")
@@ -572,17 +841,108 @@ class MatchService:
             db.rollback()
             raise e
 
-    def get_pending_conversations(self, db: Session) -> List[MatchRelation]:
+    def get_scheduled_conversations(
+        self,
+        db: Session,
+        until: datetime,
+        after: Optional[Tuple[datetime, str]] = None,
+        limit: int = 1000
+    ) -> List[Tuple[str, datetime]]:
         """
-        获取需要触发对话的匹配关系
+        按计划时间顺序获取截至until需要触发对话的匹配关系 (id, 计划时间)
+        after为上一批最后一条的 (计划时间, id)，用于分批增量加载
         """
-        now = datetime.utcnow()
-        return db.query(MatchRelation).filter(
-            and_(
-                MatchRelation.status == "active",
-                MatchRelation.next_scheduled_conversation <= now
+        query = db.query(MatchRelation.id, MatchRelation.next_scheduled_conversation).filter(
+            MatchRelation.status == "active",
+            MatchRelation.next_scheduled_conversation <= until
+        )
+
+        if after:
+            after_time, after_id = after
+            query = query.filter(
+                or_(
+                    MatchRelation.next_scheduled_conversation > after_time,
+                    and_(
+                        MatchRelation.next_scheduled_conversation == after_time,
+                        MatchRelation.id > after_id
+                    )
+                )
             )
-        ).all()
+
+        return query.order_by(
+            MatchRelation.next_scheduled_conversation, MatchRelation.id
+        ).limit(limit).all()
+
+    def claim_scheduled_conversation(
+        self,
+        db: Session,
+        match_id: str,
+        scheduled_at: datetime,
+        task_id: str,
+        lease_until: datetime
+    ) -> str:
+        """
+        原子地领取一次到期的对话计划：将计划时间推迟到lease_until，并把执行该次对话的任务ID记为schedule_owner。
+        条件更新以读到的计划时间为前提，多个调度器实例同时领取时只有一个会成功。
+        对话完成后会重新安排下次时间并清空schedule_owner。
+
+        租约到期时若上一次领取的任务仍在排队、执行或等待重试，则只续租而不重新派发；
+        任务已失败（或不存在）时才由新任务重新领取。
+
+        Returns:
+            CLAIM_CLAIMED 领取成功；CLAIM_EXTENDED 上一次的任务仍在进行，已续租到lease_until；
+            CLAIM_SKIPPED 计划时间已被修改、已被其他实例处理或关系不再活跃
+        """
+        current_owner = db.query(MatchRelation.schedule_owner).filter(
+            MatchRelation.id == match_id
+        ).scalar()
+
+        due = db.query(MatchRelation).filter(
+            MatchRelation.id == match_id,
+            MatchRelation.status == "active",
+            MatchRelation.next_scheduled_conversation == scheduled_at
+        )
+
+        if current_owner and self._is_task_live(db, current_owner):
+            extended = due.filter(MatchRelation.schedule_owner == current_owner).update({
+                "next_scheduled_conversation": lease_until
+            }, synchronize_session=False)
+            db.commit()
+            return CLAIM_EXTENDED if extended == 1 else CLAIM_SKIPPED
+
+        claimed = due.update({
+            "next_scheduled_conversation": lease_until,
+            "schedule_owner": task_id
+        }, synchronize_session=False)
+        db.commit()
+        return CLAIM_CLAIMED if claimed == 1 else CLAIM_SKIPPED
+
+    def start_scheduled_conversation(
+        self,
+        db: Session,
+        match_id: str,
+        task_id: str,
+        lease_until: datetime
+    ) -> bool:
+        """
+        定时对话任务开始执行前确认仍持有领取：schedule_owner 仍为本任务时续租到lease_until。
+        重新领取会改写schedule_owner，因此租约到期后被其他调度器重新派发的旧任务会返回False；
+        租约虽已到期但尚未被重新领取时，本次更新会改变计划时间，使其他调度器基于旧时间的领取失败
+        """
+        started = db.query(MatchRelation).filter(
+            MatchRelation.id == match_id,
+            MatchRelation.status == "active",
+            MatchRelation.schedule_owner == task_id
+        ).update({
+            "next_scheduled_conversation": lease_until
+        }, synchronize_session=False)
+        db.commit()
+        return started == 1
+
+    def _is_task_live(self, db: Session, task_id: str) -> bool:
+        """任务是否仍在排队、执行或等待重试"""
+        status = db.query(TaskJob.status).filter(TaskJob.id == task_id).scalar()
+        return status in (TaskStatus.PENDING.value, TaskStatus.RUNNING.value)
 
 # 创建全局实例
 match_service = MatchService(ai_service=None)  # 在需要时注入ai_service 
\ No newline at end of file
@@ -0,0 +1,239 @@
+"""
+实时聊天消息写缓冲（write-behind）
+
+发送消息时分配ID与序号，消息内容随后由后台任务按固定间隔或攒满一批后
+批量写入 realtime_messages：
+- 序号在 ChatSession.last_sequence_number 上原子分配（UPDATE ... RETURNING，在线程池中执行），
+  与直接写入的消息、其他进程的缓冲共用同一计数器，序号顺序与发送顺序一致。
+  不在进程内预留号段：号段会让各进程的序号交错，与发送顺序不一致。
+  同一会话中并发到达的消息合并为一次分配：上一次分配进行期间排队的消息在下一次 UPDATE 中一起取得连续的序号，
+  突发时每个会话每批只需一次数据库往返；单条消息仍需一次往返（UPDATE + 提交）后才能进入缓冲
+- 序号已分配但尚未刷写的消息在表中表现为序号空洞，按序号轮询新消息时
+  不越过 SEQUENCE_GAP_GRACE 内出现的空洞，避免漏读稍后写入的消息
+- 每次刷写一条批量 INSERT，并按会话合并更新 message_count / last_message_at
+- 批量写入失败时逐条重试，只丢弃确实无法写入的消息
+
+确认模式（CHAT_ACK_MODE）：
+- before_flush: 消息进入缓冲后立即返回，延迟最低，进程崩溃时可能丢失未刷写的消息
+- after_flush: 等待消息所在批次写入数据库后再返回
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, update
+
+from models.database import SessionLocal, ChatSession, RealTimeMessage, generate_uuid
+from services.chat_service import chat_service
+
+logger = logging.getLogger(__name__)
+
+# 序号空洞的等待时长：超过后视为消息已丢失或已删除，轮询不再等待
+SEQUENCE_GAP_GRACE = timedelta(seconds=5)
+
+class MessageWriteBuffer:
+    def __init__(self):
+        # 刷写配置
+        self.flush_interval = float(os.getenv("CHAT_FLUSH_INTERVAL_MS", 20)) / 1000  # 刷写间隔
+        self.batch_size = int(os.getenv("CHAT_FLUSH_BATCH_SIZE", 100))  # 攒满即刷写的消息数
+        self.ack_mode = os.getenv("CHAT_ACK_MODE", "before_flush").lower()
+
+        self.running = False
+        self.flusher_task: Optional[asyncio.Task] = None
+
+        # 待写入的消息及其写入结果
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+
+        # 按会话排队等待分配序号的消息，以及各会话正在进行的分配任务
+        self._sequence_waiters: Dict[str, List[asyncio.Future]] = {}
+        self._allocators: Dict[str, asyncio.Task] = {}
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+
+    async def start(self):
+        """启动后台刷写任务"""
+        if self.running:
+            return
+
+        self.running = True
+        self.flusher_task = asyncio.create_task(self._run_flusher())
+        logger.info(f"消息写缓冲启动 (间隔 {self.flush_interval * 1000:.0f}ms, 批量 {self.batch_size}, 模式 {self.ack_mode})")
+
+    async def stop(self):
+        """停止刷写任务，并写入缓冲中剩余的消息"""
+        if not self.running:
+            return
+
+        self.running = False
+        self._has_pending.set()
+        self._batch_full.set()
+        if self.flusher_task:
+            await self.flusher_task
+        logger.info("消息写缓冲停止")
+
+    async def add_message(
+        self,
+        session_id: str,
+        sender_user_id: str,
+        content: str,
+        message_type: str = "text",
+        wait_for_flush: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        缓冲一条聊天消息，返回已分配ID、序号和时间的消息数据
+
+        调用方需已确认发送者是会话参与者。wait_for_flush 为None时按 CHAT_ACK_MODE 决定
+        是否等待写入数据库；等待时写入失败会抛出异常。
+        """
+        sequence_number = await self._next_sequence_number(session_id)
+        message = {
+            "id": generate_uuid(),
+            "chat_session_id": session_id,
+            "sender_user_id": sender_user_id,
+            "content": content,
+            "message_type": message_type,
+            "sequence_number": sequence_number,
+            "is_deleted": False,
+            "is_read": False,
+            "created_at": datetime.utcnow()
+        }
+
+        written = asyncio.get_running_loop().create_future()
+        self._pending.append((message, written))
+        self._has_pending.set()
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+
+        if not self.running:
+            # 未启动后台刷写（如独立脚本中）时直接写入
+            await self._flush()
+
+        if wait_for_flush is None:
+            wait_for_flush = self.ack_mode == "after_flush"
+        if wait_for_flush and not await written:
+            raise RuntimeError("消息写入数据库失败")
+
+        return message
+
+    async def _next_sequence_number(self, session_id: str) -> int:
+        """排队等待会话的下一个序号，按到达顺序分配"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._sequence_waiters.setdefault(session_id, []).append(waiter)
+        if session_id not in self._allocators:
+            self._allocators[session_id] = asyncio.create_task(self._allocate_for_session(session_id))
+        return await waiter
+
+    async def _allocate_for_session(self, session_id: str):
+        """为排队的消息分配序号，分配期间新到达的消息在下一轮一起分配"""
+        try:
+            while self._sequence_waiters.get(session_id):
+                waiters = self._sequence_waiters.pop(session_id)
+                try:
+                    last = await asyncio.get_running_loop().run_in_executor(
+                        None, self._allocate_sequence_numbers, session_id, len(waiters)
+                    )
+                except Exception as e:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+
+                # 等待中被取消的消息留下序号空洞，轮询在 SEQUENCE_GAP_GRACE 后越过
+                first = last - len(waiters) + 1
+                for offset, waiter in enumerate(waiters):
+                    if not waiter.done():
+                        waiter.set_result(first + offset)
+        finally:
+            del self._allocators[session_id]
+
+    def _allocate_sequence_numbers(self, session_id: str, count: int) -> int:
+        """在会话的序号计数器上原子分配count个连续序号，返回最后一个（阻塞调用，在线程池中执行）"""
+        db = SessionLocal()
+        try:
+            sequence_number = chat_service.reserve_sequence_numbers(db, session_id, count)
+            db.commit()
+            return sequence_number
+        finally:
+            db.close()
+
+    async def _run_flusher(self):
+        """后台刷写循环：有消息时等待攒批或到达间隔后写入"""
+        while True:
+            try:
+                await self._has_pending.wait()
+                if self.running and len(self._pending) < self.batch_size:
+                    try:
+                        await asyncio.wait_for(self._batch_full.wait(), timeout=self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+
+                await self._flush()
+
+                if not self.running and not self._pending:
+                    break
+            except Exception as e:
+                logger.error(f"刷写消息缓冲时出错: {e}")
+                await asyncio.sleep(1)
+
+    async def _flush(self):
+        """将当前缓冲中的消息写入数据库"""
+        batch, self._pending = self._pending, []
+        self._has_pending.clear()
+        self._batch_full.clear()
+        if not batch:
+            return
+
+        failed_ids = await asyncio.to_thread(self._write_batch, [message for message, _ in batch])
+
+        for message, written in batch:
+            if not written.done():
+                written.set_result(message["id"] not in failed_ids)
+
+    def _write_batch(self, messages: List[Dict[str, Any]]) -> Set[str]:
+        """批量写入消息，返回写入失败的消息ID"""
+        db = SessionLocal()
+        try:
+            try:
+                self._insert_messages(db, messages)
+                db.commit()
+                return set()
+            except Exception as e:
+                db.rollback()
+                logger.error(f"批量写入 {len(messages)} 条消息失败，改为逐条写入: {e}")
+
+            failed_ids = set()
+            for message in messages:
+                try:
+                    self._insert_messages(db, [message])
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    failed_ids.add(message["id"])
+                    logger.error(f"写入消息 {message['id']} (会话 {message['chat_session_id']}) 失败: {e}")
+            return failed_ids
+        finally:
+            db.close()
+
+    def _insert_messages(self, db, messages: List[Dict[str, Any]]):
+        db.execute(insert(RealTimeMessage), messages)
+
+        # 按会话合并更新消息数和最后消息时间
+        sessions: Dict[str, List[Dict[str, Any]]] = {}
+        for message in messages:
+            sessions.setdefault(message["chat_session_id"], []).append(message)
+
+        now = datetime.utcnow()
+        for session_id, session_messages in sessions.items():
+            db.execute(
+                update(ChatSession).where(ChatSession.id == session_id).values(
+                    message_count=ChatSession.message_count + len(session_messages),
+                    last_message_at=max(m["created_at"] for m in session_messages),
+                    updated_at=now
+                ).execution_options(synchronize_session=False)
+            )
+
+# 全局消息写缓冲实例
+message_buffer = MessageWriteBuffer()
@@ -0,0 +1,94 @@
+"""
+限流原语
+调度器派发与LLM网关共用
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import List, Tuple
+
+class TokenBucket:
+    """令牌桶限流器"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate  # 每秒补充的令牌数
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens: float = 1.0):
+        """获取令牌，不足时等待补充（单次请求超过容量时按容量计）"""
+        tokens = min(tokens, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class PrioritySemaphore:
+    """
+    带优先级的信号量
+    数值越小优先级越高；等待者按 (优先级, 到达顺序) 唤醒，
+    reserved 个名额只留给最高优先级（0），低优先级的请求再多也不会占满全部名额
+    """
+
+    def __init__(self, capacity: int, reserved: int = 0):
+        self.capacity = max(1, capacity)
+        self.reserved = max(0, min(reserved, self.capacity - 1))
+        self.in_use = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    def _can_take(self, priority: int) -> bool:
+        limit = self.capacity if priority == 0 else self.capacity - self.reserved
+        return self.in_use < limit
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0):
+        self._drop_cancelled()
+        if self._can_take(priority) and (not self._waiters or self._waiters[0][0] > priority):
+            self.in_use += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配名额后才被取消，归还名额
+                self.release()
+            else:
+                self._wake()
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+    def _drop_cancelled(self):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    def _wake(self):
+        while True:
+            self._drop_cancelled()
+            if not self._waiters:
+                break
+            priority, _, future = self._waiters[0]
+            if not self._can_take(priority):
+                break
+            heapq.heappop(self._waiters)
+            self.in_use += 1
+            future.set_result(None)
@@ -1,30 +1,66 @@
 """
 定时任务调度服务
 用于自动触发情感匹配的对话
+
+调度器在内存中维护一个按计划时间排序的最小堆：
+- 通过 (status, next_scheduled_conversation) 索引分批增量加载未来一段时间窗口内的计划
+- 匹配关系创建、取消、重新安排时通过 notify_schedule_changed 即时更新堆
+- 主循环精确睡眠到下一个到期时间，派发速率由令牌桶限制
+- 派发前在数据库中原子领取计划（租约记录执行该次对话的任务ID），多个后端副本同时运行时每次到期只会执行一次；
+  租约到期时任务仍在排队或重试则续租，任务开始执行时再确认领取未被其他实例接管
 """
 
 import asyncio
+import heapq
+import os
 import random
+import socket
+import uuid
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
 
-from models.database import SessionLocal, MatchRelation, Scenario
-from services.match_service import match_service
+from models.database import SessionLocal, MatchRelation, Scenario, generate_uuid
+from services.match_service import match_service, CLAIM_CLAIMED, CLAIM_EXTENDED
 from services.task_service import task_service
+from services.rate_limit import TokenBucket
 
 class SchedulerService:
     def __init__(self):
         self.running = False
         self.task = None
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # 调度配置
+        self.horizon = int(os.getenv("SCHEDULER_HORIZON", 3600))  # 预加载的时间窗口（秒）
+        self.batch_size = int(os.getenv("SCHEDULER_BATCH_SIZE", 1000))  # 每批加载的计划数
+        self.resync_interval = int(os.getenv("SCHEDULER_RESYNC_INTERVAL", 600))  # 全量重新同步间隔（秒）
+        self.lease_seconds = int(os.getenv("SCHEDULER_LEASE_SECONDS", 1800))  # 领取计划的租约时长；到期时任务已失败则重新派发（秒）
+        self.no_scenario_retry = int(os.getenv("SCHEDULER_NO_SCENARIO_RETRY", 60))  # 没有可用场景时暂停派发的时长（秒）
+        self.dispatch_bucket = TokenBucket(
+            rate=float(os.getenv("SCHEDULER_DISPATCH_RATE", 1.0)),
+            capacity=int(os.getenv("SCHEDULER_DISPATCH_BURST", 5))
+        )
+
+        # 最小堆: (计划时间, match_id)；_scheduled 记录每个匹配关系当前有效的计划时间，堆中过期条目惰性删除
+        self._heap: List[Tuple[datetime, str]] = []
+        self._scheduled: Dict[str, datetime] = {}
+        self._wakeup = asyncio.Event()
+
+        # 增量加载游标：已加载到的 (计划时间, id)，以及下次加载/全量同步的时间
+        self._cursor: Optional[Tuple[datetime, str]] = None
+        self._next_load_at = datetime.min
+        self._next_resync_at = datetime.min
+        # 没有可用场景时暂停派发到该时间，到期的计划留在堆中
+        self._dispatch_paused_until = datetime.min
 
     async def start(self):
         """启动定时任务"""
         if self.running:
             print("⏰ 调度服务已在运行")
             return
-        
+
         self.running = True
         self.task = asyncio.create_task(self._run_scheduler())
         print("🚀 定时对话调度服务启动")
@@ -33,7 +69,7 @@ class SchedulerService:
         """停止定时任务"""
         if not self.running:
             return
-        
+
         self.running = False
         if self.task:
             self.task.cancel()
@@ -43,75 +79,158 @@ class SchedulerService:
                 pass
         print("⏹️ 定时对话调度服务停止")
 
+    def notify_schedule_changed(self, match_id: str, scheduled_at: Optional[datetime]):
+        """
+        匹配关系的计划时间发生变化（创建、取消、重新安排）
+        scheduled_at为None表示取消计划
+        """
+        if scheduled_at is None:
+            self._scheduled.pop(match_id, None)
+        elif scheduled_at <= datetime.utcnow() + timedelta(seconds=self.horizon):
+            self._push(match_id, scheduled_at)
+        else:
+            # 超出预加载窗口，等窗口推进时再从数据库加载
+            self._scheduled.pop(match_id, None)
+            return
+        self._wakeup.set()
+
+    def _push(self, match_id: str, scheduled_at: datetime):
+        if self._scheduled.get(match_id) == scheduled_at:
+            return
+        self._scheduled[match_id] = scheduled_at
+        heapq.heappush(self._heap, (scheduled_at, match_id))
+
+    def _load_schedules(self, now: datetime):
+        """从数据库分批加载时间窗口内的计划"""
+        if now >= self._next_resync_at:
+            # 定期全量同步，纳入其他进程修改的计划并清理失效条目
+            self._cursor = None
+            self._heap = []
+            self._scheduled = {}
+            self._next_resync_at = now + timedelta(seconds=self.resync_interval)
+
+        until = now + timedelta(seconds=self.horizon)
+        db = SessionLocal()
+        try:
+            rows = match_service.get_scheduled_conversations(
+                db, until=until, after=self._cursor, limit=self.batch_size
+            )
+        finally:
+            db.close()
+
+        for match_id, scheduled_at in rows:
+            self._push(match_id, scheduled_at)
+
+        if len(rows) == self.batch_size:
+            # 还有未加载的计划，继续加载下一批
+            self._cursor = (rows[-1][1], rows[-1][0])
+            self._next_load_at = now
+        else:
+            self._cursor = (until, "")
+            self._next_load_at = now + timedelta(seconds=min(self.horizon / 2, self.resync_interval))
+
     async def _run_scheduler(self):
         """运行调度器主循环"""
         while self.running:
             try:
-                await self._process_pending_conversations()
-                # 每5分钟检查一次
-                await asyncio.sleep(300)
+                now = datetime.utcnow()
+                if now >= self._next_load_at or now >= self._next_resync_at:
+                    self._load_schedules(now)
+
+                await self._process_due_conversations()
+
+                # 睡眠到下一个到期时间或下次加载时间，有新计划时提前唤醒
+                now = datetime.utcnow()
+                wake_at = min(self._next_load_at, self._next_resync_at)
+                if self._heap:
+                    wake_at = min(wake_at, max(self._heap[0][0], self._dispatch_paused_until))
+                timeout = max(0.0, (wake_at - now).total_seconds())
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 print(f"❌ 调度器执行错误: {e}")
                 await asyncio.sleep(60)  # 出错后等待1分钟再重试
 
-    async def _process_pending_conversations(self):
-        """处理待执行的对话"""
-        db = SessionLocal()
-        try:
-            # 获取需要对话的匹配关系
-            pending_matches = match_service.get_pending_conversations(db)
-            
-            if not pending_matches:
-                return
-            
-            print(f"📋 发现 {len(pending_matches)} 个待处理的匹配关系")
-            
-            # 获取可用场景
-            scenarios = db.query(Scenario).filter(Scenario.is_active == True).all()
-            if not scenarios:
-                print("⚠️ 没有可用的对话场景")
-                return
-            
-            # 处理每个匹配关系
-            for match_relation in pending_matches:
-                try:
-                    # 随机选择场景
-                    scenario = random.choice(scenarios)
-                    
-                    print(f"🎭 创建自动对话任务: {match_relation.initiator_agent.display_name} 与 {match_relation.target_agent.display_name}")
-                    print(f"   场景: {scenario.name}")
-                    
-                    # 创建异步任务
-                    task_id = task_service.create_task(
-                        task_type="auto_conversation",
-                        match_relation_id=str(match_relation.id),
-                        scenario_id=str(scenario.id)
-                    )
-                    
-                    # 异步执行对话任务（不等待完成）
-                    asyncio.create_task(
-                        task_service.execute_conversation_task(
-                            task_id=task_id,
-                            match_relation_id=str(match_relation.id),
-                            scenario_id=str(scenario.id),
-                            max_turns=random.randint(6, 12)
-                        )
-                    )
-                    
-                    print(f"✅ 对话任务已创建: {task_id}")
-                    
-                except Exception as e:
-                    print(f"❌ 创建自动对话任务失败: {e}")
-                    
-                # 处理间隔，避免创建太多并发任务
-                await asyncio.sleep(1)
-                
-        except Exception as e:
-            print(f"❌ 处理待执行对话时出错: {e}")
-        finally:
-            db.close()
+    async def _process_due_conversations(self):
+        """派发所有已到期的对话"""
+        scenarios = None
+        if datetime.utcnow() < self._dispatch_paused_until:
+            return
+
+        while self._heap and self._heap[0][0] <= datetime.utcnow():
+            scheduled_at, match_id = heapq.heappop(self._heap)
+            if self._scheduled.get(match_id) != scheduled_at:
+                continue  # 已被取消或重新安排的过期条目
+            del self._scheduled[match_id]
+
+            # 限制派发速率，避免瞬间创建过多任务
+            await self.dispatch_bucket.acquire()
+
+            db = SessionLocal()
+            try:
+                if scenarios is None:
+                    # 获取可用场景；只取 (id, name)，ORM对象在每次派发的会话提交后会过期，不能跨会话复用
+                    scenarios = db.query(Scenario.id, Scenario.name).filter(Scenario.is_active == True).all()
+                if not scenarios:
+                    print(f"⚠️ 没有可用的对话场景，{self.no_scenario_retry}秒后重试")
+                    # 放回堆中，暂停派发期间主循环不会因为它立即到期而空转
+                    self._push(match_id, scheduled_at)
+                    self._dispatch_paused_until = datetime.utcnow() + timedelta(seconds=self.no_scenario_retry)
+                    return
+
+                self._dispatch_conversation(db, match_id, scheduled_at, scenarios)
+            except Exception as e:
+                print(f"❌ 创建自动对话任务失败: {e}")
+            finally:
+                db.close()
+
+    def _dispatch_conversation(
+        self,
+        db: Session,
+        match_id: str,
+        scheduled_at: datetime,
+        scenarios: List[Tuple[str, str]]
+    ):
+        """为到期的匹配关系创建自动对话任务"""
+        # 以预先生成的任务ID原子领取计划，任务开始执行时据此确认领取仍然有效；
+        # 已被其他调度器领取或计划已被修改时放弃本次派发
+        task_id = generate_uuid()
+        lease_until = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+        claim = match_service.claim_scheduled_conversation(
+            db, match_id, scheduled_at, task_id, lease_until
+        )
+        if claim == CLAIM_EXTENDED:
+            # 上一次派发的任务仍在排队或重试，租约到期时再检查
+            self._push(match_id, lease_until)
+            return
+        if claim != CLAIM_CLAIMED:
+            return
+
+        match_relation = db.query(MatchRelation).filter(MatchRelation.id == match_id).first()
+
+        # 随机选择场景
+        scenario_id, scenario_name = random.choice(scenarios)
+
+        print(f"🎭 创建自动对话任务: {match_relation.initiator_agent.display_name} 与 {match_relation.target_agent.display_name}")
+        print(f"   场景: {scenario_name}")
+
+        # 创建异步任务（由任务worker执行，不等待完成）
+        task_service.create_task(
+            task_type="auto_conversation",
+            task_id=task_id,
+            match_relation_id=str(match_relation.id),
+            scenario_id=str(scenario_id),
+            max_turns=random.randint(6, 12),
+            scheduled=True
+        )
+
+        print(f"✅ 对话任务已创建: {task_id} (调度器 {self.owner_id})")
 
     async def trigger_immediate_conversation(self, match_relation_id: str) -> str:
         """立即触发指定匹配关系的对话，返回任务ID"""
@@ -122,36 +241,27 @@ class SchedulerService:
                 MatchRelation.id == match_relation_id,
                 MatchRelation.status == "active"
             ).first()
-            
+
             if not match_relation:
                 raise ValueError("匹配关系不存在或不活跃")
-            
+
             # 获取随机场景
             scenarios = db.query(Scenario).filter(Scenario.is_active == True).all()
             if not scenarios:
                 raise ValueError("没有可用的对话场景")
-            
+
             scenario = random.choice(scenarios)
-            
-            # 创建异步任务
+
+            # 创建异步任务（由任务worker执行）
             task_id = task_service.create_task(
                 task_type="immediate_conversation",
                 match_relation_id=match_relation_id,
-                scenario_id=str(scenario.id)
+                scenario_id=str(scenario.id),
+                max_turns=random.randint(6, 12)
             )
-            
-            # 异步执行对话任务
-            asyncio.create_task(
-                task_service.execute_conversation_task(
-                    task_id=task_id,
-                    match_relation_id=match_relation_id,
-                    scenario_id=str(scenario.id),
-                    max_turns=random.randint(6, 12)
-                )
-            )
-            
+
             return task_id
-            
+
         except Exception as e:
             print(f"❌ 立即触发对话失败: {e}")
             raise
@@ -162,9 +272,12 @@ class SchedulerService:
         """获取调度服务状态"""
         return {
             "running": self.running,
+            "owner_id": self.owner_id,
             "task_id": id(self.task) if self.task else None,
-            "started_at": datetime.utcnow().isoformat() if self.running else None
+            "started_at": datetime.utcnow().isoformat() if self.running else None,
+            "scheduled_count": len(self._scheduled),
+            "next_due_at": self._heap[0][0].isoformat() if self._heap else None
         }
 
 # 创建全局调度器实例
-scheduler_service = SchedulerService() 
\ No newline at end of file
+scheduler_service = SchedulerService()
@@ -1,15 +1,25 @@
 """
 后台任务服务
 用于异步处理耗时的AI对话生成任务
+
+任务持久化在 task_jobs 表中，worker 通过租约（locked_by + locked_until）领取任务：
+- 领取时用带条件的 UPDATE 做比较并交换，SQLite 与 PostgreSQL 均适用，多个 worker 不会重复领取
+- 执行期间定期续约；worker 崩溃后租约到期，任务会被其他 worker 重新领取
+- 执行失败按指数退避重试，超过最大次数后标记为失败
 """
 
 import asyncio
+import os
+import socket
 import uuid
 import json
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
-from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable, Awaitable
 from enum import Enum
+from sqlalchemy import and_, or_
+
+from models.database import SessionLocal, TaskJob
+from services.llm_gateway import llm_gateway, BACKGROUND
 
 class TaskStatus(Enum):
     PENDING = "pending"
@@ -17,108 +27,325 @@ class TaskStatus(Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
-class TaskResult:
-    def __init__(self, task_id: str):
-        self.task_id = task_id
-        self.status = TaskStatus.PENDING
-        self.result = None
-        self.error = None
-        self.created_at = datetime.utcnow()
-        self.started_at = None
-        self.completed_at = None
-        self.progress = 0
-
 class TaskService:
     def __init__(self):
-        self.tasks: Dict[str, TaskResult] = {}
-        self.executor = ThreadPoolExecutor(max_workers=3)  # 限制并发数避免API过载
-        
-    def create_task(self, task_type: str, **kwargs) -> str:
-        """创建新任务"""
-        task_id = str(uuid.uuid4())
-        task_result = TaskResult(task_id)
-        self.tasks[task_id] = task_result
-        
-        # 清理超过1小时的旧任务
+        # worker配置
+        self.concurrency = int(os.getenv("TASK_WORKER_CONCURRENCY", 3))  # 限制并发数避免API过载
+        self.visibility_timeout = int(os.getenv("TASK_VISIBILITY_TIMEOUT", 300))  # 租约时长（秒）
+        self.max_attempts = int(os.getenv("TASK_MAX_ATTEMPTS", 3))
+        self.retry_backoff = int(os.getenv("TASK_RETRY_BACKOFF", 30))  # 重试退避基数（秒）
+        self.poll_interval = float(os.getenv("TASK_POLL_INTERVAL", 1.0))  # 队列为空时的轮询间隔（秒）
+        self.retention_hours = int(os.getenv("TASK_RETENTION_HOURS", 1))  # 已结束任务的保留时长
+
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.running = False
+        self.worker_task: Optional[asyncio.Task] = None
+
+        # 任务类型 -> 处理函数
+        self.handlers: Dict[str, Callable[..., Awaitable[Dict[str, Any]]]] = {
+            "auto_conversation": self._execute_conversation,
+            "immediate_conversation": self._execute_conversation,
+            "conversation": self._execute_conversation,
+        }
+
+    def create_task(self, task_type: str, task_id: Optional[str] = None, **kwargs) -> str:
+        """创建新任务并放入队列；task_id 可预先生成（如调度器领取计划时需要记录任务ID）"""
+        db = SessionLocal()
+        try:
+            job = TaskJob(
+                task_type=task_type,
+                payload=json.dumps(kwargs, ensure_ascii=False),
+                status=TaskStatus.PENDING.value,
+                max_attempts=self.max_attempts,
+                available_at=datetime.utcnow()
+            )
+            if task_id:
+                job.id = task_id
+            db.add(job)
+            db.commit()
+            task_id = job.id
+        finally:
+            db.close()
+
+        # 清理过期的旧任务
         self._cleanup_old_tasks()
-        
+
         return task_id
-    
-    async def execute_conversation_task(
-        self, 
-        task_id: str, 
-        match_relation_id: str, 
-        scenario_id: str,
-        max_turns: int = 8
-    ):
-        """异步执行对话任务"""
-        if task_id not in self.tasks:
+
+    async def start_worker(self, concurrency: Optional[int] = None):
+        """启动任务worker"""
+        if self.running:
+            print("⚙️ 任务worker已在运行")
             return
-            
-        task_result = self.tasks[task_id]
-        task_result.status = TaskStatus.RUNNING
-        task_result.started_at = datetime.utcnow()
-        
+
+        self.running = True
+        self.worker_task = asyncio.create_task(self._run_worker(concurrency or self.concurrency))
+        print(f"⚙️ 任务worker启动: {self.worker_id} (并发数 {concurrency or self.concurrency})")
+
+    async def stop_worker(self):
+        """停止任务worker，未完成的任务会在租约到期后被重新领取"""
+        if not self.running:
+            return
+
+        self.running = False
+        if self.worker_task:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+        print(f"⚙️ 任务worker停止: {self.worker_id}")
+
+    async def _run_worker(self, concurrency: int):
+        """worker主循环：在并发上限内不断领取并执行任务"""
+        semaphore = asyncio.Semaphore(concurrency)
+        running_jobs = set()
+
+        try:
+            while self.running:
+                await semaphore.acquire()
+                try:
+                    task_id = self._claim_next_task()
+                except Exception as e:
+                    print(f"❌ 领取任务失败: {e}")
+                    task_id = None
+
+                if not task_id:
+                    semaphore.release()
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                job = asyncio.create_task(self._run_job(task_id, semaphore))
+                running_jobs.add(job)
+                job.add_done_callback(running_jobs.discard)
+        finally:
+            for job in running_jobs:
+                job.cancel()
+
+    def _claim_next_task(self) -> Optional[str]:
+        """领取一个可执行的任务，返回任务ID"""
+        db = SessionLocal()
         try:
-            # 在线程池中执行同步的对话生成
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                self.executor,
-                self._execute_conversation_sync,
-                match_relation_id,
-                scenario_id,
-                max_turns,
-                task_id
+            now = datetime.utcnow()
+            claimable = or_(
+                and_(TaskJob.status == TaskStatus.PENDING.value, TaskJob.available_at <= now),
+                and_(TaskJob.status == TaskStatus.RUNNING.value, TaskJob.locked_until < now)
             )
-            
-            task_result.status = TaskStatus.COMPLETED
-            task_result.result = result
-            task_result.progress = 100
-            task_result.completed_at = datetime.utcnow()
-            
+
+            candidates = db.query(TaskJob.id).filter(claimable).order_by(
+                TaskJob.available_at
+            ).limit(10).all()
+
+            for (task_id,) in candidates:
+                # 条件更新：只有任务仍处于可领取状态时才会成功，保证只被一个worker领取
+                claimed = db.query(TaskJob).filter(TaskJob.id == task_id, claimable).update({
+                    "status": TaskStatus.RUNNING.value,
+                    "locked_by": self.worker_id,
+                    "locked_until": now + timedelta(seconds=self.visibility_timeout),
+                    "attempts": TaskJob.attempts + 1,
+                    "started_at": now,
+                    "updated_at": now
+                }, synchronize_session=False)
+                db.commit()
+
+                if not claimed:
+                    continue
+
+                # 租约到期被反复回收的任务（worker多次崩溃）超过重试次数后直接失败
+                job = db.query(TaskJob).filter(TaskJob.id == task_id).first()
+                if job.attempts > job.max_attempts:
+                    job.status = TaskStatus.FAILED.value
+                    job.error = job.error or "任务租约多次过期"
+                    job.completed_at = now
+                    job.locked_by = None
+                    job.locked_until = None
+                    db.commit()
+                    continue
+
+                return task_id
+
+            return None
+
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _run_job(self, task_id: str, semaphore: asyncio.Semaphore):
+        """执行已领取的任务"""
+        heartbeat = asyncio.create_task(self._heartbeat(task_id, asyncio.current_task()))
+        try:
+            db = SessionLocal()
+            try:
+                job = db.query(TaskJob).filter(TaskJob.id == task_id).first()
+                task_type = job.task_type
+                payload = json.loads(job.payload or "{}")
+            finally:
+                db.close()
+
+            handler = self.handlers.get(task_type)
+            if not handler:
+                raise ValueError(f"未知的任务类型: {task_type}")
+
+            # 后台任务中的模型调用走低优先级通道，不与交互请求争抢
+            with llm_gateway.lane(BACKGROUND):
+                result = await handler(task_id, **payload)
+            self._complete_task(task_id, result)
+
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            task_result.status = TaskStatus.FAILED
-            task_result.error = str(e)
-            task_result.completed_at = datetime.utcnow()
             print(f"❌ 任务 {task_id} 执行失败: {e}")
-    
-    def _execute_conversation_sync(
-        self, 
-        match_relation_id: str, 
-        scenario_id: str, 
-        max_turns: int,
-        task_id: str
+            self._fail_task(task_id, str(e))
+        finally:
+            heartbeat.cancel()
+            semaphore.release()
+
+    async def _heartbeat(self, task_id: str, job: asyncio.Task):
+        """
+        定期续约，避免长任务被其他worker重新领取
+        续约未更新任何行说明租约已过期并被其他worker领取（或任务已结束），取消本地执行，避免同一任务执行两次
+        """
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            db = SessionLocal()
+            try:
+                renewed = db.query(TaskJob).filter(
+                    TaskJob.id == task_id,
+                    TaskJob.status == TaskStatus.RUNNING.value,
+                    TaskJob.locked_by == self.worker_id
+                ).update({
+                    "locked_until": datetime.utcnow() + timedelta(seconds=self.visibility_timeout)
+                }, synchronize_session=False)
+                db.commit()
+            except Exception as e:
+                # 数据库暂时不可用时保留本地执行，下次续约时再确认租约
+                print(f"❌ 任务 {task_id} 续约失败: {e}")
+                db.rollback()
+                continue
+            finally:
+                db.close()
+
+            if not renewed:
+                print(f"⚠️ 任务 {task_id} 的租约已被其他worker接管，停止执行")
+                job.cancel()
+                return
+
+    def _complete_task(self, task_id: str, result: Dict[str, Any]):
+        """标记任务完成（仅当当前worker仍持有租约）"""
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.query(TaskJob).filter(
+                TaskJob.id == task_id,
+                TaskJob.locked_by == self.worker_id
+            ).update({
+                "status": TaskStatus.COMPLETED.value,
+                "result": json.dumps(result, ensure_ascii=False),
+                "progress": 100,
+                "completed_at": now,
+                "locked_by": None,
+                "locked_until": None,
+                "updated_at": now
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _fail_task(self, task_id: str, error: str):
+        """任务执行失败：未超过重试次数则退避后重新排队，否则标记失败"""
+        db = SessionLocal()
+        try:
+            job = db.query(TaskJob).filter(
+                TaskJob.id == task_id,
+                TaskJob.locked_by == self.worker_id
+            ).first()
+            if not job:
+                return
+
+            now = datetime.utcnow()
+            job.error = error
+            job.locked_by = None
+            job.locked_until = None
+
+            if job.attempts < job.max_attempts:
+                job.status = TaskStatus.PENDING.value
+                job.available_at = now + timedelta(seconds=self.retry_backoff * 2 ** (job.attempts - 1))
+                print(f"🔁 任务 {task_id} 将在 {job.available_at.isoformat()} 重试 (第{job.attempts}次失败)")
+            else:
+                job.status = TaskStatus.FAILED.value
+                job.completed_at = now
+
+            db.commit()
+        finally:
+            db.close()
+
+    def _update_progress(self, task_id: str, progress: int):
+        """更新任务进度"""
+        db = SessionLocal()
+        try:
+            db.query(TaskJob).filter(TaskJob.id == task_id).update(
+                {"progress": progress}, synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    async def _execute_conversation(
+        self,
+        task_id: str,
+        match_relation_id: str,
+        scenario_id: str,
+        max_turns: int = 8,
+        scheduled: bool = False
     ) -> Dict[str, Any]:
-        """在线程池中同步执行对话生成"""
-        from models.database import SessionLocal, MatchRelation, Scenario
+        """
+        执行对话生成
+        scheduled为True表示由调度器领取计划后派发，执行前需确认该计划仍由本任务持有
+        """
+        from models.database import MatchRelation, Scenario
         from services.match_service import match_service
-        
+        from services.scheduler_service import scheduler_service
+
         db = SessionLocal()
         try:
             # 获取匹配关系和场景
             match_relation = db.query(MatchRelation).filter(
                 MatchRelation.id == match_relation_id
             ).first()
-            
+
             scenario = db.query(Scenario).filter(
                 Scenario.id == scenario_id
             ).first()
-            
+
             if not match_relation or not scenario:
                 raise ValueError("匹配关系或场景不存在")
-            
+
+            if scheduled:
+                lease_until = datetime.utcnow() + timedelta(seconds=scheduler_service.lease_seconds)
+                if not match_service.start_scheduled_conversation(db, match_relation_id, task_id, lease_until):
+                    # 排队期间租约被其他调度器接管（或关系已取消），由接管的任务执行
+                    print(f"⏭️ 任务 {task_id} 的对话计划已被重新领取，跳过")
+                    return {"skipped": True, "reason": "schedule_claim_lost"}
+                db.refresh(match_relation)
+
             # 更新任务进度
-            if task_id in self.tasks:
-                self.tasks[task_id].progress = 20
-            
-            # 执行对话（这里会调用同步的OpenAI API）
-            auto_conv = asyncio.run(match_service.conduct_auto_conversation(
+            self._update_progress(task_id, 20)
+
+            # 执行对话
+            auto_conv = await match_service.conduct_auto_conversation(
                 match_relation=match_relation,
                 scenario=scenario,
                 max_turns=max_turns,
                 db=db
-            ))
-            
+            )
+
+            # 对话完成后已重新安排下次对话时间
+            scheduler_service.notify_schedule_changed(
+                match_relation.id, match_relation.next_scheduled_conversation
+            )
+
             return {
                 "auto_conversation_id": str(auto_conv.id),
                 "scenario_name": scenario.name,
@@ -127,44 +354,58 @@ class TaskService:
                 "actual_turns": auto_conv.actual_turns,
                 "termination_reason": auto_conv.termination_reason
             }
-            
+
         finally:
             db.close()
-    
-    def get_task_status(self, task_id: str) -> Optional[Dict[str, Any]]:
-        """获取任务状态"""
-        if task_id not in self.tasks:
-            return None
-            
-        task_result = self.tasks[task_id]
+
+    def _to_status_dict(self, job: TaskJob) -> Dict[str, Any]:
         return {
-            "task_id": task_id,
-            "status": task_result.status.value,
-            "progress": task_result.progress,
-            "result": task_result.result,
-            "error": task_result.error,
-            "created_at": task_result.created_at.isoformat(),
-            "started_at": task_result.started_at.isoformat() if task_result.started_at else None,
-            "completed_at": task_result.completed_at.isoformat() if task_result.completed_at else None
+            "task_id": job.id,
+            "status": job.status,
+            "progress": job.progress,
+            "result": json.loads(job.result) if job.result else None,
+            "error": job.error,
+            "attempts": job.attempts,
+            "created_at": job.created_at.isoformat(),
+            "started_at": job.started_at.isoformat() if job.started_at else None,
+            "completed_at": job.completed_at.isoformat() if job.completed_at else None
         }
-    
+
+    def get_task_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """获取任务状态"""
+        db = SessionLocal()
+        try:
+            job = db.query(TaskJob).filter(TaskJob.id == task_id).first()
+            if not job:
+                return None
+            return self._to_status_dict(job)
+        finally:
+            db.close()
+
     def _cleanup_old_tasks(self):
-        """清理超过1小时的旧任务"""
-        cutoff_time = datetime.utcnow() - timedelta(hours=1)
-        old_task_ids = [
-            task_id for task_id, task_result in self.tasks.items()
-            if task_result.created_at < cutoff_time
-        ]
-        
-        for task_id in old_task_ids:
-            del self.tasks[task_id]
-    
+        """清理超过保留时长的已结束任务"""
+        cutoff_time = datetime.utcnow() - timedelta(hours=self.retention_hours)
+        db = SessionLocal()
+        try:
+            db.query(TaskJob).filter(
+                TaskJob.status.in_([TaskStatus.COMPLETED.value, TaskStatus.FAILED.value]),
+                TaskJob.created_at < cutoff_time
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            print(f"❌ 清理旧任务失败: {e}")
+            db.rollback()
+        finally:
+            db.close()
+
     def get_all_tasks(self) -> Dict[str, Dict[str, Any]]:
-        """获取所有任务状态（用于调试）"""
-        return {
-            task_id: self.get_task_status(task_id)
-            for task_id in self.tasks.keys()
-        }
+        """获取最近任务状态（用于调试）"""
+        db = SessionLocal()
+        try:
+            jobs = db.query(TaskJob).order_by(TaskJob.created_at.desc()).limit(100).all()
+            return {job.id: self._to_status_dict(job) for job in jobs}
+        finally:
+            db.close()
 
 # 创建全局任务服务实例
-task_service = TaskService() 
\ No newline at end of file
+task_service = TaskService()
@@ -6,6 +6,9 @@ from fastapi import WebSocket, WebSocketDisconnect
 from sqlalchemy.orm import Session
 from models.database import MatchRelation, User, ConversationMessage, RealTimeMessage, ChatSession
 from services.chat_service import chat_service
+from services.message_buffer import message_buffer
+from services.broadcast_backplane import create_backplane
+from services.display_name_cache import display_name_cache
 import asyncio
 
 logger = logging.getLogger(__name__)
@@ -18,13 +21,25 @@ class ConnectionManager:
         self.user_online_status: Dict[str, Set[str]] = {}
         # 存储正在输入状态: {session_id: {user_id: timestamp}}
         self.typing_status: Dict[str, Dict[str, datetime]] = {}
+        # 会话到连接的反向索引: {session_id: {user_id: websocket}}，广播时只遍历会话参与者
+        self.session_connections: Dict[str, Dict[str, WebSocket]] = {}
+        # 跨进程/节点转发广播的背板
+        self.backplane = create_backplane()
+
+    async def start_backplane(self):
+        """启动广播背板，接收其他节点的广播"""
+        await self.backplane.start(self.deliver_to_session)
+
+    async def stop_backplane(self):
+        """停止广播背板"""
+        await self.backplane.stop()
 
     async def connect(self, websocket: WebSocket, user_id: str, session_id: str):
         """建立WebSocket连接"""
         await websocket.accept()
         
-        # 获取连接前会话中的在线用户列表（用于发送初始状态）
-        online_users_before = self.get_online_users_in_session(session_id)
+        # 获取连接前会话中的在线用户列表（用于发送初始状态），包括连接在其他节点上的用户
+        online_users_before = await self.get_online_users_in_session(session_id)
         
         # 初始化用户连接字典
         if user_id not in self.active_connections:
@@ -34,6 +49,9 @@ class ConnectionManager:
         # 存储连接
         self.active_connections[user_id][session_id] = websocket
         self.user_online_status[user_id].add(session_id)
+        self.session_connections.setdefault(session_id, {})[user_id] = websocket
+        # 订阅会话的广播频道并登记在线状态
+        await self.backplane.join(session_id, user_id)
         
         logger.info(f"用户 {user_id} 在会话 {session_id} 中上线")
         
@@ -70,6 +88,12 @@ class ConnectionManager:
         if user_id in self.user_online_status and session_id in self.user_online_status[user_id]:
             self.user_online_status[user_id].discard(session_id)
             
+        if session_id in self.session_connections:
+            self.session_connections[session_id].pop(user_id, None)
+            if not self.session_connections[session_id]:
+                del self.session_connections[session_id]
+        await self.backplane.leave(session_id, user_id)
+            
         # 清理空的用户记录
         if user_id in self.active_connections and not self.active_connections[user_id]:
             del self.active_connections[user_id]
@@ -95,22 +119,29 @@ class ConnectionManager:
                 await self.disconnect(user_id, session_id)
 
     async def broadcast_to_session(self, message: dict, session_id: str, exclude_user: Optional[str] = None):
-        """向会话中的所有用户广播消息（可排除指定用户）"""
+        """向会话中的所有用户广播消息（可排除指定用户），包括连接在其他节点上的用户"""
+        await self.deliver_to_session(session_id, message, exclude_user)
+        await self.backplane.publish(session_id, message, exclude_user)
+
+    async def deliver_to_session(self, session_id: str, message: dict, exclude_user: Optional[str] = None):
+        """向本节点上会话中的用户投递消息"""
         disconnected_users = []
         sent_count = 0
         
-        for user_id, connections in self.active_connections.items():
+        payload = json.dumps(message)
+        
+        # 复制一份，发送过程中可能有连接加入或断开
+        for user_id, websocket in list(self.session_connections.get(session_id, {}).items()):
             if exclude_user and user_id == exclude_user:
                 continue
                 
-            if session_id in connections:
-                try:
-                    await connections[session_id].send_text(json.dumps(message))
-                    sent_count += 1
-                    logger.debug(f"成功向用户 {user_id} 发送消息: {message.get('type', 'unknown')}")
-                except Exception as e:
-                    logger.error(f"广播消息给用户 {user_id} 失败: {e}")
-                    disconnected_users.append((user_id, session_id))
+            try:
+                await websocket.send_text(payload)
+                sent_count += 1
+                logger.debug(f"成功向用户 {user_id} 发送消息: {message.get('type', 'unknown')}")
+            except Exception as e:
+                logger.error(f"广播消息给用户 {user_id} 失败: {e}")
+                disconnected_users.append((user_id, session_id))
         
         if message.get('type') == 'user_status':
             logger.info(f"状态广播完成: 发送给 {sent_count} 个用户 (会话 {session_id})")
@@ -161,13 +192,10 @@ class ConnectionManager:
         }
         await self.broadcast_to_session(typing_message, session_id, exclude_user=user_id)
 
-    def get_online_users_in_session(self, session_id: str) -> Set[str]:
-        """获取会话中的在线用户"""
-        online_users = set()
-        for user_id, session_ids in self.user_online_status.items():
-            if session_id in session_ids:
-                online_users.add(user_id)
-        return online_users
+    async def get_online_users_in_session(self, session_id: str) -> Set[str]:
+        """获取会话中的在线用户（本节点的连接和背板登记的其他节点上的用户）"""
+        local_users = set(self.session_connections.get(session_id, {}))
+        return local_users | await self.backplane.online_users(session_id)
 
 # 全局连接管理器实例
 manager = ConnectionManager()
@@ -204,6 +232,9 @@ class WebSocketService:
                 is_online=True
             )
             
+            # 发送者名称在连接期间不变，只查询一次
+            sender_name = display_name_cache.get_display_names(db, [user_id]).get(user_id)
+            
             # 建立WebSocket连接
             await self.manager.connect(websocket, user_id, chat_session.id)
             
@@ -214,7 +245,7 @@ class WebSocketService:
                     message_data = json.loads(data)
                     
                     # 处理不同类型的消息
-                    await self.handle_message(message_data, user_id, chat_session.id, db)
+                    await self.handle_message(message_data, user_id, chat_session.id, sender_name)
                     
             except WebSocketDisconnect:
                 logger.info(f"用户 {user_id} 主动断开连接")
@@ -234,63 +265,59 @@ class WebSocketService:
             logger.error(f"WebSocket连接建立失败: {e}")
             await websocket.close(code=4000, reason="服务器内部错误")
 
-    async def handle_message(self, message_data: dict, user_id: str, session_id: str, db: Session):
+    async def handle_message(self, message_data: dict, user_id: str, session_id: str, sender_name: Optional[str]):
         """处理接收到的消息"""
         message_type = message_data.get("type")
         
         if message_type == "message":
-            await self.handle_chat_message(message_data, user_id, session_id, db)
+            await self.handle_chat_message(message_data, user_id, session_id, sender_name)
         elif message_type == "typing":
             await self.handle_typing_message(message_data, user_id, session_id)
         else:
             logger.warning(f"未知的消息类型: {message_type}")
 
-    async def handle_chat_message(self, message_data: dict, user_id: str, session_id: str, db: Session):
+    async def handle_chat_message(self, message_data: dict, user_id: str, session_id: str, sender_name: Optional[str]):
         """处理聊天消息"""
         try:
             content = message_data.get("content", "").strip()
             if not content:
                 return
                 
-            # 获取用户信息
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
+            if sender_name is None:
                 logger.warning(f"用户 {user_id} 不存在")
                 return
                 
-            # 使用ChatService发送消息
-            realtime_message = chat_service.send_message(
-                db=db,
-                session_id=session_id,
-                sender_user_id=user_id,
-                content=content,
-                message_type="text"
-            )
-            
-            if not realtime_message:
-                logger.warning(f"用户 {user_id} 发送消息到会话 {session_id} 失败")
+            # 写入消息缓冲：立即分配序号，由后台批量持久化
+            try:
+                realtime_message = await message_buffer.add_message(
+                    session_id=session_id,
+                    sender_user_id=user_id,
+                    content=content,
+                    message_type="text"
+                )
+            except Exception as e:
+                logger.warning(f"用户 {user_id} 发送消息到会话 {session_id} 失败: {e}")
                 return
             
             # 构建广播消息对象
             chat_message = {
                 "type": "message",
-                "id": str(realtime_message.id),
+                "id": realtime_message["id"],
                 "senderId": user_id,
-                "senderName": user.username or "用户",
+                "senderName": sender_name,
                 "content": content,
-                "timestamp": realtime_message.created_at.isoformat(),
+                "timestamp": realtime_message["created_at"].isoformat(),
                 "sessionId": session_id,
-                "sequenceNumber": realtime_message.sequence_number
+                "sequenceNumber": realtime_message["sequence_number"]
             }
             
             # 广播消息给会话中的所有用户
             await self.manager.broadcast_to_session(chat_message, session_id)
             
-            logger.info(f"用户 {user_id} 在会话 {session_id} 中发送消息 (序号: {realtime_message.sequence_number}): {content}")
+            logger.info(f"用户 {user_id} 在会话 {session_id} 中发送消息 (序号: {realtime_message['sequence_number']}): {content}")
             
         except Exception as e:
             logger.error(f"处理聊天消息失败: {e}")
-            db.rollback()
 
     async def handle_typing_message(self, message_data: dict, user_id: str, session_id: str):
         """处理正在输入消息"""
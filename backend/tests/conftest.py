@@ -0,0 +1,120 @@
+"""
+测试公共配置
+
+测试使用临时目录中的 SQLite 数据库（按迁移建表），不会读写 backend/soullink.db；
+环境变量需在导入 models.database 之前设置。
+"""
+
+import os
+import sys
+import tempfile
+
+_TEST_DIR = tempfile.mkdtemp(prefix="soullink-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_TEST_DIR}/test.db"
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ["TASK_WORKER_EMBEDDED"] = "false"
+os.environ["LLM_CACHE_ENABLED"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from models.database import Base, SessionLocal, engine
+from migrations import upgrade
+
+@pytest.fixture(scope="session", autouse=True)
+def migrated_database():
+    upgrade()
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def db():
+    """数据库会话，测试结束后清空所有表"""
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        with engine.begin() as connection:
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(table.delete())
+
+@pytest.fixture
+def make_user(db):
+    """创建用户及其数字人格"""
+    from models.database import DigitalPersona, User
+
+    def _make_user(username: str):
+        user = User(username=username, email=f"{username}@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        persona = DigitalPersona(user_id=user.id, name=f"{username}的人格", system_prompt="你好", initial_prompt="你好")
+        db.add(persona)
+        db.commit()
+        return user, persona
+
+    return _make_user
+
+@pytest.fixture
+def client():
+    """只挂载 API 路由的应用，不启动调度器、任务worker等后台服务"""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from api.routes import router
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v1")
+    with TestClient(app) as client:
+        yield client
+
+@pytest.fixture
+def auth_headers():
+    from services.auth_service import auth_service
+
+    def _auth_headers(user):
+        return {"Authorization": f"Bearer {auth_service.create_access_token({'sub': user.id})}"}
+
+    return _auth_headers
+
+@pytest.fixture
+def make_market_agent(db):
+    """将用户的数字人格投放到市场"""
+    from services.match_service import match_service
+
+    def _make_market_agent(user, persona, market_type="love", display_name=None, description="喜欢聊天", tags=None):
+        return match_service.create_market_agent(
+            db, user.id, persona.id, market_type, display_name or f"{user.username}的分身", description, tags or []
+        )
+
+    return _make_market_agent
+
+@pytest.fixture
+def make_match(db):
+    """创建 initiator -> target 的匹配关系"""
+    from models.database import MatchRelation
+
+    def _make_match(initiator_agent, target_agent, **fields):
+        match = MatchRelation(
+            initiator_user_id=initiator_agent.user_id,
+            target_user_id=target_agent.user_id,
+            initiator_agent_id=initiator_agent.id,
+            target_agent_id=target_agent.id,
+            match_type=initiator_agent.market_type,
+            **fields
+        )
+        db.add(match)
+        db.commit()
+        return match
+
+    return _make_match
+
+@pytest.fixture
+def scenario(db):
+    from models.database import Scenario
+
+    scenario = Scenario(name="咖啡馆", description="在咖啡馆偶遇", context="午后的咖啡馆", category="日常")
+    db.add(scenario)
+    db.commit()
+    return scenario
@@ -0,0 +1,153 @@
+"""
+共享HTTP连接池的负载测试：并发调用受 AI_HTTP_MAX_CONNECTIONS 限制，且连接被复用；
+通过 ASGI 并发请求 /messages 时，所有请求共用同一个连接池
+"""
+
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from api.routes import router
+from models.database import Conversation, ConversationMessage
+from services.ai_service import AIService, ai_service
+
+RESPONSE_DELAY = 0.1
+
+class FakeChatServer:
+    """最小的 OpenAI 兼容接口，记录同时打开的连接数和同时处理中的请求数"""
+
+    def __init__(self):
+        self.open_connections = 0
+        self.peak_connections = 0
+        self.total_connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        self.open_connections += 1
+        self.total_connections += 1
+        self.peak_connections = max(self.peak_connections, self.open_connections)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.decode().split("\r\n"):
+                    if line.lower().startswith("content-length:"):
+                        length = int(line.split(":", 1)[1])
+                await reader.readexactly(length)
+
+                self.requests += 1
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                await asyncio.sleep(RESPONSE_DELAY)
+                self.in_flight -= 1
+
+                body = json.dumps({
+                    "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "test-model",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "ok"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+                }).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            self.open_connections -= 1
+            writer.close()
+
+async def _start_fake_server(monkeypatch, max_connections: int):
+    """启动假的模型服务，返回 (服务, 指向它且使用指定连接池上限的 AIService, 关闭函数)"""
+    fake = FakeChatServer()
+    server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{port}/v1")
+    monkeypatch.setenv("AI_HTTP_MAX_CONNECTIONS", str(max_connections))
+    monkeypatch.setenv("AI_HTTP_MAX_KEEPALIVE", str(max_connections))
+    service = AIService()
+
+    async def close():
+        await service.http_client.aclose()
+        server.close()
+        await server.wait_closed()
+
+    return fake, service, close
+
+async def _run_load(monkeypatch, max_connections: int, calls: int):
+    fake, service, close = await _start_fake_server(monkeypatch, max_connections)
+
+    started = time.monotonic()
+    try:
+        results = await asyncio.gather(*[
+            service.complete([{"role": "user", "content": f"hi {i}"}], temperature=0.7, model="test-model", use_cache=False)
+            for i in range(calls)
+        ])
+    finally:
+        await close()
+    return fake, results, time.monotonic() - started
+
+def test_concurrent_calls_respect_pool_limit(monkeypatch):
+    fake, results, elapsed = asyncio.run(_run_load(monkeypatch, max_connections=4, calls=40))
+
+    assert results == ["ok"] * 40
+    assert fake.requests == 40
+    # 连接数和并发请求数都不超过连接池上限
+    assert fake.peak_connections <= 4
+    assert fake.peak_in_flight == 4
+    # 连接被复用，而不是每次请求新建
+    assert fake.total_connections <= 4
+    # 40个请求以4路并发完成，约10轮（串行需要40轮）
+    assert elapsed < 40 * RESPONSE_DELAY / 2
+
+def test_concurrent_message_requests_share_the_pool(db, make_user, scenario, auth_headers, monkeypatch):
+    user, persona = make_user("alice")
+    conversations = [
+        Conversation(user_id=user.id, digital_persona_id=persona.id, scenario_id=scenario.id) for _ in range(20)
+    ]
+    db.add_all(conversations)
+    db.commit()
+    conversation_ids = [conversation.id for conversation in conversations]
+    headers = auth_headers(user)
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v1")
+
+    async def run():
+        fake, service, close = await _start_fake_server(monkeypatch, max_connections=4)
+        # 接口使用全局的 ai_service，换成指向假服务的客户端
+        monkeypatch.setattr(ai_service, "http_client", service.http_client)
+        monkeypatch.setattr(ai_service, "client", service.client)
+        monkeypatch.setattr(ai_service, "ai_provider", "openai")
+
+        started = time.monotonic()
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                responses = await asyncio.gather(*[
+                    client.post("/api/v1/messages", headers=headers,
+                                json={"conversation_id": conversation_id, "content": "你好"})
+                    for conversation_id in conversation_ids
+                ])
+        finally:
+            await close()
+        return fake, responses, time.monotonic() - started
+
+    fake, responses, elapsed = asyncio.run(run())
+
+    assert [r.status_code for r in responses] == [200] * 20
+    assert [r.json()["content"] for r in responses] == ["ok"] * 20
+    assert fake.requests == 20
+    assert fake.peak_connections <= 4 and fake.total_connections <= 4
+    assert fake.peak_in_flight == 4
+    assert elapsed < 20 * RESPONSE_DELAY / 2
+
+    db.expire_all()
+    replies = db.query(ConversationMessage).filter(ConversationMessage.sender_type == "agent").count()
+    assert replies == 20
@@ -0,0 +1,97 @@
+"""
+自动对话的流水线模式与串行模式结果一致：保存的消息、结束轮次、终止原因和评估结果相同；
+自然结束时预先生成的下一轮回复被丢弃，不保存、不计入轮次
+"""
+
+import asyncio
+
+import pytest
+
+from models.database import AutoConversationMessage, MatchEvaluation
+from services.ai_service import AIService
+from services.match_service import MatchService
+
+MAX_TURNS = 6
+
+@pytest.fixture
+def match(make_user, make_market_agent, make_match):
+    alice, alice_persona = make_user("alice")
+    bob, bob_persona = make_user("bob")
+    return make_match(
+        make_market_agent(alice, alice_persona, display_name="小王"),
+        make_market_agent(bob, bob_persona, display_name="小李")
+    )
+
+def _fake_service(monkeypatch, end_after):
+    """回复、结束判断和评估都是确定的，并带有不同的耗时以让流水线中的任务交错执行"""
+    service = MatchService(AIService())
+    generated = []
+
+    async def generate_reply(scenario, sender, receiver, persona, context):
+        generated.append(len(context))
+        await asyncio.sleep(0.01)
+        return f"{sender.display_name}第{len(context)}句", {"model_used": "fake"}
+
+    async def should_end(context, scenario, auto_conversation_id):
+        await asyncio.sleep(0.02)
+        return end_after is not None and len(context) >= end_after
+
+    async def evaluate_message(message, sender_agent, receiver_agent, conversation_context, match_type):
+        await asyncio.sleep(0.005)
+        return len(message) / 10, 0.5, f"评估:{message}"
+
+    async def evaluate_conversation(conversation_context, agent1, agent2, match_type):
+        return [(len(m["content"]) / 10, 0.5, f"评估:{m['content']}") for m in conversation_context]
+
+    monkeypatch.setattr(service, "_generate_turn_reply", generate_reply)
+    monkeypatch.setattr(service, "_should_end_conversation", should_end)
+    monkeypatch.setattr(service, "evaluate_message_compatibility", evaluate_message)
+    monkeypatch.setattr(service, "evaluate_conversation_compatibility", evaluate_conversation)
+    monkeypatch.setattr("services.match_service.random.choice", lambda options: options[0])
+    return service, generated
+
+def _outcome(db, auto_conv):
+    messages = db.query(AutoConversationMessage).filter(
+        AutoConversationMessage.auto_conversation_id == auto_conv.id
+    ).order_by(AutoConversationMessage.message_index).all()
+    evaluations = {
+        e.message_id: (e.love_score_delta, e.friendship_score_delta, e.evaluation_reason)
+        for e in db.query(MatchEvaluation).filter(MatchEvaluation.auto_conversation_id == auto_conv.id)
+    }
+    return {
+        "messages": [(m.sender_agent_id, m.content, m.message_index) for m in messages],
+        "evaluations": [evaluations.get(m.id) for m in messages],
+        "status": auto_conv.status,
+        "actual_turns": auto_conv.actual_turns,
+        "termination_reason": auto_conv.termination_reason,
+        "scores": (auto_conv.round_love_score, auto_conv.round_friendship_score),
+    }
+
+@pytest.mark.parametrize("evaluation_mode", ["per_message", "batch"])
+@pytest.mark.parametrize("end_after, expected_turns, expected_reason", [
+    (3, 3, "natural_end"),
+    (MAX_TURNS, MAX_TURNS, "natural_end"),
+    (None, MAX_TURNS, "max_turns"),
+])
+def test_pipelined_matches_sequential(db, match, scenario, monkeypatch,
+                                      evaluation_mode, end_after, expected_turns, expected_reason):
+    outcomes, generated_counts = {}, {}
+    for pipelined in (False, True):
+        service, generated = _fake_service(monkeypatch, end_after)
+        auto_conv = asyncio.run(service.conduct_auto_conversation(
+            match_relation=match, scenario=scenario, max_turns=MAX_TURNS, db=db,
+            pipelined=pipelined, evaluation_mode=evaluation_mode
+        ))
+        outcomes[pipelined] = _outcome(db, auto_conv)
+        generated_counts[pipelined] = len(generated)
+
+    assert outcomes[True] == outcomes[False]
+    assert outcomes[True]["status"] == "completed"
+    assert outcomes[True]["actual_turns"] == expected_turns
+    assert outcomes[True]["termination_reason"] == expected_reason
+    assert all(evaluation is not None for evaluation in outcomes[True]["evaluations"])
+
+    # 串行模式只生成保存的回复；流水线模式在对话提前自然结束时多生成（并丢弃）一条下一轮的回复
+    speculative = 1 if expected_reason == "natural_end" and expected_turns < MAX_TURNS else 0
+    assert generated_counts[False] == expected_turns
+    assert generated_counts[True] == expected_turns + speculative
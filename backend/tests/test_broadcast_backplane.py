@@ -0,0 +1,148 @@
+"""
+Redis 广播背板（使用 fakeredis）：一个节点上的广播经会话频道投递到另一个节点上的连接；
+节点只订阅本地有连接的会话；在线状态在节点间共享，节点崩溃后登记过期
+"""
+
+import asyncio
+import json
+
+import fakeredis
+import pytest
+
+from services.broadcast_backplane import RedisBackplane
+from services.websocket_service import ConnectionManager
+
+class FakeWebSocket:
+    def __init__(self):
+        self.received = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload: str):
+        self.received.append(json.loads(payload))
+
+    def of_type(self, message_type: str):
+        return [m for m in self.received if m["type"] == message_type]
+
+async def _wait_for(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("等待背板投递超时")
+        await asyncio.sleep(0.01)
+
+async def _node(**options) -> ConnectionManager:
+    manager = ConnectionManager()
+    manager.backplane = RedisBackplane("redis://fake", **options)
+    await manager.start_backplane()
+    return manager
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.asyncio, "from_url", lambda url: fakeredis.aioredis.FakeRedis(server=server))
+    return server
+
+def _subscribed_sessions(manager: ConnectionManager):
+    prefix = f"{manager.backplane.prefix}:session:".encode()
+    return {channel[len(prefix):].decode() for channel in manager.backplane.pubsub.channels if channel.startswith(prefix)}
+
+def test_broadcast_reaches_subscriber_on_another_node():
+    async def scenario():
+        node_a, node_b = await _node(), await _node()
+        try:
+            alice, bob, carol = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+            await node_a.connect(alice, "alice", "session-1")
+            await node_b.connect(bob, "bob", "session-1")
+            await node_b.connect(carol, "carol", "session-2")
+
+            # 节点A上的上线状态到达节点B上的bob
+            await _wait_for(lambda: bob.of_type("user_status"))
+            assert bob.of_type("user_status")[0]["userId"] == "alice"
+
+            await node_a.broadcast_to_session({"type": "message", "content": "你好"}, "session-1")
+            await node_a.handle_typing_status("alice", "session-1", True)
+
+            await _wait_for(lambda: bob.of_type("message") and bob.of_type("typing"))
+            assert bob.of_type("message") == [{"type": "message", "content": "你好"}]
+
+            # 发布节点不会重复投递自己的广播，被排除的发送者收不到自己的输入状态，其他会话不受影响
+            await asyncio.sleep(0.1)
+            assert len(alice.of_type("message")) == 1
+            assert alice.of_type("typing") == []
+            assert carol.of_type("message") == [] and carol.of_type("typing") == []
+        finally:
+            await node_a.stop_backplane()
+            await node_b.stop_backplane()
+
+    asyncio.run(scenario())
+
+
+def test_nodes_subscribe_only_to_local_sessions():
+    async def scenario():
+        node_a, node_b = await _node(), await _node()
+        try:
+            alice, carol = FakeWebSocket(), FakeWebSocket()
+            await node_a.connect(alice, "alice", "session-1")
+            await node_b.connect(carol, "carol", "session-2")
+            assert _subscribed_sessions(node_a) == {"session-1"}
+            assert _subscribed_sessions(node_b) == {"session-2"}
+
+            # 会话频道的订阅者只有本地有连接的节点
+            channel = node_a.backplane._channel("session-1")
+            assert await node_a.backplane.redis.pubsub_numsub(channel) == [(channel.encode(), 1)]
+
+            # 会话在节点上的最后一个连接断开后取消订阅
+            await node_b.disconnect("carol", "session-2")
+            assert _subscribed_sessions(node_b) == set()
+        finally:
+            await node_a.stop_backplane()
+            await node_b.stop_backplane()
+
+    asyncio.run(scenario())
+
+def test_presence_is_shared_across_nodes():
+    async def scenario():
+        node_a, node_b = await _node(), await _node()
+        try:
+            alice, bob = FakeWebSocket(), FakeWebSocket()
+            await node_a.connect(alice, "alice", "session-1")
+            # 等待节点A的上线广播发布完，bob 的初始状态只能来自共享的在线登记
+            await asyncio.sleep(0.05)
+            await node_b.connect(bob, "bob", "session-1")
+
+            initial = [m["userId"] for m in bob.of_type("user_status") if m["isOnline"]]
+            assert initial == ["alice"]
+            assert await node_b.get_online_users_in_session("session-1") == {"alice", "bob"}
+
+            await node_a.disconnect("alice", "session-1")
+            assert await node_b.get_online_users_in_session("session-1") == {"bob"}
+            await _wait_for(lambda: any(not m["isOnline"] for m in bob.of_type("user_status")))
+        finally:
+            await node_a.stop_backplane()
+            await node_b.stop_backplane()
+
+    asyncio.run(scenario())
+
+def test_presence_of_crashed_node_expires():
+    async def scenario():
+        node_a, node_b = await _node(presence_ttl=0.3), await _node(presence_ttl=0.3)
+        try:
+            await node_a.connect(FakeWebSocket(), "alice", "session-1")
+            await node_b.connect(FakeWebSocket(), "bob", "session-1")
+
+            # 正常运行时定期续期，超过TTL仍然在线
+            await asyncio.sleep(0.5)
+            assert await node_b.get_online_users_in_session("session-1") == {"alice", "bob"}
+
+            # 节点A崩溃：停止续期且没有撤销登记
+            node_a.backplane.refresh_task.cancel()
+            await asyncio.sleep(0.5)
+            assert await node_b.get_online_users_in_session("session-1") == {"bob"}
+        finally:
+            await node_b.stop_backplane()
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+"""
+对话上下文折叠：未折叠的历史超过条数上限时，较早的消息按顺序逐块合并进摘要，每次请求最多一块；
+摘要失败时未能折叠的消息仍在上下文中
+"""
+
+import asyncio
+
+import pytest
+
+from models.database import Conversation, ConversationMessage
+from services.ai_service import ai_service
+from services.conversation_context import ConversationContextBuilder
+
+@pytest.fixture
+def conversation(db, make_user, scenario):
+    user, persona = make_user("alice")
+    conversation = Conversation(user_id=user.id, digital_persona_id=persona.id, scenario_id=scenario.id, title="长对话")
+    db.add(conversation)
+    db.flush()
+    db.add_all([
+        ConversationMessage(conversation_id=conversation.id, sender_type="user" if i % 2 else "agent",
+                            content=f"消息{i}", message_index=i)
+        for i in range(100)
+    ])
+    db.commit()
+    return conversation
+
+@pytest.fixture
+def builder(monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_MAX_MESSAGES", "10")
+    monkeypatch.setenv("CHAT_HISTORY_TOKEN_BUDGET", "100000")
+    return ConversationContextBuilder()
+
+def _summarizer(monkeypatch, fail_on_call=None):
+    """记录每次被折叠的消息；摘要为已折叠内容的拼接"""
+    calls = []
+
+    async def summarize(previous_summary, messages):
+        calls.append([m["content"] for m in messages])
+        if fail_on_call == len(calls):
+            return None
+        return (previous_summary or "") + "".join(m["content"] for m in messages)
+
+    monkeypatch.setattr(ai_service, "summarize_conversation", summarize)
+    return calls
+
+def test_folds_one_chunk_per_request(db, conversation, builder, monkeypatch):
+    calls = _summarizer(monkeypatch)
+
+    history, summary = asyncio.run(builder.build(db, conversation))
+
+    # 第一次只折叠最早的一块；积压未折叠完时使用条数上限内的最新原文
+    assert calls == [[f"消息{i}" for i in range(10)]]
+    assert conversation.summary_until_index == 9
+    assert [m["content"] for m in history] == [f"消息{i}" for i in range(90, 100)]
+
+    builds = 1
+    while conversation.summary_until_index < 94:
+        history, summary = asyncio.run(builder.build(db, conversation))
+        builds += 1
+        assert len(calls) == builds
+
+    # 之后的请求逐块折叠，不跳过窗口之外的旧消息；最终保留最新的5条（条数上限的一半）
+    folded = [content for chunk in calls for content in chunk]
+    assert folded == [f"消息{i}" for i in range(95)]
+    assert builds == 10
+    assert [m["content"] for m in history] == [f"消息{i}" for i in range(95, 100)]
+    assert summary == "".join(folded)
+
+def test_failed_summary_keeps_unsummarized_messages(db, conversation, builder, monkeypatch):
+    calls = _summarizer(monkeypatch)
+    for _ in range(9):
+        asyncio.run(builder.build(db, conversation))
+    assert conversation.summary_until_index == 89
+    db.commit()
+
+    # 折叠 90-94 失败：这几条不在摘要中，仍作为原文放入上下文
+    _summarizer(monkeypatch, fail_on_call=1)
+    history, summary = asyncio.run(builder.build(db, conversation))
+    assert conversation.summary_until_index == 89
+    assert [m["content"] for m in history] == [f"消息{i}" for i in range(90, 100)]
+    assert summary == "".join(content for chunk in calls for content in chunk)
+
+    # 下一轮从失败的位置重试
+    calls = _summarizer(monkeypatch)
+    history, _ = asyncio.run(builder.build(db, conversation))
+    assert calls == [[f"消息{i}" for i in range(90, 95)]]
+    assert [m["content"] for m in history] == [f"消息{i}" for i in range(95, 100)]
+
+def test_history_within_token_budget_when_summary_fails(db, conversation, monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_MAX_MESSAGES", "40")
+    monkeypatch.setenv("CHAT_HISTORY_TOKEN_BUDGET", "8")
+    monkeypatch.setattr(ai_service, "count_tokens", lambda text: 1)
+    _summarizer(monkeypatch, fail_on_call=1)
+
+    history, summary = asyncio.run(ConversationContextBuilder().build(db, conversation))
+
+    # 无法摘要时按完整预算截断原文（而不是只保留一半预算）
+    assert summary is None
+    assert [m["content"] for m in history] == [f"消息{i}" for i in range(92, 100)]
@@ -0,0 +1,61 @@
+"""
+自动对话结束预筛：简短但有内容的中文对话不会被判定为敷衍，影子规则只记录、以LLM结论为准
+"""
+
+import asyncio
+
+import pytest
+
+from services.ai_service import AIService
+from services.conversation_end_detector import ConversationEndHeuristic
+from services.match_service import MatchService
+
+def _context(*contents):
+    return [{"sender": "A" if i % 2 == 0 else "B", "content": c} for i, c in enumerate(contents)]
+
+@pytest.fixture
+def heuristic():
+    return ConversationEndHeuristic()
+
+def test_short_but_engaged_chat_is_not_a_short_reply_streak(heuristic):
+    # 最后三条都不超过6个字，旧规则会在这里结束对话
+    context = _context("周末去哪了", "去爬香山了", "红叶好看吗", "特别美", "下次带我", "好呀一起")
+    assert heuristic.classify(context)[1] != "short_reply_streak"
+
+@pytest.mark.parametrize("contents", [
+    ("你喜欢看电影吗？", "还行吧", "嗯", "哦", "好的"),
+    ("最近挺忙的", "加油", "嗯嗯", "先走了", "好"),
+])
+def test_filler_or_farewell_streak_is_detected(heuristic, contents):
+    assert heuristic.classify(_context(*contents)) == (True, "short_reply_streak")
+
+def test_short_reply_streak_is_shadowed_by_default(heuristic):
+    assert heuristic.is_shadow("short_reply_streak")
+    assert not heuristic.is_shadow("mutual_farewell")
+
+def test_shadow_rule_defers_to_llm(monkeypatch):
+    service = MatchService(AIService())
+    llm_calls = []
+
+    async def llm_should_end(conversation_context, scenario):
+        llm_calls.append(conversation_context)
+        return False
+
+    monkeypatch.setattr(service, "_llm_should_end_conversation", llm_should_end)
+    context = _context("你喜欢看电影吗？", "还行吧", "嗯", "哦", "好的")
+
+    assert asyncio.run(service._should_end_conversation(context, scenario=None)) is False
+    assert len(llm_calls) == 1
+
+def test_enforced_rule_ends_without_llm(monkeypatch):
+    monkeypatch.setenv("CONVERSATION_END_SHADOW_RULES", "")
+    monkeypatch.setattr("services.match_service.conversation_end_heuristic", ConversationEndHeuristic())
+    service = MatchService(AIService())
+
+    async def llm_should_end(conversation_context, scenario):
+        raise AssertionError("不应调用LLM")
+
+    monkeypatch.setattr(service, "_llm_should_end_conversation", llm_should_end)
+    context = _context("你喜欢看电影吗？", "还行吧", "嗯", "哦", "好的")
+
+    assert asyncio.run(service._should_end_conversation(context, scenario=None)) is True
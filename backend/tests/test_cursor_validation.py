@@ -0,0 +1,75 @@
+"""
+游标分页：格式错误或缺少排序键的游标返回400，而不是500
+"""
+
+import pytest
+
+from api.pagination import NEXT, PREV, encode_cursor
+from services.chat_service import chat_service
+
+@pytest.fixture
+def alice(make_user):
+    user, _ = make_user("alice")
+    return user
+
+@pytest.mark.parametrize("cursor", [
+    "not-a-cursor",
+    encode_cursor(NEXT, id="x"),
+    encode_cursor(NEXT, updated_at="yesterday", id="x"),
+])
+def test_conversation_list_rejects_bad_cursor(client, auth_headers, alice, cursor):
+    response = client.get(f"/api/v1/conversations/paginated?cursor={cursor}", headers=auth_headers(alice))
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor(NEXT, id="x"),
+    encode_cursor(NEXT, score=None, id="x"),
+    encode_cursor(PREV, score=0.5, id="x"),
+])
+def test_match_list_rejects_bad_cursor(client, auth_headers, alice, cursor):
+    response = client.get(f"/api/v1/match-relations?cursor={cursor}", headers=auth_headers(alice))
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor(NEXT, id="x"),
+    encode_cursor(NEXT, last="yesterday", id="x"),
+    encode_cursor(NEXT, last=None, id="x"),
+    encode_cursor(NEXT, rank="0.5", id="x"),
+    encode_cursor(NEXT, rank=True, id="x"),
+    encode_cursor(NEXT, rank=-1.5, id=3),
+    encode_cursor(PREV, rank=-1.5, id="x"),
+])
+def test_market_list_rejects_bad_cursor(client, auth_headers, alice, cursor):
+    response = client.get(f"/api/v1/market-agents?cursor={cursor}", headers=auth_headers(alice))
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor(NEXT, rank=-1.5, id="x"),
+    encode_cursor(NEXT, last="2026-01-01T00:00:00", id="x"),
+])
+def test_market_list_accepts_valid_cursor(client, auth_headers, alice, cursor):
+    response = client.get(f"/api/v1/market-agents?cursor={cursor}", headers=auth_headers(alice))
+    assert response.status_code == 200
+
+@pytest.mark.parametrize("cursor", [encode_cursor(NEXT), encode_cursor(PREV, id="x")])
+def test_chat_messages_reject_cursor_without_sequence(client, auth_headers, db, alice, make_user, cursor):
+    bob, _ = make_user("bob")
+    session = chat_service.get_or_create_chat_session(db, alice.id, bob.id)
+
+    response = client.get(
+        f"/api/v1/chat-sessions/{session.id}/messages?cursor={cursor}", headers=auth_headers(alice)
+    )
+    assert response.status_code == 400
+
+def test_valid_cursor_still_pages(client, auth_headers, db, alice, make_user):
+    bob, _ = make_user("bob")
+    session = chat_service.get_or_create_chat_session(db, alice.id, bob.id)
+    for content in ("1", "2", "3"):
+        chat_service.send_message(db, session.id, alice.id, content)
+
+    response = client.get(
+        f"/api/v1/chat-sessions/{session.id}/messages?cursor={encode_cursor(PREV, seq=1)}",
+        headers=auth_headers(alice)
+    )
+    assert response.status_code == 200
+    assert [m["sequence_number"] for m in response.json()] == [2, 3]
@@ -0,0 +1,96 @@
+"""
+显示名称缓存：未命中的用户一次批量查询加载，命中时不查询数据库；
+消息历史接口的查询次数与页面大小无关（逐条查询发送者时随消息数线性增长）
+"""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from models.database import ChatSession, RealTimeMessage, User, engine
+from services.chat_service import chat_service
+from services.display_name_cache import DisplayNameCache, display_name_cache
+
+PAGE_SIZES = [50, 200, 1000]
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def _make_users(db, count):
+    users = [User(username=f"user{i}", email=f"user{i}@example.com", hashed_password="x") for i in range(count)]
+    db.add_all(users)
+    db.commit()
+    return [user.id for user in users]
+
+@pytest.mark.parametrize("count", PAGE_SIZES)
+def test_cold_lookup_is_one_query_and_hits_are_free(db, count):
+    user_ids = _make_users(db, count)
+    cache = DisplayNameCache()
+
+    with count_queries() as cold:
+        names = cache.get_display_names(db, user_ids)
+    with count_queries() as warm:
+        for _ in range(10):
+            assert cache.get_display_names(db, user_ids) == names
+
+    # 未命中的用户一次 IN 查询加载（而不是每个用户一次），命中路径不再查询
+    assert len(cold) == 1
+    assert warm == []
+    assert names[user_ids[0]] == "user0" and len(names) == count
+
+def test_only_missing_users_are_loaded(db):
+    user_ids = _make_users(db, 10)
+    cache = DisplayNameCache()
+    cache.get_display_names(db, user_ids[:5])
+    cache.invalidate(user_ids[0])
+
+    with count_queries() as statements:
+        names = cache.get_display_names(db, user_ids)
+
+    assert len(statements) == 1
+    assert len(names) == 10
+
+def _fill_session(db, session_id, senders, count):
+    db.add_all([
+        RealTimeMessage(chat_session_id=session_id, sender_user_id=senders[i % 2], content=str(i), sequence_number=i + 1)
+        for i in range(count)
+    ])
+    db.query(ChatSession).filter(ChatSession.id == session_id).update({"last_sequence_number": count})
+    db.commit()
+
+@pytest.mark.parametrize("limit", PAGE_SIZES)
+def test_history_endpoint_resolves_names_once_per_page(client, auth_headers, db, make_user, limit):
+    alice, _ = make_user("alice")
+    bob, _ = make_user("bob")
+    session = chat_service.get_or_create_chat_session(db, alice.id, bob.id)
+    session_id, headers = session.id, auth_headers(alice)
+    _fill_session(db, session_id, [bob.id, alice.id], max(PAGE_SIZES))
+    for user in (alice, bob):
+        display_name_cache.invalidate(user.id)
+
+    def fetch(page_size):
+        with count_queries() as statements:
+            response = client.get(f"/api/v1/chat-sessions/{session_id}/messages?limit={page_size}", headers=headers)
+        assert response.status_code == 200
+        assert len(response.json()) == page_size
+        assert {m["sender_name"] for m in response.json()} == {"alice", "bob"}
+        return len(statements)
+
+    cold = fetch(limit)
+    warm = fetch(limit)
+    baseline = fetch(2)
+
+    # 冷缓存比热缓存只多一次批量查询；热缓存时整页的查询次数与只取两条消息相同
+    assert cold == warm + 1
+    assert warm == baseline
@@ -0,0 +1,122 @@
+"""
+LLM响应缓存：内存层LRU淘汰与TTL过期、SQLite磁盘层跨实例命中、只缓存低温度的调用
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import ai_service as ai_module
+from services.ai_service import ai_service
+from services.llm_cache import LLMResponseCache
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("services.llm_cache.time.time", clock.time)
+    return clock
+
+@pytest.fixture
+def make_cache(monkeypatch):
+    caches = []
+
+    def make(**env):
+        monkeypatch.setenv("LLM_CACHE_ENABLED", "true")
+        monkeypatch.delenv("LLM_CACHE_PATH", raising=False)
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        cache = LLMResponseCache()
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.close()
+
+def test_lru_evicts_least_recently_used(make_cache, clock):
+    cache = make_cache(LLM_CACHE_SIZE=2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"  # a 变为最近使用
+
+    cache.set("c", "C")
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+    assert cache.get_stats()["evictions"] == 1
+
+def test_entries_expire_after_ttl(make_cache, clock):
+    cache = make_cache(LLM_CACHE_TTL=60)
+    cache.set("a", "A")
+
+    clock.now += 59
+    assert cache.get("a") == "A"
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.get_stats()["memory_entries"] == 0
+
+def test_disk_tier_survives_restart(make_cache, clock, tmp_path):
+    path = tmp_path / "llm_cache.db"
+    first = make_cache(LLM_CACHE_PATH=path, LLM_CACHE_TTL=60)
+    first.set("a", "A")
+    first.close()
+
+    # 新实例（进程重启）内存为空，从磁盘命中后回填内存
+    second = make_cache(LLM_CACHE_PATH=path, LLM_CACHE_TTL=60)
+    assert second.get("a") == "A"
+    assert second.get("a") == "A"
+    stats = second.get_stats()
+    assert (stats["disk_hits"], stats["hits"], stats["disk_enabled"]) == (1, 1, True)
+
+    # 磁盘上的条目同样按TTL过期
+    clock.now += 61
+    third = make_cache(LLM_CACHE_PATH=path, LLM_CACHE_TTL=60)
+    assert third.get("a") is None
+
+def test_should_cache_only_low_temperature(make_cache):
+    cache = make_cache(LLM_CACHE_MAX_TEMPERATURE=0.3)
+    assert cache.should_cache(0.0) and cache.should_cache(0.3)
+    assert not cache.should_cache(0.7)
+
+    cache.enabled = False
+    assert not cache.should_cache(0.0)
+
+@pytest.mark.parametrize("temperature, calls", [(0.0, 1), (0.7, 2)])
+def test_complete_caches_by_temperature(make_cache, monkeypatch, temperature, calls):
+    monkeypatch.setattr(ai_service, "response_cache", make_cache())
+    requests = []
+
+    async def fake_call(provider, model, request_fn, estimated_tokens=0):
+        requests.append(model)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"回复{len(requests)}"))])
+    monkeypatch.setattr(ai_module.llm_gateway, "call", fake_call)
+
+    messages = [{"role": "user", "content": "你好"}]
+    results = [asyncio.run(ai_service.complete(messages, temperature=temperature)) for _ in range(2)]
+
+    assert len(requests) == calls
+    assert results == (["回复1", "回复1"] if calls == 1 else ["回复1", "回复2"])
+
+def test_initial_prompt_is_not_cached(make_cache, monkeypatch):
+    monkeypatch.setattr(ai_service, "response_cache", make_cache())
+    monkeypatch.setattr(ai_service, "ai_provider", "openai")
+    requests = []
+
+    async def fake_call(provider, model, request_fn, estimated_tokens=0):
+        requests.append(model)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"人格{len(requests)}"))])
+    monkeypatch.setattr(ai_module.llm_gateway, "call", fake_call)
+
+    info = {"username": "alice"}
+    prompts = [asyncio.run(ai_service.generate_initial_prompt(info, "喜欢爬山")) for _ in range(2)]
+
+    # 高温度生成，每次都重新请求
+    assert prompts == ["人格1", "人格2"]
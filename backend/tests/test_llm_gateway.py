@@ -0,0 +1,278 @@
+"""
+LLM网关与限流原语（假时钟、假客户端）：
+优先级信号量按通道唤醒并为交互请求预留名额；RPM/TPM令牌桶；429/5xx 按 Retry-After 重试
+"""
+
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from services.llm_gateway import BACKGROUND, INTERACTIVE, LLMGateway, ProviderHTTPError
+from services.rate_limit import PrioritySemaphore, TokenBucket
+
+class FakeClock:
+    """替换 time.monotonic 与 asyncio.sleep：sleep 立即推进时钟并记录时长"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self.on_sleep = None
+        self._real_sleep = asyncio.sleep
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        if self.on_sleep:
+            self.on_sleep()
+        self.sleeps.append(round(delay, 3))
+        self.now += delay
+        await self._real_sleep(0)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("services.rate_limit.time.monotonic", clock.monotonic)
+    monkeypatch.setattr(asyncio, "sleep", clock.sleep)
+    return clock
+
+@pytest.fixture
+def new_gateway(monkeypatch):
+    def make(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        return LLMGateway()
+    return make
+
+async def _settle():
+    """让已就绪的协程都运行到下一个等待点"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+# ---------- 优先级信号量 ----------
+
+def test_waiters_wake_by_lane_then_arrival():
+    async def run():
+        semaphore = PrioritySemaphore(capacity=1)
+        await semaphore.acquire(INTERACTIVE)
+        order = []
+
+        async def waiter(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            semaphore.release()
+
+        tasks = []
+        for name, priority in [("bg1", BACKGROUND), ("chat1", INTERACTIVE), ("bg2", BACKGROUND), ("chat2", INTERACTIVE)]:
+            tasks.append(asyncio.create_task(waiter(name, priority)))
+            await _settle()
+
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        return order, semaphore.in_use
+
+    order, in_use = asyncio.run(run())
+    assert order == ["chat1", "chat2", "bg1", "bg2"]
+    assert in_use == 0
+
+def test_reserved_slots_only_for_interactive():
+    async def run():
+        semaphore = PrioritySemaphore(capacity=3, reserved=1)
+        await semaphore.acquire(BACKGROUND)
+        await semaphore.acquire(BACKGROUND)
+
+        # 后台请求占满非预留名额后排队，交互请求仍可直接使用预留名额
+        queued = asyncio.create_task(semaphore.acquire(BACKGROUND))
+        await _settle()
+        assert not queued.done() and semaphore.waiting == 1
+        await asyncio.wait_for(semaphore.acquire(INTERACTIVE), timeout=1)
+        assert semaphore.in_use == 3
+
+        # 交互请求释放的预留名额不会分给后台请求
+        semaphore.release()
+        await _settle()
+        assert not queued.done()
+
+        semaphore.release()
+        await _settle()
+        assert queued.done() and semaphore.in_use == 2
+
+    asyncio.run(run())
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def run():
+        semaphore = PrioritySemaphore(capacity=1)
+        await semaphore.acquire()
+        waiter = asyncio.create_task(semaphore.acquire(BACKGROUND))
+        await _settle()
+        waiter.cancel()
+        await _settle()
+
+        semaphore.release()
+        assert semaphore.in_use == 0 and semaphore.waiting == 0
+        await asyncio.wait_for(semaphore.acquire(BACKGROUND), timeout=1)
+
+    asyncio.run(run())
+
+def test_interactive_call_preempts_background_load(new_gateway):
+    gateway = new_gateway(LLM_MODEL_CONCURRENCY=2, LLM_PROVIDER_CONCURRENCY=2, LLM_INTERACTIVE_RESERVED=1)
+
+    async def run():
+        release = asyncio.Event()
+        finished = []
+
+        async def request(name):
+            await release.wait()
+            finished.append(name)
+            return name
+
+        async def background(name):
+            with gateway.lane(BACKGROUND):
+                return await gateway.call("openai", "m", lambda: request(name))
+
+        jobs = [asyncio.create_task(background(f"bg{i}")) for i in range(5)]
+        await _settle()
+        # 后台请求只能占用一个非预留名额，其余排队
+        assert gateway.get_stats()["models"]["openai:m"] == {"in_flight": 1, "waiting": 4}
+
+        async def chat():
+            return "chat"
+        assert await asyncio.wait_for(gateway.call("openai", "m", chat), timeout=1) == "chat"
+
+        release.set()
+        await asyncio.gather(*jobs)
+        return finished
+
+    assert asyncio.run(run()) == [f"bg{i}" for i in range(5)]
+
+# ---------- RPM / TPM 令牌桶 ----------
+
+def test_token_bucket_waits_for_refill(clock):
+    async def run():
+        bucket = TokenBucket(rate=1, capacity=2)
+        for _ in range(4):
+            await bucket.acquire()
+
+    asyncio.run(run())
+    # 容量内的请求不等待，之后每个请求等待一个令牌的补充时间
+    assert clock.sleeps == [1.0, 1.0]
+    assert clock.now == 2.0
+
+def test_token_bucket_caps_oversized_request(clock):
+    async def run():
+        bucket = TokenBucket(rate=10, capacity=100)
+        await bucket.acquire(80)
+        await bucket.acquire(500)  # 超过容量按容量计，不会永远等待
+
+    asyncio.run(run())
+    assert clock.sleeps == [8.0]
+
+def test_gateway_applies_rpm_and_tpm(clock, new_gateway):
+    gateway = new_gateway(LLM_RPM=2, LLM_TPM=600)
+
+    async def run():
+        async def request():
+            return "ok"
+        # 两次请求用满RPM；第三次等待请求令牌（60/2=30秒），期间也补足了token
+        for _ in range(3):
+            await gateway.call("openai", "m", request, estimated_tokens=300)
+
+    asyncio.run(run())
+    assert clock.sleeps == [30.0]
+    assert gateway.get_stats()["requests"] == 3
+
+def test_gateway_tpm_limits_large_requests(clock, new_gateway):
+    gateway = new_gateway(LLM_TPM=600)
+
+    async def run():
+        async def request():
+            return "ok"
+        await gateway.call("openai", "m", request, estimated_tokens=500)
+        await gateway.call("openai", "m", request, estimated_tokens=400)
+
+    asyncio.run(run())
+    # 剩余100个token，还需300个，按每秒10个补充
+    assert clock.sleeps == [30.0]
+
+def test_buckets_are_per_model(clock, new_gateway):
+    gateway = new_gateway(LLM_RPM=1)
+
+    async def run():
+        async def request():
+            return "ok"
+        await gateway.call("openai", "a", request)
+        await gateway.call("openai", "b", request)
+
+    asyncio.run(run())
+    assert clock.sleeps == []
+
+# ---------- 重试 ----------
+
+def _rate_limit_error(retry_after):
+    response = httpx.Response(
+        429, headers={"retry-after": retry_after}, request=httpx.Request("POST", "https://api.example.com")
+    )
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+class FakeClient:
+    """依次抛出预设的错误，之后返回成功；每次请求时确认持有并发名额"""
+
+    def __init__(self, gateway, errors):
+        self.gateway = gateway
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def create(self):
+        self.calls += 1
+        assert self.gateway.get_stats()["models"]["openai:m"]["in_flight"] == 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+def test_retries_follow_retry_after(clock, new_gateway):
+    gateway = new_gateway(LLM_MAX_RETRIES=3, LLM_RETRY_MAX_DELAY=20)
+    client = FakeClient(gateway, [
+        _rate_limit_error("2"),
+        ProviderHTTPError(503, "unavailable", retry_after="3"),
+        ProviderHTTPError(429, "slow down", retry_after="120"),
+    ])
+    in_flight_during_backoff = []
+    clock.on_sleep = lambda: in_flight_during_backoff.append(gateway.get_stats()["models"]["openai:m"]["in_flight"])
+
+    assert asyncio.run(gateway.call("openai", "m", client.create)) == "ok"
+    # 遵循服务端的 Retry-After，超过上限时按上限等待
+    assert clock.sleeps == [2.0, 3.0, 20.0]
+    assert client.calls == 4
+    # 退避期间不占用并发名额
+    assert in_flight_during_backoff == [0, 0, 0]
+    stats = gateway.get_stats()
+    assert (stats["retries"], stats["rate_limited"], stats["failures"]) == (3, 2, 0)
+
+def test_server_errors_without_retry_after_back_off_exponentially(clock, new_gateway, monkeypatch):
+    gateway = new_gateway(LLM_MAX_RETRIES=3, LLM_RETRY_BASE_DELAY=1)
+    monkeypatch.setattr("services.llm_gateway.random.uniform", lambda low, high: high)
+    client = FakeClient(gateway, [ProviderHTTPError(500, "error")] * 3)
+
+    assert asyncio.run(gateway.call("openai", "m", client.create)) == "ok"
+    assert clock.sleeps == [1.0, 2.0, 4.0]
+
+def test_gives_up_after_max_retries(clock, new_gateway):
+    gateway = new_gateway(LLM_MAX_RETRIES=2)
+    client = FakeClient(gateway, [_rate_limit_error("1")] * 3)
+
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(gateway.call("openai", "m", client.create))
+    assert clock.sleeps == [1.0, 1.0]
+    assert client.calls == 3
+    assert gateway.get_stats()["failures"] == 1
+
+def test_client_errors_are_not_retried(clock, new_gateway):
+    gateway = new_gateway()
+    client = FakeClient(gateway, [ProviderHTTPError(400, "bad request")])
+
+    with pytest.raises(ProviderHTTPError):
+        asyncio.run(gateway.call("openai", "m", client.create))
+    assert clock.sleeps == []
+    assert client.calls == 1
@@ -0,0 +1,85 @@
+"""
+市场检索：PostgreSQL 候选集按最近投放截取、描述为空时仍可检索名称；标签解析结果被缓存
+"""
+
+import json
+from types import SimpleNamespace
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from models.database import MarketAgent, engine
+from services.market_search_service import MarketSearchService
+
+def test_postgres_candidates_are_the_most_recent_matches():
+    service = MarketSearchService()
+    db = SimpleNamespace(bind=SimpleNamespace(dialect=SimpleNamespace(name="postgresql")))
+
+    candidates = service._ranked_candidates(db, ["喜欢聊天"], [MarketAgent.is_active == True])
+    sql = str(select(candidates).compile(dialect=postgresql.dialect())).lower()
+
+    # LIMIT 之前有确定的排序，截取的是最近投放的候选
+    assert "order by market_agents.last_interaction desc, market_agents.id desc" in sql
+    assert sql.index("order by") < sql.index("limit")
+    # 描述为 NULL 时名称仍可被检索
+    assert "coalesce(market_agents.display_description, '')" in sql
+
+def test_search_by_text_and_tags(db, make_user, make_market_agent):
+    alice, alice_persona = make_user("alice")
+    bob, bob_persona = make_user("bob")
+    make_market_agent(alice, alice_persona, display_name="爱爬山的小王", tags=["户外", "Hiking"])
+    make_market_agent(bob, bob_persona, display_name="读书的小李", tags=["阅读"])
+
+    service = MarketSearchService()
+    by_text = service.search(db, market_type="love", query="爱爬山")
+    by_tag = service.search(db, tags=["hiking"])
+
+    assert [agent.display_name for agent, _ in by_text] == ["爱爬山的小王"]
+    assert [agent.display_name for agent, _ in by_tag] == ["爱爬山的小王"]
+    assert by_tag[0][0].tag_list == ["户外", "Hiking"]
+
+def test_tag_list_is_parsed_once_until_tags_change(monkeypatch):
+    agent = MarketAgent(tags=json.dumps(["音乐", "电影"]))
+    calls = []
+    loads = json.loads
+
+    def counting_loads(value):
+        calls.append(value)
+        return loads(value)
+
+    monkeypatch.setattr("models.database.json.loads", counting_loads)
+
+    for _ in range(5):
+        assert agent.tag_list == ["音乐", "电影"]
+    assert len(calls) == 1
+
+    # 调用方修改返回的列表不影响缓存
+    agent.tag_list.append("旅行")
+    assert agent.tag_list == ["音乐", "电影"]
+
+    agent.tags = json.dumps(["旅行"])
+    assert agent.tag_list == ["旅行"]
+    assert len(calls) == 2
+
+def test_text_index_follows_updates_deletes_and_vacuum(db, make_user, make_market_agent):
+    alice, alice_persona = make_user("alice")
+    bob, bob_persona = make_user("bob")
+    carol, carol_persona = make_user("carol")
+    first = make_market_agent(alice, alice_persona, display_name="爱爬山的小王")
+    make_market_agent(bob, bob_persona, display_name="读书的小李")
+    make_market_agent(carol, carol_persona, display_name="爱爬山的小张")
+
+    # 删除留下 rowid 空洞，VACUUM 可能重新编号 market_agents 的隐式 rowid
+    db.delete(first)
+    db.commit()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("VACUUM")
+
+    service = MarketSearchService()
+    assert [agent.display_name for agent, _ in service.search(db, query="爱爬山")] == ["爱爬山的小张"]
+
+    renamed = db.query(MarketAgent).filter(MarketAgent.user_id == bob.id).one()
+    renamed.display_name = "爱爬山的小李"
+    db.commit()
+    assert {agent.display_name for agent, _ in service.search(db, query="爱爬山")} == {"爱爬山的小张", "爱爬山的小李"}
+    assert service.search(db, query="读书的") == []
@@ -0,0 +1,95 @@
+"""
+匹配度评估模式的校验；批量评估结果的解析（格式错误、缺失条目、分数限制）
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from services.ai_service import AIService
+from services.match_service import DEFAULT_EVALUATION_MODE, MatchService
+
+def test_unknown_env_mode_falls_back_to_default(monkeypatch, capsys):
+    monkeypatch.setenv("MATCH_EVALUATION_MODE", "per-message")
+    service = MatchService(AIService())
+
+    assert service.evaluation_mode == DEFAULT_EVALUATION_MODE
+    assert "MATCH_EVALUATION_MODE" in capsys.readouterr().out
+
+@pytest.mark.parametrize("value, expected", [("batch", "batch"), (" PER_MESSAGE ", "per_message")])
+def test_supported_env_modes(monkeypatch, value, expected):
+    monkeypatch.setenv("MATCH_EVALUATION_MODE", value)
+    assert MatchService(AIService()).evaluation_mode == expected
+
+def test_unknown_explicit_mode_is_rejected():
+    service = MatchService(AIService())
+    with pytest.raises(ValueError):
+        asyncio.run(service.conduct_auto_conversation(
+            match_relation=None, scenario=None, db=None, evaluation_mode="everything"
+        ))
+
+# ---------- 批量评估结果解析 ----------
+
+class _Agent:
+    display_name = "小王"
+    display_description = "喜欢聊天"
+
+CONTEXT = [
+    {"sender": "小王", "content": "你好"},
+    {"sender": "小李", "content": "你好呀"},
+    {"sender": "小王", "content": "周末去爬山吗"},
+]
+DEFAULT = (0.0, 0.0, "评估解析失败")
+
+def _evaluate_batch(monkeypatch, reply):
+    service = MatchService(AIService())
+
+    async def complete(messages, temperature=0.7):
+        return reply if isinstance(reply, str) else json.dumps(reply)
+    monkeypatch.setattr(service.ai_service, "complete", complete)
+    return asyncio.run(service.evaluate_conversation_compatibility(CONTEXT, _Agent(), _Agent()))
+
+@pytest.mark.parametrize("reply", [
+    "不是JSON",
+    '{"evaluations": [{"index": 0, ',
+    "```json\n{}\n```",
+    [],
+    {"evaluations": "全部良好"},
+    {},
+])
+def test_malformed_batch_reply_falls_back_to_defaults(monkeypatch, reply):
+    assert _evaluate_batch(monkeypatch, reply) == [DEFAULT] * len(CONTEXT)
+
+def test_missing_and_invalid_entries_keep_defaults(monkeypatch):
+    results = _evaluate_batch(monkeypatch, {"evaluations": [
+        {"index": 1, "love_score_delta": "很高", "friendship_score_delta": 0.1},  # 无效分数
+        "第0条还不错",  # 不是对象
+        {"index": 7, "love_score_delta": 1, "friendship_score_delta": 1},  # 序号越界
+        {"love_score_delta": 1, "friendship_score_delta": 1},  # 缺少序号
+        {"index": 0, "love_score_delta": "NaN", "friendship_score_delta": 0.1},
+        {"index": 2, "love_score_delta": 0.5, "friendship_score_delta": 0.2, "analysis": "共同爱好"},
+    ]})
+
+    # 一条无效条目不影响其后的条目；没有有效评估的消息保留默认值
+    assert results == [DEFAULT, DEFAULT, (0.5, 0.2, "共同爱好")]
+
+def test_batch_scores_are_clamped_and_fields_defaulted(monkeypatch):
+    results = _evaluate_batch(monkeypatch, {"evaluations": [
+        {"index": 0, "love_score_delta": 25, "friendship_score_delta": -40, "analysis": "过分热情"},
+        {"index": "1", "love_score_delta": "0.3"},
+        {"index": 2, "love_score_delta": -10, "friendship_score_delta": 10, "analysis": "边界"},
+    ]})
+
+    assert results == [(10, -10, "过分热情"), (0.3, 0.0, "无分析说明"), (-10.0, 10.0, "边界")]
+
+def test_batch_request_failure_marks_every_message(monkeypatch):
+    service = MatchService(AIService())
+
+    async def complete(messages, temperature=0.7):
+        raise RuntimeError("upstream down")
+    monkeypatch.setattr(service.ai_service, "complete", complete)
+
+    results = asyncio.run(service.evaluate_conversation_compatibility(CONTEXT, _Agent(), _Agent()))
+    assert results == [(0.0, 0.0, "评估失败: upstream down")] * len(CONTEXT)
+    assert asyncio.run(service.evaluate_conversation_compatibility([], _Agent(), _Agent())) == []
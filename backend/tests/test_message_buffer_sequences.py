@@ -0,0 +1,127 @@
+"""
+聊天消息序号：缓冲写入与直接写入共用计数器，序号顺序与发送顺序一致；按序号轮询不越过未刷写的消息
+"""
+
+import asyncio
+import threading
+from datetime import timedelta
+
+from fastapi import Response
+
+from api.routes import PREV, encode_cursor, paginate_chat_messages
+from models.database import RealTimeMessage
+from services.chat_service import chat_service
+from services.message_buffer import MessageWriteBuffer
+
+def _chat_session(db, make_user):
+    alice, _ = make_user("alice")
+    bob, _ = make_user("bob")
+    return alice, bob, chat_service.get_or_create_chat_session(db, alice.id, bob.id)
+
+def _sequences_in_send_order(db, session_id):
+    rows = db.query(RealTimeMessage.content, RealTimeMessage.sequence_number).filter(
+        RealTimeMessage.chat_session_id == session_id
+    ).all()
+    return [seq for _, seq in sorted(rows, key=lambda row: int(row[0]))]
+
+def test_buffered_and_direct_writes_share_one_sequence(db, make_user):
+    alice, bob, session = _chat_session(db, make_user)
+    first, second = MessageWriteBuffer(), MessageWriteBuffer()
+
+    async def send_all():
+        # 两个缓冲实例（模拟两个进程）与直接写入交替发送，content 记录发送顺序
+        for i in range(9):
+            if i % 3 == 0:
+                chat_service.send_message(db, session.id, alice.id, str(i))
+            else:
+                buffer = first if i % 3 == 1 else second
+                await buffer.add_message(session.id, bob.id, str(i))
+
+    asyncio.run(send_all())
+
+    assert _sequences_in_send_order(db, session.id) == list(range(1, 10))
+
+def test_sequence_allocation_runs_off_the_event_loop(db, make_user, monkeypatch):
+    _, bob, session = _chat_session(db, make_user)
+    buffer = MessageWriteBuffer()
+    threads = []
+    allocate = buffer._allocate_sequence_numbers
+
+    def recording_allocate(session_id, count):
+        threads.append(threading.get_ident())
+        return allocate(session_id, count)
+
+    monkeypatch.setattr(buffer, "_allocate_sequence_numbers", recording_allocate)
+
+    async def send():
+        await buffer.add_message(session.id, bob.id, "1")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(send())
+
+    assert threads and loop_thread not in threads
+
+def test_concurrent_messages_share_one_allocation(db, make_user, monkeypatch):
+    alice, bob, session = _chat_session(db, make_user)
+    buffer = MessageWriteBuffer()
+    allocations = []
+    allocate = buffer._allocate_sequence_numbers
+
+    def recording_allocate(session_id, count):
+        allocations.append(count)
+        return allocate(session_id, count)
+
+    monkeypatch.setattr(buffer, "_allocate_sequence_numbers", recording_allocate)
+
+    async def send_all():
+        # 同一会话同时到达的10条消息只需一次分配；之后单独发送的消息各自分配
+        burst = await asyncio.gather(*[buffer.add_message(session.id, bob.id, str(i)) for i in range(1, 11)])
+        later = await buffer.add_message(session.id, alice.id, "11")
+        return [m["sequence_number"] for m in burst] + [later["sequence_number"]]
+
+    sequences = asyncio.run(send_all())
+
+    assert allocations == [10, 1]
+    assert sequences == list(range(1, 12))
+    assert _sequences_in_send_order(db, session.id) == list(range(1, 12))
+    assert not buffer._allocators and not buffer._sequence_waiters
+
+def test_polling_waits_for_unflushed_sequence(db, make_user):
+    alice, bob, session = _chat_session(db, make_user)
+    chat_service.send_message(db, session.id, alice.id, "1")
+    buffer = MessageWriteBuffer()
+
+    def poll(after):
+        messages = paginate_chat_messages(db, session.id, 50, 0, encode_cursor(PREV, seq=after), Response())
+        return [m.sequence_number for m in messages]
+
+    async def scenario():
+        # 标记为运行中但不启动刷写任务，消息停留在缓冲中
+        buffer.running = True
+        await buffer.add_message(session.id, bob.id, "2")
+        chat_service.send_message(db, session.id, alice.id, "3")
+
+        # 序号2尚未写入，轮询不能越过它返回序号3
+        assert poll(1) == []
+
+        buffer.running = False
+        await buffer._flush()
+        db.expire_all()
+        assert poll(1) == [2, 3]
+
+    asyncio.run(scenario())
+
+def test_polling_skips_stale_gap(db, make_user):
+    alice, _, session = _chat_session(db, make_user)
+    for content in ("1", "2", "3"):
+        chat_service.send_message(db, session.id, alice.id, content)
+
+    # 序号2已删除且之后的消息早已写入，空洞不再阻塞轮询
+    db.query(RealTimeMessage).filter(RealTimeMessage.sequence_number == 2).update({"is_deleted": True})
+    third = db.query(RealTimeMessage).filter(RealTimeMessage.sequence_number == 3).one()
+    third.created_at = third.created_at - timedelta(minutes=1)
+    db.commit()
+
+    messages = paginate_chat_messages(db, session.id, 50, 0, encode_cursor(PREV, seq=1), Response())
+
+    assert [m.sequence_number for m in messages] == [3]
@@ -0,0 +1,112 @@
+"""
+流式发送消息（SSE）：生成完成后用户消息和回复一起保存；
+生成出错或客户端中途断开时两者都不保存，对话中不留下没有回复的用户消息
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from api.routes import MessageCreate, send_message_stream
+from models.database import Conversation, ConversationMessage
+from services.ai_service import ai_service
+
+@pytest.fixture
+def chat(db, make_user, scenario):
+    user, persona = make_user("alice")
+    conversation = Conversation(user_id=user.id, digital_persona_id=persona.id, scenario_id=scenario.id)
+    db.add(conversation)
+    db.commit()
+    return user, conversation.id
+
+def _fake_stream(monkeypatch, events, closed=None):
+    async def stream_agent_response(**kwargs):
+        try:
+            for event in events:
+                await asyncio.sleep(0)
+                yield event
+        finally:
+            if closed is not None:
+                closed.append(True)
+    monkeypatch.setattr(ai_service, "stream_agent_response", stream_agent_response)
+
+def _parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def _stored(db, conversation_id):
+    db.expire_all()
+    messages = db.query(ConversationMessage).filter(
+        ConversationMessage.conversation_id == conversation_id
+    ).order_by(ConversationMessage.message_index).all()
+    conversation = db.get(Conversation, conversation_id)
+    return [(m.sender_type, m.content, m.message_index) for m in messages], conversation.message_count
+
+def test_stream_saves_both_turns_on_completion(client, auth_headers, db, chat, monkeypatch):
+    user, conversation_id = chat
+    _fake_stream(monkeypatch, [
+        {"type": "delta", "content": "你"},
+        {"type": "delta", "content": "好"},
+        {"type": "done", "content": "你好", "metadata": {"model_used": "fake"}},
+    ])
+
+    response = client.post("/api/v1/messages/stream", headers=auth_headers(user),
+                           json={"conversation_id": conversation_id, "content": "在吗"})
+
+    assert response.status_code == 200
+    events = _parse_sse(response.text)
+    assert [name for name, _ in events] == ["delta", "delta", "done"]
+    assert events[-1][1]["content"] == "你好" and events[-1][1]["message_index"] == 1
+    assert _stored(db, conversation_id) == ([("user", "在吗", 0), ("agent", "你好", 1)], 2)
+
+def test_stream_error_saves_nothing(client, auth_headers, db, chat, monkeypatch):
+    user, conversation_id = chat
+    _fake_stream(monkeypatch, [
+        {"type": "delta", "content": "你"},
+        {"type": "error", "error": "upstream failed"},
+    ])
+
+    response = client.post("/api/v1/messages/stream", headers=auth_headers(user),
+                           json={"conversation_id": conversation_id, "content": "在吗"})
+
+    assert [name for name, _ in _parse_sse(response.text)] == ["delta", "error"]
+    assert _stored(db, conversation_id) == ([], 0)
+
+def test_client_disconnect_saves_nothing(db, chat, monkeypatch):
+    user, conversation_id = chat
+    closed = []
+    _fake_stream(monkeypatch, [
+        {"type": "delta", "content": "你"},
+        {"type": "delta", "content": "好"},
+        {"type": "done", "content": "你好", "metadata": {}},
+    ], closed)
+
+    async def disconnect_after_first_event():
+        response = await send_message_stream(MessageCreate(conversation_id=conversation_id, content="在吗"), user, db)
+        body = response.body_iterator
+        first = await body.__anext__()
+        # 客户端断开时 Starlette 取消响应任务，生成器被关闭
+        await body.aclose()
+        return first
+
+    first = asyncio.run(disconnect_after_first_event())
+
+    assert first.startswith("event: delta")
+    assert closed == [True]
+    assert _stored(db, conversation_id) == ([], 0)
+
+def test_next_turn_after_failed_stream_continues_the_sequence(client, auth_headers, db, chat, monkeypatch):
+    user, conversation_id = chat
+    _fake_stream(monkeypatch, [{"type": "error", "error": "upstream failed"}])
+    client.post("/api/v1/messages/stream", headers=auth_headers(user),
+                json={"conversation_id": conversation_id, "content": "第一次"})
+
+    _fake_stream(monkeypatch, [{"type": "done", "content": "收到", "metadata": {}}])
+    client.post("/api/v1/messages/stream", headers=auth_headers(user),
+                json={"conversation_id": conversation_id, "content": "重发"})
+
+    assert _stored(db, conversation_id) == ([("user", "重发", 0), ("agent", "收到", 1)], 2)
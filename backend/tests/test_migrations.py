@@ -0,0 +1,141 @@
+"""
+数据库迁移：新数据库按迁移得到与模型一致的结构；初始迁移固定为基线表结构；PostgreSQL 上重建无效索引
+"""
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from migrations import HEAD_VERSION, get_current_version, upgrade
+from migrations.runner import MigrationContext
+from migrations.versions import v0001_initial_schema, v0008_market_search_coalesce
+from models.database import Base
+
+@pytest.fixture
+def fresh_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/fresh.db")
+    yield engine
+    engine.dispose()
+
+def _schema(engine):
+    inspector = inspect(engine)
+    return {
+        table: (
+            {column["name"] for column in inspector.get_columns(table)},
+            {index["name"] for index in inspector.get_indexes(table)}
+        )
+        for table in inspector.get_table_names()
+    }
+
+def _assert_matches_models(schema):
+    for table in Base.metadata.sorted_tables:
+        assert table.name in schema, f"缺少表 {table.name}"
+        columns, indexes = schema[table.name]
+        assert columns == {column.name for column in table.columns}, table.name
+        assert {index.name for index in table.indexes} <= indexes, table.name
+
+def test_fresh_database_matches_models(fresh_engine):
+    upgrade(bind=fresh_engine)
+
+    assert get_current_version(fresh_engine) == HEAD_VERSION
+    _assert_matches_models(_schema(fresh_engine))
+
+def test_initial_schema_is_the_baseline(fresh_engine):
+    with fresh_engine.begin() as connection:
+        v0001_initial_schema.upgrade(MigrationContext(connection))
+
+    schema = _schema(fresh_engine)
+    # 之后的迁移添加的表和列不在初始结构中
+    assert "task_jobs" not in schema and "market_agent_tags" not in schema
+    assert "message_count" not in schema["conversations"][0]
+    assert "schedule_owner" not in schema["match_relations"][0]
+    assert "idx_chat_session_users" in schema["chat_sessions"][1]
+
+def test_legacy_create_all_database_upgrades(fresh_engine):
+    # 引入迁移之前的部署直接用 create_all 建表
+    Base.metadata.create_all(bind=fresh_engine)
+
+    upgrade(bind=fresh_engine)
+
+    assert get_current_version(fresh_engine) == HEAD_VERSION
+    _assert_matches_models(_schema(fresh_engine))
+
+def test_conversation_summary_backfill(fresh_engine):
+    upgrade(bind=fresh_engine, target=2)
+    with fresh_engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO conversations (id, user_id, digital_persona_id, scenario_id) "
+            "VALUES ('c1', 'u', 'p', 's'), ('c2', 'u', 'p', 's')"
+        ))
+        connection.execute(text(
+            "INSERT INTO conversation_messages (id, conversation_id, sender_type, content, message_index, created_at) "
+            "VALUES (:id, 'c1', 'user', :content, :index, :created_at)"
+        ), [
+            {"id": "m1", "content": "你好", "index": 1, "created_at": "2026-01-01 10:00:00"},
+            {"id": "m2", "content": "长" * 60, "index": 2, "created_at": "2026-01-01 10:01:00"},
+        ])
+
+    upgrade(bind=fresh_engine, target=3)
+
+    with fresh_engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT id, message_count, last_message_preview, last_message_at FROM conversations ORDER BY id"
+        )).fetchall()
+    assert [tuple(row) for row in rows] == [
+        ("c1", 2, "长" * 50 + "...", "2026-01-01 10:01:00"),
+        ("c2", 0, None, None),
+    ]
+
+class _Result:
+    def __init__(self, value=None):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+class _PostgresConnection:
+    """记录执行的SQL，查询结果按SQL中包含的关键字返回预设值"""
+
+    class dialect:
+        name = "postgresql"
+
+    def __init__(self, **results):
+        self.results = results
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        self.statements.append(sql)
+        return _Result(next((value for key, value in self.results.items() if key in sql), None))
+
+    def ddl(self):
+        return [sql for sql in self.statements if not sql.startswith("SELECT")]
+
+@pytest.mark.parametrize("index_valid, rebuilt", [(False, True), (True, False), (None, False)])
+def test_create_index_rebuilds_invalid_postgres_index(index_valid, rebuilt):
+    connection = _PostgresConnection(indisvalid=index_valid)
+
+    MigrationContext(connection).create_index("idx_example", "example", ["a", "b"])
+
+    statements = connection.ddl()
+    create = "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_example ON example (a, b)"
+    if rebuilt:
+        assert statements == ["DROP INDEX CONCURRENTLY IF EXISTS idx_example", create]
+    else:
+        assert statements == [create]
+
+@pytest.mark.parametrize("definition, dropped", [
+    ("CREATE INDEX idx_market_agent_search_trgm ON public.market_agents USING gin "
+     "((((display_name)::text || ' '::text) || display_description) gin_trgm_ops)", True),
+    ("CREATE INDEX idx_market_agent_search_trgm ON public.market_agents USING gin "
+     "((((display_name)::text || ' '::text) || COALESCE(display_description, ''::text)) gin_trgm_ops)", False),
+    (None, False),
+])
+def test_market_search_index_is_rebuilt_with_coalesce(definition, dropped):
+    connection = _PostgresConnection(pg_extension=1, pg_get_indexdef=definition, indisvalid=None)
+
+    v0008_market_search_coalesce.upgrade(MigrationContext(connection))
+
+    drop = "DROP INDEX CONCURRENTLY IF EXISTS idx_market_agent_search_trgm"
+    create = ("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_market_agent_search_trgm ON market_agents USING gin "
+              "((display_name || ' ' || coalesce(display_description, '')) gin_trgm_ops)")
+    assert connection.ddl() == ([drop, create] if dropped else [create])
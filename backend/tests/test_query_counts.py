@@ -0,0 +1,92 @@
+"""
+列表接口的查询次数回归测试：查询次数不随返回条数增长（无 N+1）
+"""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from models.database import Conversation, engine
+
+# get_current_user 的两次用户查询
+AUTH_QUERIES = 2
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+@pytest.fixture
+def me(make_user, make_market_agent):
+    user, persona = make_user("me")
+    return user, persona, make_market_agent(user, persona, tags=["音乐"])
+
+def _others(make_user, make_market_agent, prefix, count):
+    agents = []
+    for i in range(count):
+        user, persona = make_user(f"{prefix}{i}")
+        agents.append(make_market_agent(user, persona, tags=["电影", "旅行"]))
+    return agents
+
+def _get(client, auth_headers, user, url):
+    with count_queries() as statements:
+        response = client.get(url, headers=auth_headers(user))
+    assert response.status_code == 200, response.text
+    return response.json(), len(statements)
+
+def test_followers_query_count(client, auth_headers, me, make_user, make_market_agent, make_match):
+    user, _, agent = me
+    for other in _others(make_user, make_market_agent, "small", 2):
+        make_match(other, agent)
+    small, small_queries = _get(client, auth_headers, user, "/api/v1/followers")
+
+    for other in _others(make_user, make_market_agent, "large", 8):
+        make_match(other, agent)
+    large, large_queries = _get(client, auth_headers, user, "/api/v1/followers")
+
+    assert (len(small), len(large)) == (2, 10)
+    # 关注关系、发起者agent、聊天消息检查在同一条查询中
+    assert large_queries == small_queries == AUTH_QUERIES + 1
+
+def test_match_list_query_count(client, auth_headers, me, make_user, make_market_agent, make_match):
+    user, _, agent = me
+    for other in _others(make_user, make_market_agent, "small", 2):
+        make_match(agent, other, love_compatibility_score=0.5)
+    small, small_queries = _get(client, auth_headers, user, "/api/v1/match-relations")
+
+    for other in _others(make_user, make_market_agent, "large", 8):
+        make_match(agent, other, love_compatibility_score=0.8)
+    large, large_queries = _get(client, auth_headers, user, "/api/v1/match-relations?limit=20")
+
+    assert (len(small), len(large)) == (2, 10)
+    # 匹配关系与目标agent在同一条查询中
+    assert large_queries == small_queries == AUTH_QUERIES + 1
+
+def test_conversation_list_query_count(client, auth_headers, db, me, scenario):
+    user, persona, _ = me
+
+    def add_conversations(count):
+        db.add_all([
+            Conversation(user_id=user.id, digital_persona_id=persona.id, scenario_id=scenario.id,
+                         title=f"对话{i}", message_count=i, last_message_preview="你好")
+            for i in range(count)
+        ])
+        db.commit()
+
+    add_conversations(2)
+    small, small_queries = _get(client, auth_headers, user, "/api/v1/conversations/paginated?size=20")
+    add_conversations(8)
+    large, large_queries = _get(client, auth_headers, user, "/api/v1/conversations/paginated?size=20")
+
+    assert (len(small["conversations"]), len(large["conversations"])) == (2, 10)
+    # 总数 + 当前页（场景、消息数和最后一条消息随页面一起取得）
+    assert large_queries == small_queries == AUTH_QUERIES + 2
@@ -0,0 +1,98 @@
+"""
+热点查询的执行计划：对服务实际发出的SQL执行 EXPLAIN QUERY PLAN，确认走复合索引而不是全表扫描
+"""
+
+import asyncio
+import re
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from models.database import Conversation, engine
+from services.chat_service import chat_service
+from services.conversation_context import ConversationContextBuilder
+from services.match_service import match_service
+
+def _capture(action):
+    """执行 action，返回期间发出的 (SQL, 参数)"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        action()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+def _plan(statements, table):
+    """主表为 table 的那条查询的执行计划"""
+    matching = [(sql, params) for sql, params in statements if re.search(rf"\bFROM {table}\b", sql)]
+    assert matching, f"没有查询 {table} 的语句"
+    sql, params = matching[0]
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[-1] for row in rows]
+
+def _assert_uses_index(plan, table, index):
+    assert any(
+        re.match(rf"SEARCH {table}\b.*USING (COVERING )?INDEX {index}\b", step) for step in plan
+    ), plan
+    assert not any(re.match(rf"SCAN {table}\b", step) for step in plan), plan
+    # 按索引顺序读取，不需要额外排序
+    assert not any("USE TEMP B-TREE FOR ORDER BY" in step for step in plan), plan
+
+@pytest.fixture
+def alice(make_user):
+    user, _ = make_user("alice")
+    return user
+
+@pytest.mark.parametrize("match_type, index", [
+    (None, "idx_match_relation_initiator_score"),
+    ("love", "idx_match_relation_initiator_type_score"),
+])
+def test_match_list(db, alice, match_type, index):
+    statements = _capture(lambda: match_service.get_user_matches(
+        db, alice.id, match_type=match_type, limit=51, after=(0.5, "x")
+    ))
+    _assert_uses_index(_plan(statements, "match_relations"), "match_relations", index)
+
+def test_followers(db, alice):
+    statements = _capture(lambda: match_service.get_followers(db, alice.id, match_type="love"))
+    plan = _plan(statements, "match_relations")
+    assert any(re.match(r"SEARCH match_relations\b.*INDEX idx_match_relation_target\b", step) for step in plan), plan
+    assert not any(re.match(r"SCAN match_relations\b", step) for step in plan), plan
+
+@pytest.mark.parametrize("market_type, index", [
+    ("love", "idx_market_agent_active_type_last_id"),
+    (None, "idx_market_agent_active_last_id"),
+])
+def test_market_list(db, alice, market_type, index):
+    statements = _capture(lambda: match_service.get_market_agents(
+        db, market_type=market_type, exclude_user_id=alice.id, limit=51, after=(datetime.utcnow(), "x")
+    ))
+    _assert_uses_index(_plan(statements, "market_agents"), "market_agents", index)
+
+@pytest.mark.parametrize("kwargs", [{}, {"before_sequence": 100}, {"after_sequence": 100}])
+def test_chat_messages(db, alice, make_user, kwargs):
+    bob, _ = make_user("bob")
+    session = chat_service.get_or_create_chat_session(db, alice.id, bob.id)
+    session_id = session.id
+
+    statements = _capture(lambda: chat_service.get_messages(db, session_id, limit=51, **kwargs))
+    _assert_uses_index(_plan(statements, "realtime_messages"), "realtime_messages",
+                       "idx_realtime_message_session_seq")
+
+def test_conversation_history_window(db, alice, scenario):
+    persona = alice.digital_personas[0]
+    conversation = Conversation(user_id=alice.id, digital_persona_id=persona.id, scenario_id=scenario.id)
+    db.add(conversation)
+    db.commit()
+    db.refresh(conversation)
+
+    statements = _capture(lambda: asyncio.run(ConversationContextBuilder().build(db, conversation)))
+    _assert_uses_index(_plan(statements, "conversation_messages"), "conversation_messages",
+                       "idx_conversation_message_conv_index")
@@ -0,0 +1,148 @@
+"""
+多个调度器实例同时运行时，每次到期的对话只派发一次；
+派发出的任务在排队或重试期间租约到期不会被重复派发
+"""
+
+import asyncio
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from models.database import MatchRelation, SessionLocal, TaskJob
+from services.match_service import match_service
+from services.scheduler_service import SchedulerService
+from services.task_service import task_service
+
+SCHEDULER_COUNT = 5
+MATCH_COUNT = 30
+
+@pytest.fixture
+def new_scheduler(monkeypatch):
+    monkeypatch.setenv("SCHEDULER_DISPATCH_RATE", "10000")
+    monkeypatch.setenv("SCHEDULER_DISPATCH_BURST", "10000")
+    return SchedulerService
+
+@pytest.fixture
+def due_matches(db, make_user, make_market_agent, make_match, scenario):
+    due_at = datetime.utcnow() - timedelta(seconds=1)
+    user, persona = make_user("target")
+    target = make_market_agent(user, persona)
+    matches = []
+    for i in range(MATCH_COUNT):
+        user, persona = make_user(f"initiator{i}")
+        matches.append(make_match(make_market_agent(user, persona), target, next_scheduled_conversation=due_at))
+    return [m.id for m in matches]
+
+def _run_once(scheduler: SchedulerService):
+    async def run():
+        scheduler._load_schedules(datetime.utcnow())
+        await scheduler._process_due_conversations()
+    asyncio.run(run())
+
+def _jobs_by_match(db):
+    jobs = {}
+    for job in db.query(TaskJob).all():
+        jobs.setdefault(match_id_of(job), []).append(job)
+    return jobs
+
+def match_id_of(job: TaskJob) -> str:
+    return json.loads(job.payload)["match_relation_id"]
+
+def test_concurrent_schedulers_dispatch_each_match_once(db, due_matches, new_scheduler):
+    schedulers = [new_scheduler() for _ in range(SCHEDULER_COUNT)]
+    barrier = threading.Barrier(SCHEDULER_COUNT)
+    errors = []
+
+    def worker(scheduler):
+        try:
+            barrier.wait()
+            _run_once(scheduler)
+        except Exception as e:  # 在主线程断言
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(s,)) for s in schedulers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    jobs = _jobs_by_match(db)
+    assert sorted(jobs) == sorted(due_matches)
+    assert all(len(match_jobs) == 1 for match_jobs in jobs.values())
+
+    # 每个匹配关系的领取记录指向派发出的那个任务
+    owners = dict(db.query(MatchRelation.id, MatchRelation.schedule_owner).all())
+    assert all(owners[match_id] == match_jobs[0].id for match_id, match_jobs in jobs.items())
+
+def _expire_lease(match_id: str):
+    session = SessionLocal()
+    try:
+        session.query(MatchRelation).filter(MatchRelation.id == match_id).update(
+            {"next_scheduled_conversation": datetime.utcnow() - timedelta(seconds=1)}
+        )
+        session.commit()
+    finally:
+        session.close()
+
+def test_expired_lease_is_extended_while_job_is_queued(db, due_matches, new_scheduler):
+    match_id = due_matches[0]
+    _run_once(new_scheduler())
+    (job,) = _jobs_by_match(db)[match_id]
+
+    # 任务仍在排队时租约到期：另一个调度器只续租，不重复派发
+    _expire_lease(match_id)
+    _run_once(new_scheduler())
+    db.expire_all()
+    assert len(_jobs_by_match(db)[match_id]) == 1
+    relation = db.get(MatchRelation, match_id)
+    assert relation.schedule_owner == job.id
+    assert relation.next_scheduled_conversation > datetime.utcnow()
+
+    # 任务最终失败后租约到期：重新派发新任务
+    db.query(TaskJob).filter(TaskJob.id == job.id).update({"status": "failed"})
+    db.commit()
+    _expire_lease(match_id)
+    _run_once(new_scheduler())
+    db.expire_all()
+    match_jobs = _jobs_by_match(db)[match_id]
+    assert len(match_jobs) == 2
+    assert db.get(MatchRelation, match_id).schedule_owner != job.id
+
+def test_job_whose_claim_was_taken_over_does_not_run(db, due_matches, new_scheduler, monkeypatch):
+    match_id = due_matches[0]
+    _run_once(new_scheduler())
+    (stale_job,) = _jobs_by_match(db)[match_id]
+
+    # 模拟排队期间租约被其他调度器接管
+    db.query(MatchRelation).filter(MatchRelation.id == match_id).update({"schedule_owner": "other-task"})
+    db.commit()
+
+    async def must_not_run(**kwargs):
+        raise AssertionError("对话不应执行")
+    monkeypatch.setattr(match_service, "conduct_auto_conversation", must_not_run)
+
+    payload = json.loads(stale_job.payload)
+    result = asyncio.run(task_service._execute_conversation(stale_job.id, **payload))
+    assert result["skipped"] is True
+
+def test_job_holding_its_claim_runs_and_refreshes_lease(db, due_matches, new_scheduler, monkeypatch):
+    match_id = due_matches[0]
+    _run_once(new_scheduler())
+    (job,) = _jobs_by_match(db)[match_id]
+    _expire_lease(match_id)
+
+    ran = []
+
+    async def fake_conversation(match_relation, **kwargs):
+        # 开始执行时租约已续期，其他调度器不会重新领取
+        assert match_relation.next_scheduled_conversation > datetime.utcnow()
+        ran.append(match_relation.id)
+        raise RuntimeError("stop after start check")
+    monkeypatch.setattr(match_service, "conduct_auto_conversation", fake_conversation)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(task_service._execute_conversation(job.id, **json.loads(job.payload)))
+    assert ran == [match_id]
@@ -0,0 +1,122 @@
+"""
+调度器的内存最小堆：按计划时间派发到期条目；取消、重新安排后旧条目被跳过；
+按时间窗口分批加载计划；没有可用场景时到期条目留在堆中，恢复后继续派发
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from models.database import Scenario
+from services.scheduler_service import SchedulerService
+
+@pytest.fixture
+def new_scheduler(monkeypatch):
+    monkeypatch.setenv("SCHEDULER_DISPATCH_RATE", "10000")
+    monkeypatch.setenv("SCHEDULER_DISPATCH_BURST", "10000")
+
+    def make(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        scheduler = SchedulerService()
+        scheduler.dispatched = []
+        # 只记录派发顺序，不领取计划、不创建任务
+        scheduler._dispatch_conversation = lambda db, match_id, scheduled_at, scenarios: \
+            scheduler.dispatched.append(match_id)
+        return scheduler
+    return make
+
+def _ago(seconds):
+    return datetime.utcnow() - timedelta(seconds=seconds)
+
+def _process(scheduler):
+    asyncio.run(scheduler._process_due_conversations())
+    return scheduler.dispatched
+
+def test_due_entries_dispatch_in_schedule_order(new_scheduler, scenario):
+    scheduler = new_scheduler()
+    for match_id, seconds_ago in [("m3", 1), ("m1", 30), ("future", -600), ("m2", 10)]:
+        scheduler.notify_schedule_changed(match_id, _ago(seconds_ago))
+
+    assert _process(scheduler) == ["m1", "m2", "m3"]
+    # 未到期的条目留在堆中
+    assert list(scheduler._scheduled) == ["future"]
+    assert scheduler.get_status()["next_due_at"] == scheduler._scheduled["future"].isoformat()
+
+def test_cancelled_and_rescheduled_entries_are_skipped(new_scheduler, scenario):
+    scheduler = new_scheduler()
+    scheduler.notify_schedule_changed("cancelled", _ago(20))
+    scheduler.notify_schedule_changed("moved", _ago(20))
+    scheduler.notify_schedule_changed("kept", _ago(10))
+
+    scheduler.notify_schedule_changed("cancelled", None)
+    scheduler.notify_schedule_changed("moved", _ago(5))  # 重新安排：旧条目仍在堆中但已失效
+
+    assert _process(scheduler) == ["kept", "moved"]
+    assert scheduler._scheduled == {}
+
+def test_schedule_beyond_horizon_is_not_kept_in_memory(new_scheduler, scenario):
+    scheduler = new_scheduler(SCHEDULER_HORIZON=3600)
+    scheduler.notify_schedule_changed("soon", _ago(-60))
+    scheduler.notify_schedule_changed("later", _ago(-7200))
+
+    assert set(scheduler._scheduled) == {"soon"}
+
+    # 原本在窗口内的计划被推迟到窗口外时，移出内存，之后由窗口推进时的加载纳入
+    scheduler.notify_schedule_changed("soon", _ago(-7200))
+    assert scheduler._scheduled == {}
+    assert _process(scheduler) == []
+
+def test_horizon_loading_in_batches(db, new_scheduler, make_user, make_market_agent, make_match):
+    user, persona = make_user("target")
+    target = make_market_agent(user, persona)
+
+    def match(name, scheduled_at, **fields):
+        user, persona = make_user(name)
+        return make_match(make_market_agent(user, persona), target, next_scheduled_conversation=scheduled_at, **fields).id
+
+    now = datetime.utcnow()
+    in_window = [match(f"due{i}", now - timedelta(minutes=5 - i)) for i in range(5)]
+    match("outside", now + timedelta(hours=2))
+    match("inactive", now - timedelta(minutes=1), status="cancelled")
+
+    scheduler = new_scheduler(SCHEDULER_HORIZON=3600, SCHEDULER_BATCH_SIZE=2)
+
+    # 每批最多加载2条，批次满时立即继续加载下一批
+    scheduler._load_schedules(now)
+    assert len(scheduler._scheduled) == 2 and scheduler._next_load_at == now
+    scheduler._load_schedules(now)
+    scheduler._load_schedules(now)
+    assert set(scheduler._scheduled) == set(in_window)
+    assert scheduler._next_load_at > now
+
+    # 游标之后没有新的计划，再次加载不会重复入堆
+    heap_size = len(scheduler._heap)
+    scheduler._load_schedules(now)
+    assert len(scheduler._heap) == heap_size
+
+    # 窗口推进到两小时后，窗口外的计划被纳入（全量同步重建堆）
+    later = now + timedelta(hours=2)
+    scheduler._next_resync_at = later
+    while scheduler._next_load_at <= later:
+        scheduler._load_schedules(later)
+    assert len(scheduler._scheduled) == 6
+
+def test_due_entry_waits_for_scenarios(db, new_scheduler):
+    scheduler = new_scheduler(SCHEDULER_NO_SCENARIO_RETRY=60)
+    scheduler.notify_schedule_changed("m1", _ago(10))
+
+    # 没有可用场景：条目放回堆中并暂停派发，而不是被丢弃
+    assert _process(scheduler) == []
+    assert "m1" in scheduler._scheduled
+    assert scheduler._dispatch_paused_until > datetime.utcnow() + timedelta(seconds=50)
+
+    # 暂停期间即使有了场景也不派发
+    db.add(Scenario(name="公园", description="在公园散步", context="傍晚的公园", category="日常"))
+    db.commit()
+    assert _process(scheduler) == []
+
+    scheduler._dispatch_paused_until = _ago(1)
+    assert _process(scheduler) == ["m1"]
+    assert scheduler._scheduled == {}
@@ -0,0 +1,193 @@
+"""
+任务队列的租约：条件更新领取、租约到期后重新领取、失败退避重试、超过最大次数后失败、
+多个worker同时领取时每个任务只被领取一次；续约失败（租约被接管）时取消本地执行
+"""
+
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from models.database import SessionLocal, TaskJob
+from services.task_service import TaskService
+
+WORKER_COUNT = 5
+TASK_COUNT = 30
+
+@pytest.fixture
+def new_worker():
+    def make(max_attempts=3, retry_backoff=30, visibility_timeout=300):
+        worker = TaskService()
+        worker.max_attempts = max_attempts
+        worker.retry_backoff = retry_backoff
+        worker.visibility_timeout = visibility_timeout
+        return worker
+    return make
+
+def _job(db, task_id) -> TaskJob:
+    db.expire_all()
+    return db.get(TaskJob, task_id)
+
+def _make_available(task_id, **fields):
+    session = SessionLocal()
+    try:
+        session.query(TaskJob).filter(TaskJob.id == task_id).update(
+            fields or {"available_at": datetime.utcnow() - timedelta(seconds=1)}
+        )
+        session.commit()
+    finally:
+        session.close()
+
+def _expire_lease(task_id):
+    _make_available(task_id, locked_until=datetime.utcnow() - timedelta(seconds=1))
+
+def test_claim_is_exclusive(db, new_worker):
+    first, second = new_worker(), new_worker()
+    task_id = first.create_task("conversation")
+
+    assert first._claim_next_task() == task_id
+    assert second._claim_next_task() is None
+
+    job = _job(db, task_id)
+    assert (job.status, job.locked_by, job.attempts) == ("running", first.worker_id, 1)
+    assert job.locked_until > datetime.utcnow()
+
+def test_expired_lease_is_reclaimed(db, new_worker):
+    crashed, other = new_worker(), new_worker()
+    task_id = crashed.create_task("conversation")
+    crashed._claim_next_task()
+
+    # 租约未到期时不能领取，到期后由其他worker领取
+    assert other._claim_next_task() is None
+    _expire_lease(task_id)
+    assert other._claim_next_task() == task_id
+
+    # 原worker失去租约，结果不会被写入
+    crashed._complete_task(task_id, {"stale": True})
+    job = _job(db, task_id)
+    assert (job.status, job.locked_by, job.attempts, job.result) == ("running", other.worker_id, 2, None)
+
+def test_failed_task_retries_with_backoff(db, new_worker):
+    worker = new_worker(retry_backoff=30)
+    task_id = worker.create_task("conversation")
+
+    for attempt, backoff in [(1, 30), (2, 60)]:
+        assert worker._claim_next_task() == task_id
+        before = datetime.utcnow()
+        worker._fail_task(task_id, f"error {attempt}")
+
+        job = _job(db, task_id)
+        assert (job.status, job.attempts, job.locked_by, job.error) == ("pending", attempt, None, f"error {attempt}")
+        assert before + timedelta(seconds=backoff - 1) <= job.available_at <= datetime.utcnow() + timedelta(seconds=backoff)
+        # 退避期间不会被领取
+        assert worker._claim_next_task() is None
+        _make_available(task_id)
+
+def test_task_fails_after_max_attempts(db, new_worker):
+    worker = new_worker(max_attempts=2)
+    task_id = worker.create_task("conversation")
+
+    worker._claim_next_task()
+    worker._fail_task(task_id, "first")
+    _make_available(task_id)
+    worker._claim_next_task()
+    worker._fail_task(task_id, "second")
+
+    job = _job(db, task_id)
+    assert (job.status, job.attempts, job.error) == ("failed", 2, "second")
+    assert job.completed_at is not None
+    _make_available(task_id)
+    assert worker._claim_next_task() is None
+
+def test_repeatedly_expired_lease_fails_task(db, new_worker):
+    worker = new_worker(max_attempts=2)
+    task_id = worker.create_task("conversation")
+
+    for _ in range(2):
+        assert worker._claim_next_task() == task_id
+        _expire_lease(task_id)
+
+    # 第三次领取超过最大次数，任务直接失败
+    assert worker._claim_next_task() is None
+    job = _job(db, task_id)
+    assert (job.status, job.locked_by) == ("failed", None)
+
+def test_racing_workers_claim_each_task_once(db, new_worker):
+    workers = [new_worker() for _ in range(WORKER_COUNT)]
+    task_ids = [workers[0].create_task("conversation") for _ in range(TASK_COUNT)]
+    barrier = threading.Barrier(WORKER_COUNT)
+    claims, errors = [], []
+
+    def run(worker):
+        try:
+            barrier.wait()
+            while True:
+                task_id = worker._claim_next_task()
+                if not task_id:
+                    break
+                claims.append((task_id, worker.worker_id))
+        except Exception as e:  # 在主线程断言
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(w,)) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert sorted(task_id for task_id, _ in claims) == sorted(task_ids)
+    owners = dict(claims)
+    db.expire_all()
+    assert all(job.locked_by == owners[job.id] and job.attempts == 1 for job in db.query(TaskJob).all())
+
+def test_lost_lease_cancels_running_job(db, new_worker):
+    worker = new_worker(visibility_timeout=0.3)
+    started, finished = asyncio.Event(), []
+
+    async def slow_handler(task_id):
+        started.set()
+        await asyncio.sleep(5)
+        finished.append(task_id)
+        return {}
+    worker.handlers["slow"] = slow_handler
+
+    task_id = worker.create_task("slow")
+    assert worker._claim_next_task() == task_id
+
+    async def run():
+        semaphore = asyncio.Semaphore(1)
+        await semaphore.acquire()
+        job = asyncio.create_task(worker._run_job(task_id, semaphore))
+        await started.wait()
+        # 租约到期后被其他worker领取
+        _make_available(task_id, locked_by="other-worker")
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(job, timeout=2)
+        assert not semaphore.locked()
+
+    asyncio.run(run())
+    assert finished == []
+    job = _job(db, task_id)
+    assert (job.status, job.locked_by, job.result) == ("running", "other-worker", None)
+
+def test_heartbeat_keeps_lease_while_job_runs(db, new_worker):
+    worker = new_worker(visibility_timeout=0.3)
+
+    async def handler(task_id):
+        await asyncio.sleep(0.5)
+        return {"done": True}
+    worker.handlers["slow"] = handler
+
+    task_id = worker.create_task("slow")
+    worker._claim_next_task()
+
+    async def run():
+        semaphore = asyncio.Semaphore(1)
+        await semaphore.acquire()
+        await worker._run_job(task_id, semaphore)
+
+    asyncio.run(run())
+    job = _job(db, task_id)
+    assert (job.status, job.result) == ("completed", '{"done": true}')
@@ -0,0 +1,67 @@
+"""
+WebSocket 会话广播的基准测试：广播只遍历会话参与者，耗时不随服务器总连接数增长
+"""
+
+import asyncio
+import time
+
+from services.broadcast_backplane import InProcessBackplane
+from services.websocket_service import ConnectionManager
+
+BROADCASTS = 1000
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload: str):
+        self.sent += 1
+
+async def _connect_many(manager: ConnectionManager, connections: int):
+    """除被测会话的两个参与者外，再建立 connections 条其他会话的连接"""
+    for i in range(connections):
+        await manager.connect(FakeWebSocket(), f"user-{i}", f"session-{i // 2}")
+
+    alice, bob = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(alice, "alice", "target")
+    await manager.connect(bob, "bob", "target")
+    return alice, bob
+
+async def _broadcast_seconds(manager: ConnectionManager) -> float:
+    """多次测量取最小值，减少调度抖动的影响"""
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(BROADCASTS):
+            await manager.handle_typing_status("alice", "target", True)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+async def _run(connections: int):
+    manager = ConnectionManager()
+    manager.backplane = InProcessBackplane()
+    alice, bob = await _connect_many(manager, connections)
+    bob.sent = 0
+    others = [ws for sessions in manager.active_connections.values() for ws in sessions.values()]
+    sent_before = sum(ws.sent for ws in others)
+
+    elapsed = await _broadcast_seconds(manager)
+
+    other_sends = sum(ws.sent for ws in others) - sent_before - bob.sent
+    return elapsed, bob.sent, other_sends
+
+def test_broadcast_cost_is_independent_of_total_connections():
+    small, small_sent, small_other = asyncio.run(_run(100))
+    large, large_sent, large_other = asyncio.run(_run(20000))
+
+    # 只有会话中的另一个参与者收到广播（发送者被排除）
+    assert small_sent == large_sent == 5 * BROADCASTS
+    assert small_other == large_other == 0
+
+    # 连接数增加 200 倍，广播耗时基本不变（逐个扫描所有连接时会慢两个数量级）
+    assert large < small * 3
+    # 吞吐量：1000 次广播远小于 1 秒
+    assert large < 1.0
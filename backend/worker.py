@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+SoulLink 后台任务 Worker
+独立于API进程运行，从 task_jobs 队列中领取并执行任务，可多进程/多节点部署
+
+用法：
+    python worker.py [--concurrency N]
+
+部署独立worker时，建议在API进程中设置 TASK_WORKER_EMBEDDED=false
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.ai_service import ai_service
+from services.match_service import match_service
+from services.task_service import task_service
+
+async def run_worker(concurrency: int):
+    """运行worker直到收到退出信号"""
+    # 初始化服务依赖
+    match_service.ai_service = ai_service
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await task_service.start_worker(concurrency)
+    await stop_event.wait()
+
+    await task_service.stop_worker()
+    await ai_service.cleanup()
+
+def main():
+    """Worker入口"""
+    parser = argparse.ArgumentParser(description="SoulLink 后台任务 Worker")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=task_service.concurrency,
+        help="单个worker同时执行的任务数（默认取 TASK_WORKER_CONCURRENCY）"
+    )
+    args = parser.parse_args()
+
+    # 与API进程相同的日志配置，自动对话在worker中执行，结束判断的决策日志在这里输出
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+    print("🚀 SoulLink 任务Worker 启动中...")
+    asyncio.run(run_worker(args.concurrency))
+    print("👋 SoulLink 任务Worker 已安全退出")
+
+if __name__ == "__main__":
+    main()